@@ -0,0 +1,48 @@
+"""
+Compare utils.save_items write throughput under the default SQLite
+settings and each of the --db-profile pragma sets.
+
+    python benchmarks/bench_db_profile.py [num_items] [batch_size ...]
+
+Small batch sizes mean more commits, which is where synchronous and the
+journal mode matter most.
+"""
+import pathlib
+import sys
+import tempfile
+import time
+
+import sqlite_utils
+
+from pocket_to_sqlite import utils
+
+from bench_save_items import make_items
+
+
+def run(label, open_db, n, batch_size):
+    # save_items modifies items in place, so every run gets fresh copies
+    items = list(make_items(n))
+    with tempfile.TemporaryDirectory() as tmp:
+        db = open_db(str(pathlib.Path(tmp) / "bench.db"))
+        start = time.perf_counter()
+        utils.save_items(items, db, batch_size)
+        utils.finish_database(db)
+        elapsed = time.perf_counter() - start
+        assert db["items"].count == len(items)
+        db.close()
+    print("{:<8} batch {:>5}  {:>8} items in {:7.2f}s  {:>10.0f} items/sec".format(
+        label, batch_size, len(items), elapsed, len(items) / elapsed
+    ))
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    batch_sizes = [int(arg) for arg in sys.argv[2:]] or [10, 500]
+    for batch_size in batch_sizes:
+        run("default", sqlite_utils.Database, n, batch_size)
+        for profile in utils.DB_PROFILES:
+            run(profile, lambda path: utils.open_database(path, profile), n, batch_size)
+
+
+if __name__ == "__main__":
+    main()
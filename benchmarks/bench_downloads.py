@@ -0,0 +1,115 @@
+"""
+Compare autotag's page downloads against the old approach of six threads
+each doing requests.get(url).text, over a local server that mixes ordinary
+pages with slow ones, huge ones and PDFs.
+
+    python benchmarks/bench_downloads.py [num_pages] [--hosts N]
+
+Pages are spread over N hosts (127.0.0.1, 127.0.0.2, ... all served by the
+same process) so the per-host limits come into play. Each approach runs in
+its own subprocess so peak RSS is measured separately.
+"""
+import argparse
+import os
+import pathlib
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler
+
+import requests
+
+from pocket_to_sqlite import downloader
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / "tests"))
+from fake_servers import start_server, stop_server
+
+PAGE = b"<html><body>" + b"<p>lorem ipsum dolor sit amet</p>" * 1000 + b"</body></html>"
+HUGE = b"<html><body>" + b"x" * (20 * 1024 * 1024) + b"</body></html>"
+PDF = b"%PDF-1.4" + b"\0" * (5 * 1024 * 1024)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        kind = self.path.split("/")[1]
+        time.sleep(2 if kind == "slow" else 0.05)
+        body = {"huge": HUGE, "pdf": PDF}.get(kind, PAGE)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/pdf" if kind == "pdf" else "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # The downloader hung up after max_bytes or on seeing the type
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+def urls(port, n, hosts):
+    kinds = ["page"] * 16 + ["slow", "huge", "pdf"]
+    return [
+        "http://127.0.0.{}:{}/{}/{}".format(i % hosts + 1, port, kinds[i % len(kinds)], i)
+        for i in range(n)
+    ]
+
+
+def run_threads(pages):
+    session = requests.Session()
+    with ThreadPoolExecutor(max_workers=6) as executor:
+        return sum(
+            len(text) for text in executor.map(lambda url: session.get(url, timeout=10).text, pages)
+        )
+
+
+def run_async(pages):
+    with downloader.PageDownloader() as page_downloader:
+        futures = [page_downloader.submit(url) for url in pages]
+        return sum(len(future.result()[0] or "") for future in futures)
+
+
+def child(mode, port, n, hosts):
+    run = {"threads": run_threads, "async": run_async}[mode]
+    print(run(urls(port, n, hosts)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("num_pages", type=int, nargs="?", default=400)
+    parser.add_argument("--hosts", type=int, default=8)
+    options = parser.parse_args()
+    n, hosts = options.num_pages, options.hosts
+    # Every 127.0.0.x address, so pages can be spread over several hosts
+    server, _ = start_server(Handler, host="")
+    port = server.server_address[1]
+    print("{} pages over {} hosts, 1 in 19 slow, huge or PDF".format(n, hosts))
+    for mode in ("threads", "async"):
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, __file__, "--child", mode, str(port), str(n), str(hosts)],
+            stdout=subprocess.PIPE,
+        )
+        chars = process.stdout.read().decode("utf-8").strip()
+        # wait4 gives the rusage of this one child rather than all children
+        _, status, rusage = os.wait4(process.pid, 0)
+        elapsed = time.perf_counter() - start
+        process.stdout.close()
+        max_rss_mb = rusage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+        print(
+            "{:<8} {:7.2f}s  {:7.1f} pages/sec  {:7.1f} MB peak RSS  {:>12} chars kept".format(
+                mode, elapsed, n / elapsed, max_rss_mb, chars
+            )
+        )
+    stop_server(server)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--child"]:
+        child(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]), int(sys.argv[5]))
+    else:
+        main()
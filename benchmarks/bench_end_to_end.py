@@ -0,0 +1,248 @@
+"""
+Run fetch, autotag and autotag-sync end to end against local stand-ins for
+everything they talk to, and report wall time, items/sec, peak RSS and the
+requests each command made.
+
+    python benchmarks/bench_end_to_end.py [--items N] [--api-latency SECONDS]
+        [--error-rate FRACTION] [--page-latency SECONDS] [--page-bytes N]
+
+Three servers run in this process:
+
+    fake Pocket API   /v3/get, /v3/stats and /v3/send for an account of
+                      --items copies of tests/pocket.json. Every request
+                      waits --api-latency and a --error-rate fraction of
+                      them get a 503.
+    page server       /page/<item_id> with --page-bytes of HTML after
+                      --page-latency
+    classifier        serve-classifier's protocol in front of a stub model
+                      that hashes the page into a category
+
+The commands run as subprocesses with POCKET_API_URL pointing at the fake
+API and autotag using --categorize-url, so nothing touches the network and
+homepage2vec is never loaded. Pass --keep to leave the database behind.
+"""
+import argparse
+import collections
+import hashlib
+import json
+import os
+import pathlib
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+
+import sqlite_utils
+
+from pocket_to_sqlite import classifiers
+
+from bench_save_items import make_items
+
+# The fake Pocket API and the server helpers are shared with the tests
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / "tests"))
+from fake_servers import FakePocket, start_server, stop_server
+
+RUN_CLI = "from pocket_to_sqlite.cli import cli; cli()"
+CATEGORIES = ["Arts", "Business", "Computers", "Health", "News", "Science", "Sports"]
+WORDS = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do".split()
+
+
+class Requests:
+    "Request counts by path and status, shared by all the servers"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+
+    def record(self, path, status):
+        with self.lock:
+            self.counts[(path, status)] += 1
+
+    def take(self):
+        with self.lock:
+            counts, self.counts = self.counts, collections.Counter()
+        return counts
+
+
+def fake_pocket(items, requests, latency=0.0, error_rate=0.0):
+    # Nothing changes between runs, so an incremental fetch is empty
+    newest = max(int(item["time_updated"]) for item in items)
+    pocket = FakePocket(
+        items,
+        latency=latency,
+        error_rate=error_rate,
+        since=newest,
+        on_response=requests.record,
+    )
+    return start_server(pocket.handler())
+
+
+def page_server(requests, latency=0.0, size=20000):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            time.sleep(latency)
+            rng = random.Random(self.path)
+            words = rng.choices(WORDS, k=size // 6)
+            body = "<html><title>{}</title><body><p>{}</p></body></html>".format(
+                self.path, " ".join(words)
+            ).encode("utf-8")
+            requests.record("/page", 200)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return start_server(Handler)
+
+
+def stub_predict(pages):
+    predictions = []
+    for url, html in pages:
+        digest = hashlib.md5(html.encode("utf-8")).digest()
+        scores = {
+            category: digest[i] / 255 for i, category in enumerate(CATEGORIES)
+        }
+        predictions.append((scores, [b / 255 for b in digest]))
+    return predictions
+
+
+def stub_classifier(requests):
+    server = classifiers.make_server(classifiers.LocalClassifier(stub_predict), port=0)
+    handle = server.RequestHandlerClass.do_POST
+
+    def do_POST(self):
+        requests.record("/classify", 200)
+        handle(self)
+
+    server.RequestHandlerClass.do_POST = do_POST
+    server, url = start_server(server)
+    return server, url + "/"
+
+
+def account(n, pages_url):
+    items = list(make_items(n))
+    for item in items:
+        item["resolved_url"] = item["given_url"] = "{}/page/{}".format(
+            pages_url, item["item_id"]
+        )
+    return items
+
+
+def run(args, env):
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-c", RUN_CLI] + args,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        env=env,
+    )
+    output = process.stdout.read()
+    # wait4 gives the rusage of this one child rather than all children
+    _, status, rusage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    process.stdout.close()
+    if os.waitstatus_to_exitcode(status):
+        sys.stdout.write(output.decode("utf-8"))
+        raise SystemExit("{} failed".format(args[0]))
+    # ru_maxrss is kilobytes on Linux and bytes on macOS
+    max_rss_mb = rusage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    return elapsed, max_rss_mb
+
+
+def report(command, elapsed, max_rss_mb, num_items, counts):
+    print(
+        "{:<13} {:7.2f}s  {:8.1f} items/sec  {:6.1f} MB peak RSS".format(
+            command, elapsed, num_items / elapsed if elapsed else 0, max_rss_mb
+        )
+    )
+    for (path, status), count in sorted(counts.items()):
+        print("    {:<12} {}  {:>7} requests".format(path, status, count))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--items", type=int, default=2000, help="Items in the fake account")
+    parser.add_argument("--api-latency", type=float, default=0.05, help="Seconds per Pocket API request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of Pocket API requests answered with a 503")
+    parser.add_argument("--page-latency", type=float, default=0.02, help="Seconds per page download")
+    parser.add_argument("--page-bytes", type=int, default=20000, help="Size of each page")
+    parser.add_argument("--per-host", type=int, default=4, help="autotag --per-host; every page comes from the one page server")
+    parser.add_argument("--fetch-concurrency", type=int, default=4, help="fetch --concurrency")
+    parser.add_argument("--sync-concurrency", type=int, default=4, help="autotag-sync --concurrency")
+    parser.add_argument("--keep", action="store_true", help="Keep the database and metrics files")
+    options = parser.parse_args()
+
+    requests = Requests()
+    pages, pages_url = page_server(requests, options.page_latency, options.page_bytes)
+    items = account(options.items, pages_url)
+    pocket, pocket_url = fake_pocket(
+        items, requests, options.api_latency, options.error_rate
+    )
+    classifier, classifier_url = stub_classifier(requests)
+    tmp = pathlib.Path(tempfile.mkdtemp(prefix="pocket-bench-"))
+    db_path = str(tmp / "bench.db")
+    auth_path = tmp / "auth.json"
+    auth_path.write_text(
+        json.dumps({"pocket_consumer_key": "bench", "pocket_access_token": "bench"})
+    )
+    env = dict(os.environ, POCKET_API_URL=pocket_url + "/v3")
+    common = ["--auth", str(auth_path)]
+
+    print(
+        "{} items, {}s API latency, {:.0%} 503s, {}s page latency, {} CPUs".format(
+            options.items,
+            options.api_latency,
+            options.error_rate,
+            options.page_latency,
+            os.cpu_count(),
+        )
+    )
+    try:
+        commands = [
+            (
+                "fetch",
+                ["--all", "--concurrency", str(options.fetch_concurrency), "--rate", "1000"],
+                lambda db: db["items"].count,
+            ),
+            (
+                "autotag",
+                ["--silent", "--categorize-url", classifier_url, "--per-host", str(options.per_host)],
+                lambda db: db["auto_tags"].count,
+            ),
+            (
+                "autotag-sync",
+                ["--concurrency", str(options.sync_concurrency)],
+                lambda db: db["auto_tags"].count_where("synced = 1"),
+            ),
+        ]
+        for command, extra, count in commands:
+            metrics_path = str(tmp / "{}.json".format(command))
+            elapsed, max_rss_mb = run(
+                [command, db_path] + common + extra + ["--metrics-json", metrics_path],
+                env,
+            )
+            db = sqlite_utils.Database(db_path)
+            num_items = count(db)
+            db.close()
+            report(command, elapsed, max_rss_mb, num_items, requests.take())
+        if options.keep:
+            print("Database and metrics in {}".format(tmp))
+    finally:
+        for server in (pocket, pages, classifier):
+            stop_server(server)
+        if not options.keep:
+            shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Time the export command against reading the same data the way analysis
+jobs used to: SELECT * over items joined to auto_tags, JSON-decoding the
+images, scores and likely_categories columns and unpacking embeddings row
+by row into one list.
+
+    python benchmarks/bench_export.py [num_items]
+
+Parquet is skipped if pyarrow isn't installed.
+"""
+import json
+import pathlib
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from pocket_to_sqlite import embeddings, export, utils
+
+from bench_save_items import make_items
+
+
+def build(path, n):
+    db = utils.open_database(path)
+    utils.save_items(make_items(n), db)
+    utils.create_auto_tags_table(db)
+    rng = random.Random(0)
+    item_ids = [row[0] for row in db.execute("select item_id from items")]
+    for chunk in utils.chunks(item_ids, 1000):
+        rows = []
+        for item_id in chunk:
+            scores = {category: rng.random() for category in export.CATEGORIES}
+            rows.append(
+                {
+                    "item_id": item_id,
+                    "top_category": max(scores, key=scores.get),
+                    "likely_categories": json.dumps([c for c, s in scores.items() if s >= 0.5]),
+                    "scores": json.dumps(scores),
+                    "embeddings": embeddings.pack([rng.random() for _ in range(100)]),
+                    "embedding_format": "float32",
+                    "created_at": "2026-01-01T00:00:00",
+                }
+            )
+        with db.atomic():
+            db["auto_tags"].insert_all(rows)
+    return db
+
+
+def select_star(db):
+    rows = []
+    for row in db.query(
+        "select * from items left join auto_tags on auto_tags.item_id = items.item_id"
+    ):
+        for key in ("images", "scores", "likely_categories"):
+            if row.get(key):
+                row[key] = json.loads(row[key])
+        row["embeddings"] = embeddings.unpack(row["embeddings"], row["embedding_format"])
+        rows.append(row)
+    return len(rows)
+
+
+def measure(label, fn, n):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    # tracemalloc slows everything down, so memory gets a run of its own
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(
+        "{:<22} {:7.2f}s  {:>9.0f} rows/sec  {:8.1f} MB peak Python memory".format(
+            label, elapsed, n / elapsed, peak / 1024 / 1024
+        )
+    )
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = pathlib.Path(tmp)
+        db = build(str(tmp / "bench.db"), n)
+        print("{} items".format(n))
+        measure("select * + json.loads", lambda: select_star(db), n)
+        measure("export ndjson", lambda: export.export(db, str(tmp / "out.ndjson")), n)
+        try:
+            export.import_pyarrow()
+        except ValueError as ex:
+            print(ex)
+        else:
+            measure("export parquet", lambda: export.export(db, str(tmp / "out.parquet"), "parquet"), n)
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Time rebuilding a database with import from the pages fetch --archive-pages
+kept, against fetching the whole account again from a fake Pocket API.
+
+    python benchmarks/bench_import.py [--items N] [--api-latency SECONDS]
+
+Both commands run as subprocesses, like bench_end_to_end.py, into databases
+of their own; the rebuilt one is checked against the fetched one.
+"""
+import argparse
+import os
+import pathlib
+import shutil
+import tempfile
+
+import sqlite_utils
+
+from bench_end_to_end import Requests, account, fake_pocket, report, run, stop_server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--items", type=int, default=20000, help="Items in the fake account")
+    parser.add_argument("--api-latency", type=float, default=0.5, help="Seconds per Pocket API request")
+    parser.add_argument("--fetch-concurrency", type=int, default=4, help="fetch --concurrency")
+    options = parser.parse_args()
+
+    requests = Requests()
+    items = account(options.items, "https://example.com")
+    pocket, pocket_url = fake_pocket(items, requests, options.api_latency)
+    tmp = pathlib.Path(tempfile.mkdtemp(prefix="pocket-bench-"))
+    auth_path = tmp / "auth.json"
+    auth_path.write_text('{"pocket_consumer_key": "bench", "pocket_access_token": "bench"}')
+    env = dict(os.environ, POCKET_API_URL=pocket_url + "/v3")
+    print(
+        "{} items, {}s API latency, {} CPUs".format(
+            options.items, options.api_latency, os.cpu_count()
+        )
+    )
+    try:
+        fetched_path, imported_path = str(tmp / "fetched.db"), str(tmp / "imported.db")
+        elapsed, max_rss_mb = run(
+            [
+                "fetch",
+                fetched_path,
+                "--auth",
+                str(auth_path),
+                "--all",
+                "--silent",
+                "--concurrency",
+                str(options.fetch_concurrency),
+                "--rate",
+                "1000",
+                "--archive-pages",
+                str(tmp / "pages"),
+            ],
+            env,
+        )
+        report("fetch", elapsed, max_rss_mb, options.items, requests.take())
+        archived = sum(path.stat().st_size for path in (tmp / "pages").iterdir())
+        print("    {:.1f} MB of archived pages".format(archived / 1024 / 1024))
+        elapsed, max_rss_mb = run(["import", imported_path, str(tmp / "pages")], env)
+        report("import", elapsed, max_rss_mb, options.items, requests.take())
+        digests = []
+        for path in (fetched_path, imported_path):
+            db = sqlite_utils.Database(path)
+            digests.append(
+                [row[0] for row in db.execute("select digest from items order by item_id")]
+            )
+            db.close()
+        assert digests[0] == digests[1], "The imported items differ from the fetched ones"
+    finally:
+        stop_server(pocket)
+        shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Compare write throughput of utils.save_items against the previous
+one-insert-per-item approach.
+
+    python benchmarks/bench_save_items.py [num_items] [batch_size]
+
+Items are copies of tests/pocket.json with unique item_id values.
+"""
+import copy
+import json
+import pathlib
+import sys
+import tempfile
+import time
+
+import sqlite_utils
+
+from pocket_to_sqlite import utils
+
+FIXTURE = pathlib.Path(__file__).parent.parent / "tests" / "pocket.json"
+
+
+def make_items(n):
+    template = json.load(open(FIXTURE))[0]
+    base_id = int(template["item_id"])
+    for i in range(n):
+        item = copy.deepcopy(template)
+        item_id = str(base_id + i)
+        item["item_id"] = item["resolved_id"] = item_id
+        for author in item["authors"].values():
+            author["item_id"] = item_id
+        yield item
+
+
+def save_items_unbatched(items, db):
+    # The pre-batching implementation: one autocommitted insert per item
+    for item in items:
+        utils.transform(item)
+        authors = item.pop("authors", None)
+        items_authors_to_save = []
+        if authors:
+            authors_to_save = []
+            for details in authors.values():
+                authors_to_save.append(
+                    {
+                        "author_id": int(details["author_id"]),
+                        "name": details["name"],
+                        "url": details["url"],
+                    }
+                )
+                items_authors_to_save.append(
+                    {
+                        "author_id": int(details["author_id"]),
+                        "item_id": int(details["item_id"]),
+                    }
+                )
+            db["authors"].insert_all(authors_to_save, pk="author_id", replace=True)
+        db["items"].insert(item, pk="item_id", alter=True, replace=True)
+        if items_authors_to_save:
+            db["items_authors"].insert_all(
+                items_authors_to_save,
+                pk=("author_id", "item_id"),
+                foreign_keys=("author_id", "item_id"),
+                replace=True,
+            )
+
+
+def run(label, save, n):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = sqlite_utils.Database(str(pathlib.Path(tmp) / "bench.db"))
+        items = list(make_items(n))
+        start = time.perf_counter()
+        save(items, db)
+        elapsed = time.perf_counter() - start
+        assert db["items"].count == n
+        db.close()
+    print("{:<10} {:>8} items in {:7.2f}s  {:>10.0f} items/sec".format(
+        label, n, elapsed, n / elapsed
+    ))
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    run("before", save_items_unbatched, n)
+    run("after", lambda items, db: utils.save_items(items, db, batch_size), n)
+
+
+if __name__ == "__main__":
+    main()
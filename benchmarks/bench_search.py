@@ -0,0 +1,87 @@
+"""
+Time a second full fetch into an FTS-indexed database with the FTS
+triggers on versus search.bulk_load, then query latency of search.search.
+
+    python benchmarks/bench_search.py [num_items]
+
+Items get random titles and excerpts drawn from a fixed vocabulary, so
+common words match many rows and rare ones few.
+"""
+import pathlib
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+import sqlite_utils
+
+from pocket_to_sqlite import search, utils
+
+VOCABULARY = ["word{}".format(i) for i in range(5000)]
+CATEGORIES = ["Arts", "Business", "Computers", "Health", "News", "Science"]
+
+
+def make_items(n, rng):
+    for item_id in range(1, n + 1):
+        yield {
+            "item_id": item_id,
+            "resolved_id": item_id,
+            "resolved_url": "https://example.com/{}".format(item_id),
+            "resolved_title": " ".join(rng.choices(VOCABULARY[:500], k=8)),
+            "excerpt": " ".join(rng.choices(VOCABULARY, k=40)),
+            "status": rng.choice([0, 0, 0, 1]),
+        }
+
+
+def timed(label, fn):
+    start = time.perf_counter()
+    result = fn()
+    print("{:<36} {:8.3f}s".format(label, time.perf_counter() - start))
+    return result
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    with tempfile.TemporaryDirectory() as tmp:
+        db = sqlite_utils.Database(str(pathlib.Path(tmp) / "search.db"))
+        timed("initial load", lambda: utils.save_items(make_items(n, random.Random(0)), db))
+        timed("enable FTS", lambda: utils.ensure_fts(db))
+        db["auto_tags"].insert_all(
+            ({"item_id": i, "top_category": CATEGORIES[i % len(CATEGORIES)]} for i in range(1, n + 1)),
+            pk="item_id",
+        )
+        timed(
+            "refetch, FTS triggers",
+            lambda: utils.save_items(make_items(n, random.Random(1)), db),
+        )
+
+        def refetch_bulk():
+            with search.bulk_load(db):
+                utils.save_items(make_items(n, random.Random(2)), db)
+
+        timed("refetch, bulk_load + rebuild", refetch_bulk)
+
+        print("\n{} items, median of 20 runs:".format(n))
+        for label, kwargs in (
+            ("common word", {"q": "word1"}),
+            ("rare word", {"q": "word4999"}),
+            ("two words", {"q": "word1 word2"}),
+            ("prefix", {"q": "word12*"}),
+            ("common word, category", {"q": "word1", "category": "Arts"}),
+            ("common word, unread", {"q": "word1", "status": "unread"}),
+        ):
+            times = []
+            for _ in range(20):
+                start = time.perf_counter()
+                results = search.search(db, **kwargs)
+                times.append(time.perf_counter() - start)
+            print(
+                "{:<28} {:8.2f}ms  {} results".format(
+                    label, statistics.median(times) * 1000, len(results)
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
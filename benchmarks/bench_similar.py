@@ -0,0 +1,70 @@
+"""
+Time building, reloading and querying the embedding index.
+
+    python benchmarks/bench_similar.py [num_items] [format]
+
+Creates auto_tags rows with random 100-dimensional embeddings stored as
+packed BLOBs, then compares against the JSON text encoding they replace.
+"""
+import json
+import pathlib
+import random
+import sys
+import tempfile
+import time
+
+import sqlite_utils
+
+from pocket_to_sqlite import embeddings
+
+DIMENSIONS = 100
+
+
+def timed(label, fn):
+    start = time.perf_counter()
+    result = fn()
+    print("{:<28} {:8.3f}s".format(label, time.perf_counter() - start))
+    return result
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    fmt = sys.argv[2] if len(sys.argv) > 2 else "float32"
+    rng = random.Random(0)
+    vectors = [[rng.gauss(0, 1) for _ in range(DIMENSIONS)] for _ in range(n)]
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, encode in (
+            ("json", json.dumps),
+            (fmt, lambda v: embeddings.pack(v, fmt)),
+        ):
+            db_path = str(pathlib.Path(tmp) / "{}.db".format(label))
+            db = sqlite_utils.Database(db_path)
+            db["auto_tags"].insert_all(
+                (
+                    {
+                        "item_id": i,
+                        "embeddings": encode(v),
+                        "embedding_format": None if label == "json" else fmt,
+                    }
+                    for i, v in enumerate(vectors)
+                ),
+                pk="item_id",
+            )
+            size = db.execute(
+                "select sum(length(embeddings)) from auto_tags"
+            ).fetchone()[0]
+            print("\n{}: {} items, {:,} bytes of embeddings".format(label, n, size))
+            timed("build index", lambda: embeddings.EmbeddingIndex(db, db_path).load())
+            index = timed(
+                "load cached (mmap)", lambda: embeddings.EmbeddingIndex(db, db_path).load()
+            )
+            timed("first query, k=10", lambda: index.similar(0, k=10))
+            start = time.perf_counter()
+            for item_id in range(1, 101):
+                index.similar(item_id, k=10)
+            print("{:<28} {:8.3f}s".format("mean of 100 queries", (time.perf_counter() - start) / 100))
+            db.close()
+
+
+if __name__ == "__main__":
+    main()
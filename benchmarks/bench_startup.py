@@ -0,0 +1,60 @@
+"""
+Measure CLI startup cost: wall time and peak RSS for each subcommand's
+--help, plus the slowest imports reported by python -X importtime.
+
+    python benchmarks/bench_startup.py
+
+None of these subcommands should import homepage2vec, torch, httpx or numpy
+(sqlite_utils brings numpy in by itself whenever it is installed).
+"""
+import os
+import subprocess
+import sys
+import time
+
+SUBCOMMANDS = ["auth", "fetch", "autotag", "autotag-sync"]
+RUN_CLI = "from pocket_to_sqlite.cli import cli; cli()"
+
+
+def run(args):
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+    )
+    # Drain stderr first: -X importtime can write more than the pipe holds,
+    # and the child would block on it while we wait for it to exit
+    stderr = process.stderr.read().decode("utf-8")
+    process.stderr.close()
+    # wait4 gives the rusage of this one child rather than all children
+    _, status, rusage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    # ru_maxrss is kilobytes on Linux and bytes on macOS
+    max_rss_mb = rusage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    return elapsed, max_rss_mb, stderr
+
+
+def slowest_imports(stderr, n=10):
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        if cumulative.strip().isdigit():
+            rows.append((int(cumulative), name.rstrip()))
+    return sorted(rows, reverse=True)[:n]
+
+
+def main():
+    for subcommand in SUBCOMMANDS:
+        elapsed, max_rss_mb, _ = run(
+            [sys.executable, "-c", RUN_CLI, subcommand, "--help"]
+        )
+        print("{:<14} {:6.2f}s  {:7.1f} MB peak RSS".format(subcommand, elapsed, max_rss_mb))
+    _, _, stderr = run([sys.executable, "-X", "importtime", "-c", "import pocket_to_sqlite.cli"])
+    print("\nSlowest imports (cumulative microseconds):")
+    for cumulative, name in slowest_imports(stderr):
+        print("{:>10} {}".format(cumulative, name))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Time the aggregate canned queries against the summary tables that replace
+them, and what keeping the summaries up to date costs save_items.
+
+    python benchmarks/bench_summaries.py [num_items]
+
+Each query is run 20 times, as if that many page views hit Datasette.
+"""
+import random
+import sys
+import tempfile
+import time
+
+from pocket_to_sqlite import summaries, utils
+
+from bench_save_items import make_items
+
+VIEWS = 20
+AGGREGATES = (
+    (
+        "per category",
+        "select count(*) c, top_category from auto_tags where error is null "
+        "group by top_category order by c desc",
+        "select items c, top_category from summary_categories order by c desc",
+    ),
+    (
+        "per month",
+        "select strftime('%Y-%m', time_added, 'unixepoch') month, count(*) items "
+        "from items where status != 2 group by month order by month desc",
+        "select month, items from summary_months order by month desc",
+    ),
+    (
+        "per status",
+        "select status, count(*) items from items group by status",
+        "select status, items from summary_statuses",
+    ),
+    (
+        "per domain",
+        "select {} domain, count(*) items from items where status != 2 "
+        "group by domain order by items desc limit 100".format(
+            summaries.domain_sql("items.resolved_url")
+        ),
+        "select domain, items from summary_domains order by items desc limit 100",
+    ),
+)
+
+
+def account(n):
+    rng = random.Random(0)
+    items = list(make_items(n))
+    for i, item in enumerate(items):
+        item["resolved_url"] = "https://www.site{}.example/{}".format(rng.randrange(2000), i)
+        item["time_added"] = str(1400000000 + rng.randrange(300000000))
+        # The first item creates the table, so it mustn't be a deletion
+        item["status"] = str(rng.choice((0, 0, 1, 2)) if i else 0)
+    return items
+
+
+def time_save(path, items, with_summaries):
+    db = utils.open_database(path)
+    utils.save_items(items[:1], db)
+    utils.ensure_fts(db)
+    if with_summaries:
+        summaries.ensure_summaries(db)
+    start = time.perf_counter()
+    utils.save_items(items[1:], db)
+    return db, time.perf_counter() - start
+
+
+def time_query(db, sql):
+    start = time.perf_counter()
+    for _ in range(VIEWS):
+        db.execute(sql).fetchall()
+    return (time.perf_counter() - start) / VIEWS * 1000
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    with tempfile.TemporaryDirectory() as tmp:
+        items = account(n)
+        db, plain = time_save(tmp + "/plain.db", [dict(item) for item in items], False)
+        db.close()
+        db, maintained = time_save(tmp + "/summaries.db", items, True)
+        print("{} items".format(n))
+        print("save_items           {:7.2f}s without summaries, {:7.2f}s maintaining them".format(plain, maintained))
+        utils.create_auto_tags_table(db)
+        rng = random.Random(1)
+        rows = [
+            {"item_id": row[0], "top_category": rng.choice(["Arts", "News", "Science"])}
+            if rng.random() < 0.9
+            else {"item_id": row[0], "error": "Timeout"}
+            for row in db.execute("select item_id from items")
+        ]
+        start = time.perf_counter()
+        with db.atomic():
+            db["auto_tags"].insert_all(rows)
+        print("auto_tags insert     {:7.2f}s maintaining summaries".format(time.perf_counter() - start))
+        utils.ensure_indexes(db)
+        start = time.perf_counter()
+        summaries.rebuild_summaries(db)
+        print("rebuild-summaries    {:7.2f}s".format(time.perf_counter() - start))
+        for label, aggregate, summary in AGGREGATES:
+            print(
+                "{:<20} {:8.2f}ms aggregating, {:8.3f}ms from the summary table".format(
+                    label, time_query(db, aggregate), time_query(db, summary)
+                )
+            )
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
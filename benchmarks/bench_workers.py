@@ -0,0 +1,102 @@
+"""
+Throughput of local classification with 1, 2, 4 and 8 worker processes.
+
+    python benchmarks/bench_workers.py [num_pages] [--model]
+
+By default each page goes through a CPU-bound stand-in for homepage2vec:
+HTML parsing and hashed bag-of-words features in pure Python, which holds
+the GIL the way homepage2vec's feature extraction does. --model uses the
+real model instead (it is downloaded on first use).
+
+Batches go through ProcessPoolClassifier with one batch per worker in
+flight, the same arrangement `autotag --workers N` uses.
+"""
+import html.parser
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pocket_to_sqlite import classifiers, utils
+
+BATCH_SIZE = 16
+FEATURES = 4096
+
+
+class Tokens(html.parser.HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.words = []
+
+    def handle_data(self, data):
+        self.words.extend(data.lower().split())
+
+
+def stand_in_predict(pages):
+    predictions = []
+    for url, page in pages:
+        parser = Tokens()
+        parser.feed(page)
+        vector = [0.0] * FEATURES
+        for word in parser.words:
+            for seed in range(8):
+                vector[hash((seed, word)) % FEATURES] += 1.0
+        total = sum(vector) or 1.0
+        predictions.append(({"Arts": vector[0] / total}, vector[:100]))
+    return predictions
+
+
+def make_pages(n):
+    rng = random.Random(0)
+    words = ["word{}".format(i) for i in range(2000)]
+    return [
+        (
+            "https://example.com/{}".format(i),
+            "<html><body>{}</body></html>".format(
+                "".join("<p>{}</p>".format(" ".join(rng.choices(words, k=50))) for _ in range(40))
+            ),
+        )
+        for i in range(n)
+    ]
+
+
+def run(pages, workers, predict, load_model):
+    if workers == 1:
+        classifier = classifiers.LocalClassifier(predict)
+    else:
+        classifier = classifiers.ProcessPoolClassifier(
+            workers, predict=predict, load_model=load_model, split=False
+        )
+    batches = [pages[i : i + BATCH_SIZE] for i in range(0, len(pages), BATCH_SIZE)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for _ in executor.map(classifier.predict, batches):
+            pass
+    elapsed = time.perf_counter() - start
+    classifier.close()
+    return elapsed
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    n = int(args[0]) if args else 800
+    if "--model" in sys.argv:
+        predict, load_model = utils.predict_batch, utils.get_model
+    else:
+        predict, load_model = stand_in_predict, None
+    pages = make_pages(n)
+    print("{} pages, {} CPUs".format(n, os.cpu_count()))
+    baseline = None
+    for workers in (1, 2, 4, 8):
+        elapsed = run(pages, workers, predict, load_model)
+        baseline = baseline or elapsed
+        print(
+            "{} workers: {:7.2f}s  {:8.1f} pages/sec  {:5.2f}x".format(
+                workers, elapsed, n / elapsed, baseline / elapsed
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,314 @@
+"""
+Loading items without the Pocket API: from raw /v3/get responses kept by
+fetch --archive-pages, or from the HTML and CSV files Pocket's own export
+produces.
+
+Every source is read incrementally, so a multi-gigabyte archive is never
+held in memory, and the items go straight into utils.save_items.
+"""
+import csv
+import gzip
+import hashlib
+import html.parser
+import io
+import json
+import os
+import pathlib
+import time
+
+READ_SIZE = 64 * 1024
+# The status column Pocket uses for each section or value of its exports
+EXPORT_STATUSES = {"unread": 0, "read archive": 1, "archive": 1}
+
+
+class PageArchive:
+    """
+    Writes each raw /v3/get response body gzipped to its own file, named so
+    that sorting the names replays runs in order, and pages in offset order
+    within a run.
+    """
+
+    def __init__(self, directory):
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.run = time.strftime("%Y%m%dT%H%M%S")
+
+    def save(self, offset, content):
+        path = self.directory / "{}-{:09d}.json.gz".format(self.run, offset)
+        tmp_path = path.with_name(path.name + ".tmp")
+        with gzip.open(tmp_path, "wb", compresslevel=6) as fp:
+            fp.write(content)
+        os.replace(tmp_path, path)
+
+
+class Reader:
+    "Just enough of a pull parser to walk a JSON object without loading it"
+
+    decoder = json.JSONDecoder()
+
+    def __init__(self, fp, read_size=READ_SIZE):
+        self.fp = fp
+        self.read_size = read_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        chunk = self.fp.read(self.read_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        "The next character that isn't whitespace, or "" at the end"
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ""
+
+    def expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError(
+                "Expected one of {!r} but found {!r}".format(chars, char or "end of file")
+            )
+        self.pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                # Most likely the value runs on into the next chunk
+                if self.fill():
+                    continue
+                raise
+            # So might a number that ends exactly where the buffer does
+            if end == len(self.buffer) and self.fill():
+                continue
+            self.pos = end
+            return value
+
+
+class StreamingPage:
+    """
+    One /v3/get response. Iterating yields the entries of its "list" one at
+    a time; since is set once the page has been read through.
+    """
+
+    def __init__(self, fp, read_size=READ_SIZE):
+        self.reader = Reader(fp, read_size)
+        self.since = None
+
+    def __iter__(self):
+        reader = self.reader
+        reader.expect("{")
+        if reader.peek() == "}":
+            return
+        while True:
+            key = reader.value()
+            reader.expect(":")
+            if key == "list" and reader.peek() == "{":
+                reader.expect("{")
+                if reader.peek() == "}":
+                    reader.expect("}")
+                else:
+                    while True:
+                        reader.value()
+                        reader.expect(":")
+                        yield reader.value()
+                        if reader.expect(",}") == "}":
+                            break
+            else:
+                value = reader.value()
+                if key == "since":
+                    self.since = value
+                elif key == "error" and value:
+                    raise ValueError("Archived page has an error: {}".format(value))
+            if reader.expect(",}") == "}":
+                return
+
+
+def export_item_id(url):
+    """
+    Pocket's exports don't include item IDs, so items new to the database
+    get a stable negative one derived from the URL, which can't collide
+    with a real ID.
+    """
+    return -int(hashlib.sha1(url.encode("utf-8")).hexdigest()[:15], 16)
+
+
+def export_item(url, title, time_added, tags, status):
+    item_id = export_item_id(url)
+    return {
+        "item_id": item_id,
+        "resolved_id": item_id,
+        "given_url": url,
+        "resolved_url": url,
+        "given_title": title,
+        "resolved_title": title,
+        "time_added": int(time_added or 0),
+        "time_updated": int(time_added or 0),
+        "status": status,
+        "tags": {tag: {"item_id": str(item_id), "tag": tag} for tag in tags} or None,
+    }
+
+
+class ExportParser(html.parser.HTMLParser):
+    """
+    Pocket's ril_export.html: an <h1> per section (Unread, Read Archive)
+    followed by a list of <a href time_added tags> links.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.status = 0
+        self.in_heading = False
+        self.link = None
+        self.items = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "h1":
+            self.in_heading = True
+        elif tag == "a":
+            self.link = dict(attrs)
+            self.link["title"] = ""
+
+    def handle_endtag(self, tag):
+        if tag == "h1":
+            self.in_heading = False
+        elif tag == "a" and self.link:
+            link, self.link = self.link, None
+            if link.get("href"):
+                tags = [tag for tag in (link.get("tags") or "").split(",") if tag]
+                self.items.append(
+                    export_item(
+                        link["href"],
+                        link["title"].strip() or None,
+                        link.get("time_added"),
+                        tags,
+                        self.status,
+                    )
+                )
+
+    def handle_data(self, data):
+        if self.in_heading:
+            self.status = EXPORT_STATUSES.get(data.strip().lower(), self.status)
+        elif self.link is not None:
+            self.link["title"] += data
+
+
+def iter_html_export(fp):
+    parser = ExportParser()
+    while True:
+        chunk = fp.read(READ_SIZE)
+        if not chunk:
+            break
+        parser.feed(chunk)
+        yield from parser.items
+        parser.items.clear()
+    parser.close()
+    yield from parser.items
+
+
+def iter_csv_export(fp):
+    "The newer CSV export: title, url, time_added, tags (| separated), status"
+    for row in csv.DictReader(fp):
+        if not row.get("url"):
+            continue
+        yield export_item(
+            row["url"],
+            row.get("title") or None,
+            row.get("time_added"),
+            [tag for tag in (row.get("tags") or "").split("|") if tag],
+            EXPORT_STATUSES.get((row.get("status") or "").lower(), 0),
+        )
+
+
+def open_text(path):
+    if path.name.endswith(".gz"):
+        return io.TextIOWrapper(gzip.open(path, "rb"), encoding="utf-8")
+    return open(path, encoding="utf-8", newline="")
+
+
+def source_files(paths):
+    "Expand directories into the archived pages inside them, in replay order"
+    for path in map(pathlib.Path, paths):
+        if path.is_dir():
+            yield from sorted(
+                child
+                for child in path.iterdir()
+                if child.name.endswith((".json", ".json.gz"))
+            )
+        else:
+            yield path
+
+
+class Importer:
+    """
+    Yields items from every source in turn, skipping those that haven't
+    changed since since unless it is None; deletions and records without a
+    timestamp always come through. Afterwards since is the newest since
+    seen in an archived API page, if that moved it forward.
+
+    Export files carry much less than the API, so their links are skipped
+    if the URL is in known_urls or an archived page imported earlier in the
+    same run, typically because it was fetched already.
+    """
+
+    def __init__(self, paths, since=None, known_urls=None):
+        self.paths = list(paths)
+        self.since = since
+        self.known_urls = known_urls or set()
+        self.files = 0
+
+    @staticmethod
+    def changed(item, field, since):
+        # Deletions can come as bare {"item_id", "status"} records, with no
+        # timestamp to go by
+        if not item.get(field) or str(item.get("status")) == "2":
+            return True
+        return int(item[field]) > since
+
+    def unknown(self, items):
+        return (item for item in items if item["given_url"] not in self.known_urls)
+
+    def __iter__(self):
+        since = self.since
+        for path in source_files(self.paths):
+            name = path.name.lower()
+            self.files += 1
+            with open_text(path) as fp:
+                if name.endswith((".json", ".json.gz")):
+                    page = StreamingPage(fp)
+                    items = page
+                    changed = "time_updated"
+                elif name.endswith((".html", ".htm")):
+                    page = None
+                    items = self.unknown(iter_html_export(fp))
+                    changed = "time_added"
+                elif name.endswith(".csv"):
+                    page = None
+                    items = self.unknown(iter_csv_export(fp))
+                    changed = "time_added"
+                else:
+                    raise ValueError(
+                        "Don't know how to import {}: expected archived pages "
+                        "(.json, .json.gz), or an .html or .csv export".format(path)
+                    )
+                for item in items:
+                    if page is not None:
+                        # So an export imported alongside doesn't duplicate it
+                        self.known_urls.add(item.get("given_url"))
+                    if since is None or self.changed(item, changed, since):
+                        yield item
+                if page is not None and page.since and page.since > (self.since or 0):
+                    self.since = page.since
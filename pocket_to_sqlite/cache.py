@@ -0,0 +1,226 @@
+"""
+Persistent caches kept in the same SQLite database as the items, shared by
+the worker threads in cli.autotag.
+"""
+import json
+import sqlite3
+import threading
+import time
+from . import metrics
+
+
+def thread_safe_connection(db):
+    """
+    Open a second connection to the file behind db that can be used from any
+    thread. In-memory databases can't be reopened, so they get db.conn back
+    and must stay on the thread that created it.
+    """
+    path = db.execute("pragma database_list").fetchone()[2]
+    if not path:
+        return db.conn
+    conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+    # synchronous is per connection, so match whatever profile db was opened with
+    conn.execute(
+        "pragma synchronous = {}".format(db.execute("pragma synchronous").fetchone()[0])
+    )
+    return conn
+
+
+def model_version(categorize_url=None):
+    "Identifies the model behind a classification, so upgrades miss the cache"
+    if categorize_url:
+        return "remote:{}".format(categorize_url)
+    try:
+        from importlib.metadata import version
+
+        return "homepage2vec-{}".format(version("homepage2vec"))
+    except Exception:
+        return "homepage2vec"
+
+
+class ClassificationCache:
+    """
+    Scores and embeddings keyed on (html_md5, model_version), so identical
+    page content is never classified twice by the same model.
+    """
+
+    table = "classification_cache"
+
+    def __init__(
+        self, db, version, max_entries=None, max_age_days=None, threaded=False
+    ):
+        self.version = version
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS [{}] (
+                [html_md5] TEXT,
+                [model_version] TEXT,
+                [scores] TEXT,
+                [embeddings] TEXT,
+                [created_at] FLOAT,
+                [last_used] FLOAT,
+                PRIMARY KEY ([html_md5], [model_version])
+            )""".format(self.table)
+        )
+        db.conn.commit()
+        # A second connection lets worker threads use the cache, but it can't
+        # write while the caller holds a read cursor open on db.conn
+        self.conn = thread_safe_connection(db) if threaded else db.conn
+
+    def get(self, html_md5):
+        "Returns (scores, embeddings) or None"
+        with self.lock:
+            row = self.conn.execute(
+                "select scores, embeddings from [{}] "
+                "where html_md5 = ? and model_version = ?".format(self.table),
+                (html_md5, self.version),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                metrics.inc("classification_cache_misses")
+                return None
+            self.hits += 1
+            metrics.inc("classification_cache_hits")
+            with self.conn:
+                self.conn.execute(
+                    "update [{}] set last_used = ? "
+                    "where html_md5 = ? and model_version = ?".format(self.table),
+                    (time.time(), html_md5, self.version),
+                )
+        return json.loads(row[0]), json.loads(row[1])
+
+    def put(self, html_md5, scores, embeddings):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "insert or replace into [{}] "
+                "(html_md5, model_version, scores, embeddings, created_at, last_used) "
+                "values (?, ?, ?, ?, ?, ?)".format(self.table),
+                (
+                    html_md5,
+                    self.version,
+                    json.dumps(scores),
+                    json.dumps(embeddings),
+                    now,
+                    now,
+                ),
+            )
+
+    def evict(self):
+        "Drop entries older than max_age_days, then the least recently used past max_entries"
+        with self.lock, self.conn:
+            evicted = 0
+            if self.max_age_days is not None:
+                evicted += self.conn.execute(
+                    "delete from [{}] where created_at < ?".format(self.table),
+                    (time.time() - self.max_age_days * 24 * 60 * 60,),
+                ).rowcount
+            if self.max_entries is not None:
+                evicted += self.conn.execute(
+                    "delete from [{table}] where rowid in ("
+                    "select rowid from [{table}] order by last_used desc "
+                    "limit -1 offset ?)".format(table=self.table),
+                    (self.max_entries,),
+                ).rowcount
+        return evicted
+
+    def summary(self):
+        return "Classification cache: {} hits, {} misses".format(self.hits, self.misses)
+
+
+class PageValidators:
+    """
+    ETag, Last-Modified and final URL of every downloaded page, so that a
+    re-fetch can be a conditional request. A 304 reuses the HTML already
+    stored in the HtmlStore for the recorded html_md5.
+
+    Lookups can happen on worker threads; writes are queued and only hit the
+    database when the owning thread calls flush().
+    """
+
+    table = "page_validators"
+
+    def __init__(self, db, html_store=None):
+        self.db = db
+        self.html_store = html_store
+        db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS [{}] (
+                [url] TEXT PRIMARY KEY,
+                [final_url] TEXT,
+                [etag] TEXT,
+                [last_modified] TEXT,
+                [html_md5] TEXT,
+                [size] INTEGER,
+                [fetched_at] FLOAT
+            )""".format(self.table)
+        )
+        db.conn.commit()
+        self.conn = thread_safe_connection(db)
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.not_modified = 0
+        self.bytes_saved = 0
+
+    def get(self, url):
+        with self.lock:
+            if url in self.pending:
+                return dict(self.pending[url])
+            cursor = self.conn.execute(
+                "select * from [{}] where url = ?".format(self.table), (url,)
+            )
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip([c[0] for c in cursor.description], row))
+
+    def request_headers(self, validator):
+        headers = {}
+        if validator.get("etag"):
+            headers["If-None-Match"] = validator["etag"]
+        if validator.get("last_modified"):
+            headers["If-Modified-Since"] = validator["last_modified"]
+        return headers
+
+    def stored_html(self, html_md5):
+        if self.html_store is None:
+            return None
+        return self.html_store.get(html_md5)
+
+    def record(self, url, response, html_md5, size):
+        with self.lock:
+            self.pending[url] = {
+                "url": url,
+                "final_url": str(response.url),
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "html_md5": html_md5,
+                "size": size,
+                "fetched_at": time.time(),
+            }
+
+    def record_not_modified(self, validator):
+        with self.lock:
+            self.not_modified += 1
+            self.bytes_saved += validator["size"] or 0
+        metrics.inc("pages_not_modified")
+        metrics.inc("page_bytes_not_downloaded", validator["size"] or 0)
+
+    def flush(self, min_pending=1):
+        with self.lock:
+            if len(self.pending) < min_pending:
+                return
+            pending = list(self.pending.values())
+            self.pending = {}
+        if pending:
+            self.db[self.table].insert_all(pending, pk="url", replace=True)
+
+    def summary(self):
+        return "Conditional requests: {} not modified, {:,} bytes not downloaded".format(
+            self.not_modified, self.bytes_saved
+        )
@@ -0,0 +1,225 @@
+"""
+Classifier backends for autotag. Each has a predict(pages) method taking a
+list of (url, html) pairs and returning a (scores, embeddings) pair per
+page, in order, and a version used to key the ClassificationCache.
+
+    LocalClassifier          homepage2vec in this process
+    ProcessPoolClassifier    homepage2vec in a pool of worker processes
+    RemoteClassifier         POST batches to serve-classifier, or any server
+                             speaking the same JSON
+
+serve-classifier puts a ProcessPoolClassifier behind a small HTTP server.
+"""
+import concurrent.futures
+import json
+import math
+import multiprocessing
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from . import cache, http_client, utils
+
+
+class LocalClassifier:
+    def __init__(self, predict=utils.predict_batch):
+        self.predict = predict
+        self.version = cache.model_version()
+
+    def close(self):
+        pass
+
+
+def init_worker(load_model=utils.get_model):
+    "Runs once in each worker process"
+    if load_model is None:
+        return
+    try:
+        import torch
+
+        # The pool is the parallelism, so stop each worker's torch from
+        # starting a thread per core on top
+        torch.set_num_threads(1)
+    except ImportError:
+        pass
+    load_model()
+
+
+class ProcessPoolClassifier:
+    """
+    Runs predict in worker processes. Each process loads the model once;
+    with share_model the parent loads it before the pool forks, so on Linux
+    the workers share the weights copy-on-write instead of each reading
+    their own copy.
+
+    With split, every batch is spread across all workers, which keeps
+    latency down for a server answering one request at a time. Without it
+    each batch goes to a single worker and callers keep one batch per worker
+    in flight, as categorize_items does with concurrency=workers.
+    """
+
+    def __init__(
+        self,
+        workers=None,
+        predict=utils.predict_batch,
+        load_model=utils.get_model,
+        split=True,
+        share_model=True,
+    ):
+        self.workers = workers or os.cpu_count() or 1
+        self.predict_pages = predict
+        self.split = split
+        self.version = cache.model_version()
+        context = None
+        if share_model and "fork" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("fork")
+            if load_model:
+                load_model()
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=context,
+            initializer=init_worker,
+            initargs=(load_model,),
+        )
+        # Start the workers now, before autotag's download threads exist,
+        # rather than forking from a busy process on the first batch
+        self.pool.submit(int).result()
+
+    def predict(self, pages):
+        if not self.split:
+            return self.pool.submit(self.predict_pages, pages).result()
+        size = math.ceil(len(pages) / self.workers) or 1
+        chunks = [pages[i : i + size] for i in range(0, len(pages), size)]
+        predictions = []
+        for chunk_predictions in self.pool.map(self.predict_pages, chunks):
+            predictions.extend(chunk_predictions)
+        return predictions
+
+    def close(self):
+        self.pool.shutdown()
+
+
+class RemoteClassifier:
+    """
+    Sends {"pages": [{"url", "html"}, ...]} and expects
+    {"results": [{"scores", "embeddings"}, ...]} back. Servers that only take
+    one {"url", "html"} document per request, like the original homepage2vec
+    server, are detected by their answer to the first batch (a 4xx, or a
+    2xx without results) and sent one page at a time.
+    """
+
+    def __init__(self, url, token=None):
+        self.url = url
+        self.token = token
+        self.version = cache.model_version(url)
+        self.batched = None
+
+    def post(self, body):
+        headers = {"accept": "application/json"}
+        if self.token:
+            headers["Authorization"] = "Bearer {}".format(self.token)
+        return http_client.get_session().post(self.url, headers=headers, json=body)
+
+    def check(self, response):
+        if not 200 <= response.status_code < 300:
+            raise ValueError(
+                "Status {} {}".format(response.status_code, response.text[:200])
+            )
+        return response.json()
+
+    def batch_refused(self, response):
+        "Whether the response to a first batch says the server takes one document at a time"
+        if 400 <= response.status_code < 500:
+            return True
+        if 200 <= response.status_code < 300:
+            try:
+                return "results" not in response.json()
+            except ValueError:
+                return True
+        # A 5xx may only mean the server is busy, so it doesn't settle anything
+        return False
+
+    def predict(self, pages):
+        if self.batched is not False:
+            response = self.post(
+                {"pages": [{"url": url, "html": html} for url, html in pages]}
+            )
+            if self.batched or not self.batch_refused(response):
+                results = self.check(response)["results"]
+                if len(results) != len(pages):
+                    raise ValueError(
+                        "Expected {} results, got {}".format(len(pages), len(results))
+                    )
+                self.batched = True
+                return [(r["scores"], r["embeddings"]) for r in results]
+        # Retry a refused first batch one page at a time before giving up
+        predictions = []
+        for url, html in pages:
+            result = self.check(self.post({"url": url, "html": html}))
+            predictions.append((result["scores"], result["embeddings"]))
+        self.batched = False
+        return predictions
+
+    def close(self):
+        pass
+
+
+def get_classifier(categorize_url=None, token=None, workers=None):
+    if categorize_url:
+        return RemoteClassifier(categorize_url, token=token)
+    if workers and workers > 1:
+        return ProcessPoolClassifier(workers, split=False)
+    return LocalClassifier()
+
+
+def make_server(classifier, host="127.0.0.1", port=8000, token=None, max_pages=256):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def send_json(self, status, body):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            self.send_json(200, {"ok": True, "version": classifier.version})
+
+        def do_POST(self):
+            # Read the body even when refusing it, or on a kept-alive
+            # connection it would be taken for the next request
+            data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if token and self.headers.get("Authorization") != "Bearer {}".format(token):
+                self.send_json(401, {"error": "Invalid token"})
+                return
+            try:
+                body = json.loads(data)
+                batched = "pages" in body
+                pages = [
+                    (page["url"], page["html"])
+                    for page in (body["pages"] if batched else [body])
+                ]
+            except (KeyError, TypeError, ValueError) as ex:
+                self.send_json(400, {"error": "Expected url and html: {}".format(ex)})
+                return
+            if len(pages) > max_pages:
+                self.send_json(413, {"error": "At most {} pages per request".format(max_pages)})
+                return
+            try:
+                predictions = classifier.predict(pages)
+            except Exception as ex:
+                self.send_json(500, {"error": str(ex)})
+                return
+            results = [
+                {"scores": scores, "embeddings": embeddings}
+                for scores, embeddings in predictions
+            ]
+            self.send_json(200, {"results": results} if batched else results[0])
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    return server
+
@@ -1,17 +1,74 @@
-from concurrent.futures import ThreadPoolExecutor
-from itertools import repeat
 import time
 import click
+import contextlib
+import cProfile
+import functools
+import pstats
+import sqlite3
+import sys
 import json
 import urllib.parse
 import pathlib
-import requests
-import sqlite_utils
-from . import utils
+from . import archive, cache, classifiers, downloader, embeddings, export, html_store, http_client, ledger, metrics, search, summaries, utils
 
 CONSUMER_KEY = "104708-da187ce0e7f8646d64a06a8"
 
 
+db_profile_option = click.option(
+    "--db-profile",
+    type=click.Choice(list(utils.DB_PROFILES)),
+    default="fast",
+    help="SQLite pragmas to use: fast (WAL, synchronous=NORMAL, bigger cache) or safe (WAL, synchronous=FULL)",
+)
+
+
+def instrumented(command):
+    """
+    Adds --metrics-json, --metrics-textfile and --profile to a command. The
+    report is written even if the command fails part way through.
+    """
+
+    def decorator(fn):
+        @click.option(
+            "--metrics-json",
+            type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
+            help="Write counters and timing histograms for this run to a JSON file",
+        )
+        @click.option(
+            "--metrics-textfile",
+            type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
+            help="Write the same metrics in Prometheus text format, for node_exporter's textfile collector",
+        )
+        @click.option(
+            "--profile",
+            type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
+            help="Run under cProfile, save the stats to this file and show the top functions",
+        )
+        @functools.wraps(fn)
+        def wrapper(*args, metrics_json, metrics_textfile, profile, **kwargs):
+            metrics.reset()
+            profiler = cProfile.Profile() if profile else None
+            try:
+                if profiler:
+                    profiler.enable()
+                return fn(*args, **kwargs)
+            finally:
+                if profiler:
+                    profiler.disable()
+                    profiler.dump_stats(profile)
+                    pstats.Stats(profiler, stream=sys.stderr).sort_stats(
+                        "cumulative"
+                    ).print_stats(15)
+                if metrics_json:
+                    metrics.write_json(metrics_json, command)
+                if metrics_textfile:
+                    metrics.write_prometheus(metrics_textfile, command)
+
+        return wrapper
+
+    return decorator
+
+
 @click.group()
 @click.version_option()
 def cli():
@@ -28,7 +85,8 @@ def cli():
 )
 def auth(auth):
     "Save authentication credentials to a JSON file"
-    response = requests.post(
+    session = http_client.get_session()
+    response = session.post(
         "https://getpocket.com/v3/oauth/request",
         {
             "consumer_key": CONSUMER_KEY,
@@ -44,7 +102,7 @@ def auth(auth):
     )
     input("Once you have signed in there, hit <enter> to continue")
     # Now exchange the request_token for an access_token
-    response2 = requests.post(
+    response2 = session.post(
         "https://getpocket.com/v3/oauth/authorize",
         {"consumer_key": CONSUMER_KEY, "code": request_token},
     )
@@ -83,73 +141,237 @@ def auth(auth):
 )
 @click.option("--errors", is_flag=True, help="Process items which have errors from previous categorization")
 @click.option("--save-html", 
-    type=click.Path(file_okay=False, dir_okay=True, allow_dash=False), help="Save html into the specified folder")
+    type=click.Path(file_okay=False, dir_okay=True, allow_dash=False), help="Also write stored html into the specified folder")
 @click.option("--sync", is_flag=True, help="Send already processed item tags back to Pocket")
 @click.option("--sync-num", default=-1, type=click.INT, help="How many to sync (-1 for all)")
 @click.option("-s", "--silent", is_flag=True, help="Don't show progress bar")
 @click.option(
     "--categorize-url",
-    help="URL to use for classification (optional)",
+    help="URL of a classifier server such as serve-classifier, instead of classifying locally",
+)
+@click.option(
+    "--categorize-token",
+    default="1234",
+    envvar="POCKET_CATEGORIZE_TOKEN",
+    help="Bearer token for --categorize-url",
+)
+@click.option(
+    "--batch-size",
+    default=16,
+    type=click.INT,
+    help="Pages per inference batch",
+)
+@click.option(
+    "--batch-wait",
+    default=2.0,
+    type=click.FLOAT,
+    help="Seconds to wait for an inference batch to fill up",
+)
+@click.option(
+    "--workers",
+    default=1,
+    type=click.INT,
+    help="Processes to classify pages in locally, each with its own copy of the model",
+)
+@click.option(
+    "--concurrent-batches",
+    type=click.INT,
+    help="Inference batches to run at once, defaults to 4 with --categorize-url and --workers otherwise",
+)
+@click.option("--no-cache", is_flag=True, help="Don't reuse classifications of identical page content")
+@click.option(
+    "--cache-max-entries",
+    default=100000,
+    type=click.INT,
+    help="Classification cache entries to keep, least recently used are evicted",
+)
+@click.option(
+    "--cache-max-age",
+    default=90,
+    type=click.INT,
+    help="Days to keep classification cache entries",
+)
+@click.option(
+    "--max-connections",
+    default=downloader.DEFAULT_MAX_CONNECTIONS,
+    type=click.INT,
+    help="Most page downloads in flight at once",
+)
+@click.option(
+    "--per-host",
+    default=downloader.DEFAULT_PER_HOST,
+    type=click.INT,
+    help="Most page downloads in flight to any one host",
+)
+@click.option(
+    "--max-page-bytes",
+    default=downloader.DEFAULT_MAX_BYTES,
+    type=click.INT,
+    help="Stop reading a page after this many bytes",
+)
+@click.option("--refetch", is_flag=True, help="Download every page in full, ignoring stored ETag/Last-Modified validators")
+@click.option(
+    "--html-compression",
+    type=click.Choice(list(html_store.COMPRESSION_LEVELS)),
+    default="zlib",
+    help="How to compress stored page html",
+)
+@click.option("--html-level", type=click.INT, help="Compression level for stored page html")
+@click.option(
+    "--embedding-format",
+    type=click.Choice(list(embeddings.FORMATS)),
+    default="float32",
+    help="Precision of stored embeddings",
+)
+@click.option(
+    "--write-batch-size",
+    default=50,
+    type=click.INT,
+    help="Results to write to auto_tags per transaction",
+)
+@click.option(
+    "--max-attempts",
+    default=5,
+    type=click.INT,
+    help="Attempts per item before it is marked failed, retried with exponential backoff",
+)
+@click.option(
+    "--lease-seconds",
+    default=600,
+    type=click.INT,
+    help="How long claimed items stay reserved for this process",
 )
-def autotag(db_path, auth, sync, sync_num, errors, save_html, silent, categorize_url):
+@click.option("--index-text", is_flag=True, help="Make the text of classified pages searchable with search --text")
+@click.option("--http-stats", is_flag=True, help="Show per-host HTTP connection reuse when finished")
+@click.option("--explain", is_flag=True, help="Show query plans and timings of the queries autotag relies on, then exit")
+@db_profile_option
+@instrumented("autotag")
+def autotag(db_path, auth, sync, sync_num, errors, save_html, silent, categorize_url, categorize_token, batch_size, batch_wait, workers, concurrent_batches, write_batch_size, max_attempts, lease_seconds, index_text, no_cache, cache_max_entries, cache_max_age, max_connections, per_host, max_page_bytes, refetch, html_compression, html_level, embedding_format, http_stats, explain, db_profile):
+    db = utils.open_database(db_path, db_profile)
+    if explain:
+        utils.ensure_indexes(db)
+        utils.explain_queries(db)
+        return
     auth = json.load(open(auth))
-    db = sqlite_utils.Database(db_path)
-    
-    print("Categorizing items...")
-    uncategorized = []
+    try:
+        pages = html_store.HtmlStore(
+            db, html_compression, level=html_level, export_dir=save_html
+        )
+    except ValueError as ex:
+        raise click.ClickException(str(ex))
 
+    print("Categorizing items...")
     if db["auto_tags"].exists():
-        if errors:
-            uncategorized = db.query("select * FROM items WHERE status=0 AND item_id IN (SELECT item_id FROM auto_tags where error is NOT NULL)")
-        else:
-            uncategorized = db.query("SELECT * FROM items WHERE status=0 AND item_id NOT IN (SELECT item_id FROM auto_tags)")
+        if "html" in db["auto_tags"].columns_dict:
+            print("auto_tags still stores html inline, run migrate-html to move it to the html table")
     else:
-        db.execute("""
-            CREATE TABLE [auto_tags] (
-            [item_id] INTEGER PRIMARY KEY REFERENCES [items]([item_id]),
-            [error] TEXT,
-            [html] TEXT,
-            [html_md5] TEXT,
-            [likely_categories] TEXT,
-            [top_category] TEXT,
-            [scores] TEXT,
-            [embeddings] TEXT,
-            [process_time] FLOAT,
-            [created_at] TEXT,
-            [synced] INTEGER
-        )""")
-
-        uncategorized = db.query("SELECT * FROM items WHERE status=0")
-
-    # Operate in parallel if categorization is happening remotely
-    if categorize_url:
-        uncategorized = list(uncategorized)
+        utils.create_auto_tags_table(db)
+    utils.ensure_indexes(db)
+    summaries.ensure_summaries(db)
+    # Classifications count as changes for watermarked exports
+    export.ensure_change_log(db, create=False)
+    jobs = ledger.JobLedger(
+        db, lease_seconds=lease_seconds, max_attempts=max_attempts
+    )
+    jobs.enqueue(errors)
+    total_items = jobs.remaining()
+    uncategorized = jobs.iter_claimed()
+
+    classification_cache = None
+    if not no_cache:
+        classification_cache = cache.ClassificationCache(
+            db,
+            cache.model_version(categorize_url),
+            max_entries=cache_max_entries,
+            max_age_days=cache_max_age,
+        )
+        classification_cache.evict()
+    validators = None if refetch else cache.PageValidators(db, pages)
+
+    pending = []
+
+    def write_pending():
+        with utils.write_transaction(db):
+            utils.save_categorizations(db, pending, pages, embedding_format)
+            jobs.finish(pending)
+        pending.clear()
+        if validators:
+            validators.flush(min_pending=100)
+
+    classifier = classifiers.get_classifier(
+        categorize_url, token=categorize_token, workers=workers
+    )
+    if concurrent_batches is None:
+        # A remote server can usually work on several batches at once, and
+        # a process pool on one per worker
+        concurrent_batches = 4 if categorize_url else workers
+    http_client.configure(pool_size=concurrent_batches)
+    timings = utils.StageTimings()
+    page_downloader = downloader.PageDownloader(
+        validators,
+        max_connections=max_connections,
+        per_host=per_host,
+        max_bytes=max_page_bytes,
+        timings=timings,
+    )
+    try:
         num_results = 0
-        total_items = len(uncategorized)
-        print("Entering parallel processing for {} items".format(total_items))
+        num_errors = 0
+        print("Categorizing {} items".format(total_items))
         t1 = time.time()
-        for categorize_result in ThreadPoolExecutor(max_workers=6).map(utils.categorize_item, uncategorized, repeat(categorize_url), repeat(save_html)):
-            num_results += 1
-            print("Received result #{}/{} - {:.2f} seconds since start (item_id {})".format(num_results, total_items, time.time() - t1, categorize_result["categorization"]["item_id"]))
-            if categorize_result["error"] == True:
-                print("Error categorizing item {}: {}".format(categorize_result["categorization"]["item_id"], categorize_result["categorization"]["error"][:100] ))
-            db["auto_tags"].upsert(
-                categorize_result["categorization"],
-                pk="item_id",
-                foreign_keys=("items", "item_id"))
-    
-        print("Predicted {} results in {:.2f} seconds".format(total_items, time.time() - t1))
-    else:
-        for item in uncategorized:
-            categorize_result = utils.categorize_item(item, categorize_url, save_html)
+        results = utils.categorize_items(
+            uncategorized,
+            classifier.predict,
+            pages=page_downloader,
+            batch_size=batch_size,
+            max_wait=batch_wait,
+            concurrency=concurrent_batches,
+            timings=timings,
+            cache=classification_cache,
+            validators=validators,
+        )
+        # Errors are kept in auto_tags.error and counted in the metrics
+        # rather than printed one by one
+        if silent:
+            progress = contextlib.nullcontext(results)
+        else:
+            progress = click.progressbar(results, length=total_items)
+        with progress as bar:
+            for categorize_result in bar:
+                num_results += 1
+                if categorize_result["error"]:
+                    num_errors += 1
+                    metrics.inc("autotag_errors")
 
-            if categorize_result["error"] == True:
-                print("Error categorizing item: {}".format(categorize_result["categorization"]))
+                pending.append(categorize_result)
+                if len(pending) >= write_batch_size:
+                    with timings.time("write", len(pending)):
+                        write_pending()
+        with timings.time("write", len(pending)):
+            write_pending()
+        timings.report()
+        print("Categorized {} items ({} errors) in {:.2f} seconds".format(
+            num_results, num_errors, time.time() - t1
+        ))
+    finally:
+        # Keep what already finished and hand the rest back for the next run
+        if pending:
+            write_pending()
+        jobs.release()
+        page_downloader.close()
+        classifier.close()
 
-            db["auto_tags"].upsert(
-                categorize_result["categorization"],
-                pk="item_id",
-                foreign_keys=("items", "item_id"))
+    print(jobs.summary())
+    if index_text:
+        print("Indexed text of {} pages".format(search.index_pages(db)))
+    if classification_cache:
+        print(classification_cache.summary())
+    if validators:
+        validators.flush()
+        print(validators.summary())
+    utils.finish_database(db)
+    if http_stats:
+        http_client.print_connection_stats()
 
 @cli.command()
 @click.argument(
@@ -166,22 +388,49 @@ def autotag(db_path, auth, sync, sync_num, errors, save_html, silent, categorize
 )
 @click.option("-n", "--num", default=-1, type=click.INT, help="How many to sync (-1 for all)")
 @click.option("-s", "--silent", is_flag=True, help="Don't show progress bar")
-def autotag_sync(db_path, auth, num, silent):
+@click.option(
+    "--batch-size",
+    default=100,
+    type=click.INT,
+    help="Number of tags to send per Pocket API request",
+)
+@click.option(
+    "--concurrency",
+    default=1,
+    type=click.INT,
+    help="Number of batches to send to Pocket in parallel",
+)
+@click.option("--http-stats", is_flag=True, help="Show per-host HTTP connection reuse when finished")
+@click.option("--explain", is_flag=True, help="Show query plans and timings of the queries autotag-sync relies on, then exit")
+@db_profile_option
+@instrumented("autotag-sync")
+def autotag_sync(db_path, auth, num, silent, batch_size, concurrency, http_stats, explain, db_profile):
+    db = utils.open_database(db_path, db_profile)
+    utils.ensure_indexes(db)
+    if explain:
+        utils.explain_queries(db)
+        return
     auth = json.load(open(auth))
-    db = sqlite_utils.Database(db_path)
+    http_client.configure(pool_size=concurrency)
     categorized_and_not_synced = []
 
     if db["auto_tags"].exists():
-        categorized_and_not_synced = db.query("select * from auto_tags where synced <> 1 and error is null")
+        categorized_and_not_synced = db.query(utils.UNSYNCED_SQL)
 
     categorized_and_not_synced = list(categorized_and_not_synced)
     print("{} items remaining to sync".format(len(categorized_and_not_synced)))
-    num_to_process = num
-    for unsynced in categorized_and_not_synced:
-        utils.write_labels_to_pocket(unsynced, auth, db)
-        num_to_process -= 1
-        if num_to_process == 0:
-            break
+    if num >= 0:
+        categorized_and_not_synced = categorized_and_not_synced[:num]
+    utils.sync_labels_to_pocket(
+        categorized_and_not_synced,
+        auth,
+        db,
+        batch_size=batch_size,
+        concurrency=concurrency,
+    )
+    utils.finish_database(db)
+    if http_stats:
+        http_client.print_connection_stats()
 
 @cli.command()
 @click.argument(
@@ -198,10 +447,36 @@ def autotag_sync(db_path, auth, num, silent):
 )
 @click.option("--all", is_flag=True, help="Fetch all items (not just new ones)")
 @click.option("-s", "--silent", is_flag=True, help="Don't show progress bar")
-def fetch(db_path, auth, all, silent):
+@click.option(
+    "--batch-size",
+    default=500,
+    type=click.INT,
+    help="Number of items to write per transaction",
+)
+@click.option(
+    "--concurrency",
+    default=1,
+    type=click.INT,
+    help="Number of pages to fetch from Pocket in parallel",
+)
+@click.option(
+    "--rate",
+    type=click.FLOAT,
+    help="Maximum Pocket API requests per second when fetching in parallel",
+)
+@click.option(
+    "--archive-pages",
+    type=click.Path(file_okay=False, dir_okay=True, allow_dash=False),
+    help="Also keep every raw API response, gzipped, in this directory for the import command",
+)
+@click.option("--http-stats", is_flag=True, help="Show per-host HTTP connection reuse when finished")
+@db_profile_option
+@instrumented("fetch")
+def fetch(db_path, auth, all, silent, batch_size, concurrency, rate, archive_pages, http_stats, db_profile):
     "Save Pocket data to a SQLite database"
     auth = json.load(open(auth))
-    db = sqlite_utils.Database(db_path)
+    http_client.configure(pool_size=concurrency)
+    db = utils.open_database(db_path, db_profile)
     last_since = None
     if not all and db["since"].exists():
         last_since = db["since"].get(1)["since"]
@@ -211,13 +486,314 @@ def fetch(db_path, auth, all, silent):
         record_since=lambda since: db["since"].insert(
             {"id": 1, "since": since}, replace=True, pk="id"
         ),
+        concurrency=concurrency,
+        rate=rate,
+        archive=archive.PageArchive(archive_pages) if archive_pages else None,
     )
+    summaries.ensure_summaries(db)
     if (all or last_since is None) and not silent:
         total_items = utils.fetch_stats(auth)["count_list"]
-        with click.progressbar(fetch, length=total_items) as bar:
-            utils.save_items(bar, db)
+        fetch.total = total_items
+        # A full fetch rewrites most rows, so rebuild the FTS index once
+        # afterwards rather than through a trigger per row
+        with search.bulk_load(db), summaries.bulk_load(db), click.progressbar(
+            fetch, length=total_items
+        ) as bar:
+            counts = utils.save_items(bar, db, batch_size=batch_size)
     else:
         # No progress bar
         print("Fetching items since {}".format(last_since))
-        utils.save_items(fetch, db)
+        counts = utils.save_items(fetch, db, batch_size=batch_size)
+    print(
+        "{inserted} inserted, {updated} updated, {deleted} deleted, "
+        "{skipped} unchanged".format(**counts)
+    )
     utils.ensure_fts(db)
+    utils.ensure_indexes(db)
+    # Creates the summaries, if this fetch created the items table
+    summaries.ensure_summaries(db)
+    utils.finish_database(db)
+    if http_stats:
+        http_client.print_connection_stats()
+
+
+@cli.command()
+@click.argument(
+    "db_path",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+@click.option(
+    "--html-compression",
+    type=click.Choice(list(html_store.COMPRESSION_LEVELS)),
+    default="zlib",
+    help="How to compress stored page html",
+)
+@click.option("--html-level", type=click.INT, help="Compression level for stored page html")
+@db_profile_option
+def migrate_html(db_path, html_compression, html_level, db_profile):
+    "Move page html out of auto_tags into the compressed html table"
+    db = utils.open_database(db_path, db_profile)
+    if not db["auto_tags"].exists():
+        raise click.ClickException("No auto_tags table in {}".format(db_path))
+    try:
+        pages = html_store.HtmlStore(db, html_compression, level=html_level)
+    except ValueError as ex:
+        raise click.ClickException(str(ex))
+    before, after = html_store.migrate_auto_tags(db, pages)
+    # Rebuilding auto_tags without the html column drops its triggers
+    summaries.ensure_summaries(db)
+    export.ensure_change_log(db, create=False)
+    utils.finish_database(db)
+    click.echo("Database size: {:,} bytes before, {:,} bytes after".format(before, after))
+
+
+@cli.command()
+@click.argument(
+    "db_path",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False, exists=True),
+    required=True,
+)
+@click.argument("item")
+@click.option("-k", "--top", default=10, type=click.INT, help="Number of similar items to show")
+@db_profile_option
+def similar(db_path, item, top, db_profile):
+    "Show saved items most similar to ITEM (an item_id or URL) by embedding"
+    db = utils.open_database(db_path, db_profile)
+    if not db["auto_tags"].exists():
+        raise click.ClickException("Run autotag first to compute embeddings")
+    item_id = embeddings.resolve_item_id(db, item)
+    if item_id is None:
+        raise click.ClickException("No item found for {}".format(item))
+    index = embeddings.EmbeddingIndex(db, db_path).load()
+    try:
+        results = index.similar(item_id, k=top)
+    except KeyError:
+        raise click.ClickException("Item {} has no embedding".format(item_id))
+    for similar_id, score in results:
+        row = db.execute(
+            "select resolved_title, coalesce(resolved_url, given_url) from items where item_id = ?",
+            (similar_id,),
+        ).fetchone() or (None, None)
+        click.echo("{:.4f}  {}  {}  {}".format(score, similar_id, row[0] or "", row[1] or ""))
+
+
+@cli.command()
+@click.argument(
+    "db_path",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False, exists=True),
+    required=True,
+)
+@click.option(
+    "--embedding-format",
+    type=click.Choice(list(embeddings.FORMATS)),
+    default="float32",
+    help="Precision of stored embeddings",
+)
+@db_profile_option
+def migrate_embeddings(db_path, embedding_format, db_profile):
+    "Convert JSON embeddings in auto_tags into packed binary BLOBs"
+    db = utils.open_database(db_path, db_profile)
+    if not db["auto_tags"].exists():
+        raise click.ClickException("No auto_tags table in {}".format(db_path))
+    converted = embeddings.migrate_auto_tags(db, embedding_format)
+    utils.finish_database(db)
+    click.echo("Converted {} embeddings".format(converted))
+
+
+@cli.command()
+@click.argument(
+    "db_path",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False, exists=True),
+    required=True,
+)
+@db_profile_option
+def rebuild_summaries(db_path, db_profile):
+    "Recompute the summary tables behind the Datasette canned queries"
+    db = utils.open_database(db_path, db_profile)
+    if not db["items"].exists():
+        raise click.ClickException("No items table in {}".format(db_path))
+    start = time.perf_counter()
+    counts = summaries.rebuild_summaries(db)
+    utils.finish_database(db)
+    for table, rows in counts.items():
+        click.echo("{}: {} rows".format(table, rows))
+    click.echo("Rebuilt in {:.2f}s".format(time.perf_counter() - start))
+
+
+@cli.command(name="search")
+@click.argument(
+    "db_path",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False, exists=True),
+    required=True,
+)
+@click.argument("q")
+@click.option("--category", help="Only items with this top_category")
+@click.option("--status", type=click.Choice(list(search.STATUSES)), help="Only items with this status")
+@click.option("--text", is_flag=True, help="Also search page text indexed by autotag --index-text")
+@click.option("-n", "--limit", default=20, type=click.INT, help="Number of results")
+@db_profile_option
+def search_(db_path, q, category, status, text, limit, db_profile):
+    "Search saved items, best matches first"
+    db = utils.open_database(db_path, db_profile)
+    if "items_fts" not in db.table_names():
+        raise click.ClickException("No search index, run fetch first")
+    start = time.perf_counter()
+    try:
+        results = search.search(
+            db, q, category=category, status=status, text=text, limit=limit
+        )
+    except sqlite3.OperationalError as ex:
+        raise click.ClickException("Invalid search: {}".format(ex))
+    for result in results:
+        click.echo(
+            "{} [{}] {}".format(
+                result["item_id"],
+                result["top_category"] or "-",
+                result["resolved_title"] or result["resolved_url"],
+            )
+        )
+        click.echo("    {}".format(result["resolved_url"]))
+        click.echo("    {}".format(result["snippet"]))
+    click.echo(
+        "{} results in {:.1f}ms".format(
+            len(results), (time.perf_counter() - start) * 1000
+        ),
+        err=True,
+    )
+
+
+@cli.command(name="import")
+@click.argument(
+    "db_path",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+@click.argument(
+    "paths",
+    type=click.Path(exists=True, file_okay=True, dir_okay=True, allow_dash=False),
+    nargs=-1,
+    required=True,
+)
+@click.option("--all", is_flag=True, help="Import every item, not just those changed since the last fetch or import")
+@click.option(
+    "--batch-size",
+    default=500,
+    type=click.INT,
+    help="Number of items to write per transaction",
+)
+@db_profile_option
+def import_(db_path, paths, all, batch_size, db_profile):
+    """
+    Load items from pages kept by fetch --archive-pages, or from Pocket's
+    HTML or CSV export, without calling the API
+
+    PATHS can be archived .json.gz pages, directories of them, ril_export.html
+    or CSV export files.
+    """
+    db = utils.open_database(db_path, db_profile)
+    last_since = None
+    if not all and db["since"].exists():
+        last_since = db["since"].get(1)["since"]
+    known_urls = set()
+    if db["items"].exists():
+        known_urls = {row[0] for row in db.execute("select given_url from items")}
+    importer = archive.Importer(paths, since=last_since, known_urls=known_urls)
+    summaries.ensure_summaries(db)
+    start = time.perf_counter()
+    try:
+        with search.bulk_load(db), summaries.bulk_load(db):
+            counts = utils.save_items(importer, db, batch_size=batch_size)
+    except ValueError as ex:
+        raise click.ClickException(str(ex))
+    stored_since = db["since"].get(1)["since"] if db["since"].exists() else None
+    # Replaying old pages with --all must not move since backwards
+    if importer.since and (stored_since is None or importer.since > stored_since):
+        db["since"].insert({"id": 1, "since": importer.since}, replace=True, pk="id")
+    print(
+        "{inserted} inserted, {updated} updated, {deleted} deleted, "
+        "{skipped} unchanged".format(**counts)
+        + " from {} files in {:.2f}s".format(importer.files, time.perf_counter() - start)
+    )
+    utils.ensure_fts(db)
+    utils.ensure_indexes(db)
+    summaries.ensure_summaries(db)
+    utils.finish_database(db)
+
+
+@cli.command(name="export")
+@click.argument(
+    "db_path",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+@click.argument(
+    "output",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=True),
+    required=True,
+)
+@click.option(
+    "format_",
+    "-f",
+    "--format",
+    type=click.Choice(export.FORMATS),
+    help="Output format, by default parquet for .parquet files and ndjson otherwise",
+)
+@click.option("--chunk-size", default=1000, type=click.INT, help="Rows to read and write at a time")
+@click.option(
+    "--watermark",
+    help="Only export rows changed since the last export with this name, then record this one",
+)
+@db_profile_option
+def export_(db_path, output, format_, chunk_size, watermark, db_profile):
+    "Export items with their classifications and authors as NDJSON or Parquet"
+    db = utils.open_database(db_path, db_profile)
+    if not db["items"].exists():
+        raise click.ClickException("No items table in {}, run fetch first".format(db_path))
+    if format_ is None:
+        format_ = "parquet" if output.endswith(".parquet") else "ndjson"
+    start = time.perf_counter()
+    try:
+        num_rows = export.export(
+            db, output, format_, chunk_size=chunk_size, watermark_name=watermark
+        )
+    except ValueError as ex:
+        raise click.ClickException(str(ex))
+    click.echo(
+        "Exported {} rows in {:.2f}s".format(num_rows, time.perf_counter() - start),
+        err=True,
+    )
+
+
+@cli.command()
+@click.option("--host", default="127.0.0.1", help="Interface to listen on")
+@click.option("--port", default=8000, type=click.INT, help="Port to listen on")
+@click.option(
+    "--workers",
+    type=click.INT,
+    help="Model worker processes, defaults to the number of CPUs",
+)
+@click.option(
+    "--token",
+    envvar="POCKET_CATEGORIZE_TOKEN",
+    help="Require this bearer token on requests",
+)
+@click.option("--max-pages", default=256, type=click.INT, help="Most pages accepted per request")
+def serve_classifier(host, port, workers, token, max_pages):
+    "Serve the homepage2vec classifier over HTTP for autotag --categorize-url"
+    classifier = classifiers.ProcessPoolClassifier(workers)
+    server = classifiers.make_server(
+        classifier, host=host, port=port, token=token, max_pages=max_pages
+    )
+    click.echo(
+        "Serving {} with {} workers on http://{}:{}/".format(
+            classifier.version, classifier.workers, host, port
+        )
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        classifier.close()
@@ -0,0 +1,228 @@
+"""
+Page downloads for autotag on an asyncio event loop in a background thread,
+so hundreds of pages can be in flight without a thread each. Other threads
+submit URLs and get concurrent.futures.Future objects back, resolving to
+(html, error) with exactly one of them set.
+
+Each host gets at most per_host connections at a time. Responses that
+aren't HTML or text are turned away on their headers, bodies are cut off
+after max_bytes, and a host that fails failure_threshold times in a row is
+skipped for failure_cooldown seconds.
+"""
+import asyncio
+import codecs
+import contextlib
+import hashlib
+import re
+import threading
+import time
+import urllib.parse
+from . import metrics
+
+DEFAULT_MAX_CONNECTIONS = 100
+DEFAULT_PER_HOST = 4
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024
+DEFAULT_TIMEOUT = 10
+# Pages served without a Content-Type are given the benefit of the doubt
+HTML_TYPES = {"text/html", "application/xhtml+xml", "text/plain", "text/xml", "application/xml"}
+HEADER_CHARSET = re.compile(r"charset=[\"']?([\w.:-]+)", re.I)
+META_CHARSET = re.compile(rb"<meta[^>]+charset=[\"']?([\w.:-]+)", re.I)
+# Only read this much of an error response into the error message
+ERROR_BYTES = 1000
+
+
+def decode(body, content_type=None):
+    """
+    Decode with the charset from the Content-Type header or a <meta> tag
+    near the top of the page, falling back to UTF-8. Unlike requests' .text
+    this never runs charset detection over the whole body.
+    """
+    match = HEADER_CHARSET.search(content_type or "") or META_CHARSET.search(body[:2048])
+    charset = "utf-8"
+    if match:
+        found = match.group(1)
+        charset = found.decode("ascii") if isinstance(found, bytes) else found
+        try:
+            codecs.lookup(charset)
+        except LookupError:
+            charset = "utf-8"
+    return body.decode(charset, errors="replace")
+
+
+class HostFailure(Exception):
+    "A response that says the host, rather than the page, is in trouble"
+
+
+class PageDownloader:
+    def __init__(
+        self,
+        validators=None,
+        max_connections=DEFAULT_MAX_CONNECTIONS,
+        per_host=DEFAULT_PER_HOST,
+        max_bytes=DEFAULT_MAX_BYTES,
+        timeout=DEFAULT_TIMEOUT,
+        failure_threshold=3,
+        failure_cooldown=300,
+        timings=None,
+    ):
+        self.validators = validators
+        self.max_connections = max_connections
+        self.per_host = per_host
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.failure_cooldown = failure_cooldown
+        self.timings = timings
+        # Only touched from the event loop thread
+        self.hosts = {}
+        self.failures = {}
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.slots, self.client = self.run(self.start())
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def start(self):
+        # Imported here so the CLI starts without loading httpx
+        import httpx
+
+        self.host_errors = (HostFailure, httpx.HTTPError)
+        client = httpx.AsyncClient(
+            follow_redirects=True,
+            timeout=self.timeout,
+            # slots already keeps us under the limit, so nothing waits on the
+            # pool and trips its timeout
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_connections,
+            ),
+            headers={"Accept": "text/html,application/xhtml+xml,text/plain;q=0.9,*/*;q=0.1"},
+        )
+        return asyncio.Semaphore(self.max_connections), client
+
+    async def stop(self):
+        # Downloads nobody is waiting for any more, e.g. after Ctrl-C
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.client.aclose()
+        await self.loop.shutdown_default_executor()
+
+    def submit(self, url):
+        return asyncio.run_coroutine_threadsafe(self.download(url), self.loop)
+
+    def close(self):
+        if self.loop.is_closed():
+            return
+        self.run(self.stop())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def skip_reason(self, host):
+        failures, until = self.failures.get(host, (0, 0))
+        if until > time.monotonic():
+            return "Skipped {} after {} failures in a row".format(host, failures)
+        return None
+
+    def record_failure(self, host):
+        failures, until = self.failures.get(host, (0, 0))
+        failures += 1
+        if failures >= self.failure_threshold:
+            # Once past the threshold, every failure after a cooldown starts
+            # another one, so a host that's still down gets one probe per
+            # cooldown
+            until = time.monotonic() + self.failure_cooldown
+            metrics.inc("hosts_skipped")
+        self.failures[host] = (failures, until)
+
+    async def download(self, url):
+        host = urllib.parse.urlsplit(url).hostname or ""
+        html, err = None, self.skip_reason(host)
+        if err:
+            metrics.inc("page_fetch_skipped")
+            return None, err
+        if host not in self.hosts:
+            self.hosts[host] = asyncio.Semaphore(self.per_host)
+        # The host's slot comes first, so one busy host can't tie up
+        # connections the others could be using
+        async with self.hosts[host], self.slots:
+            timer = self.timings.time("download") if self.timings else contextlib.nullcontext()
+            with timer, metrics.timer("page_fetch_seconds"):
+                try:
+                    html, err = await self.fetch(url)
+                    self.failures.pop(host, None)
+                except self.host_errors as ex:
+                    err = str(ex) or type(ex).__name__
+                    self.record_failure(host)
+                except Exception as ex:
+                    err = str(ex) or type(ex).__name__
+        if err:
+            metrics.inc("page_fetch_errors")
+            return None, err
+        metrics.inc("pages_fetched")
+        metrics.observe("page_html_bytes", len(html))
+        return html, None
+
+    async def fetch(self, url, conditional=True):
+        # The validator and HTML lookups are SQLite queries, so they run on
+        # the loop's default executor rather than holding up other downloads
+        loop = asyncio.get_running_loop()
+        validator = None
+        if conditional and self.validators:
+            validator = await loop.run_in_executor(None, self.validators.get, url)
+        headers = {}
+        request_url = url
+        if validator:
+            headers = self.validators.request_headers(validator)
+            # Skip the redirects we followed last time
+            request_url = validator["final_url"] or url
+        async with self.client.stream("GET", request_url, headers=headers) as response:
+            content_type = response.headers.get("Content-Type")
+            if response.status_code == 304 and validator:
+                html = await loop.run_in_executor(
+                    None, self.validators.stored_html, validator["html_md5"]
+                )
+                if html is not None:
+                    self.validators.record_not_modified(validator)
+                    return html, None
+            elif response.status_code != 200:
+                body = decode(await self.read(response, ERROR_BYTES), content_type)
+                err = "Status {} {}".format(response.status_code, body)
+                if response.status_code == 429 or response.status_code >= 500:
+                    raise HostFailure(err)
+                return None, err
+            else:
+                mime = (content_type or "").split(";")[0].strip().lower()
+                if mime and mime not in HTML_TYPES:
+                    metrics.inc("pages_skipped_content_type")
+                    return None, "Not HTML: {}".format(mime)
+                body = await self.read(response, self.max_bytes)
+                html = decode(body, content_type)
+                if self.validators:
+                    self.validators.record(
+                        url, response, hashlib.md5(html.encode("utf-8")).hexdigest(), len(body)
+                    )
+                return html, None
+        # A 304 without stored HTML to fall back on, so fetch it in full
+        return await self.fetch(url, conditional=False)
+
+    async def read(self, response, limit):
+        chunks = []
+        size = 0
+        async for chunk in response.aiter_bytes():
+            chunks.append(chunk)
+            size += len(chunk)
+            if size > limit:
+                metrics.inc("pages_truncated")
+                break
+        return b"".join(chunks)[:limit]
@@ -0,0 +1,132 @@
+"""
+Embeddings are stored in auto_tags as packed little-endian float BLOBs
+rather than JSON, and loaded into a contiguous, memory-mapped NumPy matrix
+for similarity search.
+"""
+import json
+import os
+import struct
+
+FORMATS = {"float32": "f", "float16": "e"}
+
+
+def pack(values, fmt="float32"):
+    return struct.pack("<{}{}".format(len(values), FORMATS[fmt]), *values)
+
+
+def unpack(blob, fmt="float32"):
+    "Accepts packed BLOBs as well as the JSON text older versions stored"
+    if blob is None:
+        return None
+    if isinstance(blob, str):
+        return json.loads(blob)
+    code = FORMATS[fmt or "float32"]
+    return list(struct.unpack("<{}{}".format(len(blob) // struct.calcsize(code), code), blob))
+
+
+def to_vector(blob, fmt, np):
+    if isinstance(blob, str):
+        return np.asarray(json.loads(blob), dtype=np.float32)
+    dtype = "<f2" if fmt == "float16" else "<f4"
+    return np.frombuffer(blob, dtype=dtype).astype(np.float32)
+
+
+class EmbeddingIndex:
+    """
+    Unit-normalised embeddings of every classified item as one float32
+    matrix, cached next to the database as .npy files and memory-mapped on
+    later runs. The cache is rebuilt whenever the number of rows with
+    embeddings or their max rowid changes.
+    """
+
+    def __init__(self, db, db_path):
+        self.db = db
+        self.prefix = db_path + ".embeddings"
+        self.ids = None
+        self.matrix = None
+
+    def state(self):
+        count, max_rowid = self.db.execute(
+            "select count(*), max(rowid) from auto_tags where embeddings is not null"
+        ).fetchone()
+        return {"count": count, "max_rowid": max_rowid}
+
+    def load(self):
+        import numpy as np
+
+        state = self.state()
+        meta_path = self.prefix + ".json"
+        if os.path.exists(meta_path):
+            with open(meta_path) as fp:
+                if json.load(fp) == state:
+                    self.ids = np.load(self.prefix + ".ids.npy", mmap_mode="r")
+                    self.matrix = np.load(self.prefix + ".npy", mmap_mode="r")
+                    return self
+        self.build(state)
+        return self
+
+    def build(self, state):
+        import numpy as np
+
+        ids = []
+        vectors = []
+        has_format = "embedding_format" in self.db["auto_tags"].columns_dict
+        sql = "select item_id, embeddings, {} from auto_tags where embeddings is not null".format(
+            "embedding_format" if has_format else "null"
+        )
+        for item_id, blob, fmt in self.db.execute(sql):
+            ids.append(item_id)
+            vectors.append(to_vector(blob, fmt, np))
+        matrix = np.vstack(vectors) if vectors else np.zeros((0, 0), dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        matrix = np.ascontiguousarray(matrix / norms, dtype=np.float32)
+        np.save(self.prefix + ".npy", matrix)
+        np.save(self.prefix + ".ids.npy", np.asarray(ids, dtype=np.int64))
+        with open(self.prefix + ".json", "w") as fp:
+            json.dump(state, fp)
+        self.ids = np.load(self.prefix + ".ids.npy", mmap_mode="r")
+        self.matrix = np.load(self.prefix + ".npy", mmap_mode="r")
+
+    def similar(self, item_id, k=10):
+        "Returns [(item_id, cosine similarity)] of the k nearest other items"
+        import numpy as np
+
+        positions = np.nonzero(self.ids == item_id)[0]
+        if not len(positions):
+            raise KeyError(item_id)
+        scores = self.matrix @ self.matrix[positions[0]]
+        scores[positions[0]] = -np.inf
+        k = min(k, len(scores) - 1)
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(self.ids[i]), float(scores[i])) for i in top]
+
+
+def resolve_item_id(db, item_id_or_url):
+    "Accepts an item_id or a resolved/given URL"
+    if str(item_id_or_url).isdigit():
+        return int(item_id_or_url)
+    row = db.execute(
+        "select item_id from items where resolved_url = ? or given_url = ? limit 1",
+        (item_id_or_url, item_id_or_url),
+    ).fetchone()
+    return row[0] if row else None
+
+
+def migrate_auto_tags(db, fmt="float32"):
+    "Convert embeddings stored as JSON text by older versions into BLOBs"
+    if "embedding_format" not in db["auto_tags"].columns_dict:
+        db["auto_tags"].add_column("embedding_format", str)
+    rows = db.execute(
+        "select item_id, embeddings from auto_tags where typeof(embeddings) = 'text'"
+    ).fetchall()
+    with db.conn:
+        for item_id, text in rows:
+            db.conn.execute(
+                "update auto_tags set embeddings = ?, embedding_format = ? where item_id = ?",
+                (pack(json.loads(text), fmt), fmt, item_id),
+            )
+    return len(rows)
@@ -0,0 +1,412 @@
+"""
+Export items joined to their auto_tags classification and authors as NDJSON
+or Parquet, for analysis outside SQLite.
+
+Rows are read in item_id order a chunk at a time, so memory use stays flat
+however big the database is. JSON stored in SQLite is decoded on the way
+out: images and authors become lists of records, likely_categories a list
+of strings, scores one float column per category and embeddings a
+fixed-size list of floats.
+
+With a watermark only rows whose item or classification changed since the
+last export under the same name are written. Triggers on items and
+auto_tags give every insert or update, deletions included (Pocket deletes
+by setting status), the next number in item_changes; a watermark is the
+last number an export saw. Watermarks are kept in the export_watermarks
+table and only move forward once an export has finished.
+"""
+import contextlib
+import datetime
+import json
+import math
+import os
+import sys
+from . import embeddings, utils
+
+FORMATS = ("ndjson", "parquet")
+WATERMARKS_TABLE = "export_watermarks"
+CHANGES_TABLE = "item_changes"
+# Tables whose writes are numbered, and the exported columns an update has
+# to touch to count (None for any), so autotag-sync setting synced doesn't
+# re-export every row
+CHANGE_SOURCES = {
+    "items": None,
+    "auto_tags": (
+        "item_id",
+        "top_category",
+        "likely_categories",
+        "scores",
+        "embeddings",
+        "embedding_format",
+        "error",
+        "created_at",
+    ),
+}
+# homepage2vec's categories, in the order it scores them
+CATEGORIES = (
+    "Arts",
+    "Business",
+    "Computers",
+    "Games",
+    "Health",
+    "Home",
+    "Kids_and_Teens",
+    "News",
+    "Recreation",
+    "Reference",
+    "Science",
+    "Shopping",
+    "Society",
+    "Sports",
+)
+IMAGE_FIELDS = (("image_id", int), ("src", str), ("width", int), ("height", int), ("credit", str), ("caption", str))
+
+
+def score_column(category):
+    return "score_" + category.lower()
+
+
+SCORE_COLUMNS = [(category, score_column(category)) for category in CATEGORIES]
+
+
+def to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def decode_images(value):
+    if not value:
+        return None
+    images = json.loads(value) if isinstance(value, str) else value
+    return [
+        {
+            name: (to_int(image.get(name)) if kind is int else image.get(name))
+            for name, kind in IMAGE_FIELDS
+        }
+        for image in images.values()
+    ]
+
+
+class Exporter:
+    def __init__(self, db, chunk_size=1000):
+        self.db = db
+        self.chunk_size = chunk_size
+        self.item_columns = [
+            (column.name, column.type) for column in db["items"].columns
+        ]
+        self.has_tags = db["auto_tags"].exists()
+        tag_columns = db["auto_tags"].columns_dict if self.has_tags else {}
+        self.has_format = "embedding_format" in tag_columns
+        self.has_authors = db["items_authors"].exists() and db["authors"].exists()
+        self.id_index = [name for name, _ in self.item_columns].index("item_id")
+        self.dimensions = self.embedding_dimensions()
+
+    def embedding_dimensions(self):
+        if not self.has_tags:
+            return None
+        row = self.db.execute(
+            "select embeddings, {} from auto_tags where embeddings is not null limit 1".format(
+                "embedding_format" if self.has_format else "null"
+            )
+        ).fetchone()
+        if row is None:
+            return None
+        return len(embeddings.unpack(*row))
+
+    def columns(self):
+        "(name, type) of every exported column, type being one of the SQLite or list kinds"
+        columns = [
+            (name, "images" if name == "images" else type_)
+            for name, type_ in self.item_columns
+        ]
+        columns += [
+            ("authors", "authors"),
+            ("top_category", "TEXT"),
+            ("likely_categories", "strings"),
+        ]
+        columns += [(column, "FLOAT") for _, column in SCORE_COLUMNS]
+        columns += [
+            ("embedding", "embedding"),
+            ("classification_error", "TEXT"),
+            ("classified_at", "TEXT"),
+        ]
+        return columns
+
+    def select_sql(self, watermark):
+        tag_columns = "null, null, null, null, null, null, null"
+        join = ""
+        if self.has_tags:
+            tag_columns = (
+                "auto_tags.top_category, auto_tags.likely_categories, auto_tags.scores, "
+                "auto_tags.embeddings, {}, auto_tags.error, auto_tags.created_at"
+            ).format("auto_tags.embedding_format" if self.has_format else "null")
+            join = "left join auto_tags on auto_tags.item_id = items.item_id"
+        where = "items.item_id > :after"
+        if watermark:
+            join += " join [{0}] on [{0}].item_id = items.item_id".format(CHANGES_TABLE)
+            where += " and [{}].seq > :seq".format(CHANGES_TABLE)
+        return "select {}, {} from items {} where {} order by items.item_id limit :limit".format(
+            ", ".join("items.[{}]".format(name) for name, _ in self.item_columns),
+            tag_columns,
+            join,
+            where,
+        )
+
+    def authors(self, item_ids):
+        by_item = {}
+        if not self.has_authors or not item_ids:
+            return by_item
+        sql = (
+            "select items_authors.item_id, authors.author_id, authors.name, authors.url "
+            "from items_authors join authors on authors.author_id = items_authors.author_id "
+            "where items_authors.item_id in ({})".format(", ".join("?" for _ in item_ids))
+        )
+        for item_id, author_id, name, url in self.db.execute(sql, item_ids):
+            by_item.setdefault(item_id, []).append(
+                {"author_id": author_id, "name": name, "url": url}
+            )
+        return by_item
+
+    def row(self, values, authors):
+        names = [name for name, _ in self.item_columns]
+        row = dict(zip(names, values))
+        (
+            top_category,
+            likely_categories,
+            scores,
+            blob,
+            fmt,
+            error,
+            created_at,
+        ) = values[len(names) :]
+        if "images" in row:
+            row["images"] = decode_images(row["images"])
+        row["authors"] = authors.get(row["item_id"], [])
+        row["top_category"] = top_category
+        row["likely_categories"] = json.loads(likely_categories) if likely_categories else None
+        scores = json.loads(scores) if scores else {}
+        for category, column in SCORE_COLUMNS:
+            row[column] = scores.get(category)
+        vector = embeddings.unpack(blob, fmt)
+        # A fixed-size list column can't hold embeddings from another model
+        if vector is not None and len(vector) != self.dimensions:
+            vector = None
+        row["embedding"] = vector
+        row["classification_error"] = error
+        row["classified_at"] = created_at
+        return row
+
+    def chunks(self, watermark=None):
+        "Yields lists of at most chunk_size rows"
+        params = dict(watermark or {}, limit=self.chunk_size, after=-1)
+        sql = self.select_sql(watermark)
+        while True:
+            rows = self.db.execute(sql, params).fetchall()
+            if not rows:
+                return
+            authors = self.authors([values[self.id_index] for values in rows])
+            yield [self.row(values, authors) for values in rows]
+            params["after"] = rows[-1][self.id_index]
+
+
+def change_trigger_sql(source):
+    "{trigger name: CREATE TRIGGER statement} numbering source's writes in item_changes"
+    bump = (
+        "INSERT INTO [{0}] (item_id, seq) "
+        "VALUES (new.item_id, (SELECT coalesce(max(seq), 0) + 1 FROM [{0}])) "
+        "ON CONFLICT (item_id) DO UPDATE SET seq = excluded.seq;".format(CHANGES_TABLE)
+    )
+    name = "{}_{}_".format(CHANGES_TABLE, source)
+    columns = CHANGE_SOURCES[source]
+    events = {"insert": "INSERT", "update": "UPDATE"}
+    if columns:
+        events["update"] += " OF " + ", ".join("[{}]".format(column) for column in columns)
+    return {
+        name + event: "CREATE TRIGGER [{}{}] AFTER {} ON [{}] BEGIN\n    {}\nEND".format(
+            name, event, sql, source, bump
+        )
+        for event, sql in events.items()
+    }
+
+
+def stored_change_triggers(db, source):
+    return dict(
+        db.execute(
+            "select name, sql from sqlite_master where type = 'trigger' "
+            "and tbl_name = ? and name like 'item\\_changes\\_%' escape '\\'",
+            (source,),
+        ).fetchall()
+    )
+
+
+def ensure_change_log(db, create=True):
+    """
+    Create item_changes and the triggers that fill it for whichever of items
+    and auto_tags exist, or without create only where a watermarked export
+    has set it up before. Returns True if any triggers had to be (re)created,
+    in which case changes since the last watermark may have gone unrecorded.
+    """
+    if not create and not db[CHANGES_TABLE].exists():
+        return False
+    recreated = False
+    for source in CHANGE_SOURCES:
+        if not db[source].exists():
+            continue
+        triggers = change_trigger_sql(source)
+        if stored_change_triggers(db, source) == triggers:
+            continue
+        with utils.write_transaction(db):
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS [{}] "
+                "([item_id] INTEGER PRIMARY KEY, [seq] INTEGER NOT NULL)".format(CHANGES_TABLE)
+            )
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS [idx_{0}_seq] ON [{0}] ([seq])".format(CHANGES_TABLE)
+            )
+            for name in stored_change_triggers(db, source):
+                db.execute("DROP TRIGGER [{}]".format(name))
+            for sql in triggers.values():
+                db.execute(sql)
+        recreated = True
+    return recreated
+
+
+def current_watermark(db):
+    "The newest change in the database, read before an export starts"
+    seq = db.execute("select max(seq) from [{}]".format(CHANGES_TABLE)).fetchone()[0]
+    return {"seq": seq or 0}
+
+
+def load_watermark(db, name):
+    if not db[WATERMARKS_TABLE].exists():
+        return None
+    rows = list(db[WATERMARKS_TABLE].rows_where("name = ?", [name]))
+    # Watermarks from before item_changes have no seq
+    if not rows or rows[0].get("seq") is None:
+        return None
+    return {"seq": rows[0]["seq"]}
+
+
+def save_watermark(db, name, watermark, num_rows):
+    db[WATERMARKS_TABLE].insert(
+        dict(
+            watermark,
+            name=name,
+            rows=num_rows,
+            exported_at=datetime.datetime.now().isoformat(),
+        ),
+        pk="name",
+        alter=True,
+        replace=True,
+    )
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ValueError(
+            "Parquet export needs the pyarrow package: "
+            "pip install pocket-to-sqlite[parquet]"
+        )
+    return pyarrow
+
+
+def arrow_schema(columns, dimensions):
+    pa = import_pyarrow()
+    author = pa.struct([("author_id", pa.int64()), ("name", pa.string()), ("url", pa.string())])
+    image = pa.struct(
+        [(name, pa.int64() if kind is int else pa.string()) for name, kind in IMAGE_FIELDS]
+    )
+    types = {
+        "INTEGER": pa.int64(),
+        "FLOAT": pa.float64(),
+        "REAL": pa.float64(),
+        "authors": pa.list_(author),
+        "images": pa.list_(image),
+        "strings": pa.list_(pa.string()),
+        "embedding": pa.list_(pa.float32(), dimensions) if dimensions else pa.list_(pa.float32()),
+    }
+    return pa.schema([(name, types.get(type_, pa.string())) for name, type_ in columns])
+
+
+@contextlib.contextmanager
+def replace_when_done(path, mode="w"):
+    "Readers never see a half-written export"
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        with open(tmp_path, mode) as fp:
+            yield fp
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def ndjson_line(row):
+    vector = row.pop("embedding")
+    text = json.dumps(row, default=str)
+    if vector is None or not all(map(math.isfinite, vector)):
+        return '{}, "embedding": {}}}\n'.format(text[:-1], json.dumps(vector))
+    # Nine significant digits round-trip a float32, and formatting them is
+    # about twice as fast as json.dumps writing out the full float64 repr
+    return '{}, "embedding": [{}]}}\n'.format(
+        text[:-1], ",".join(["%.9g" % value for value in vector])
+    )
+
+
+def write_ndjson(chunks, fp):
+    num_rows = 0
+    for rows in chunks:
+        fp.write("".join(ndjson_line(row) for row in rows))
+        num_rows += len(rows)
+    return num_rows
+
+
+def write_parquet(chunks, fp, schema, compression="zstd"):
+    pa = import_pyarrow()
+    num_rows = 0
+    # Each chunk becomes a row group, so readers can stream it back too
+    with pa.parquet.ParquetWriter(fp, schema, compression=compression) as writer:
+        for rows in chunks:
+            writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+            num_rows += len(rows)
+    return num_rows
+
+
+def export(db, path, fmt="ndjson", chunk_size=1000, watermark_name=None):
+    """
+    Write every item, or with watermark_name only those changed since the
+    last export under that name, to path ("-" for stdout, NDJSON only).
+    Returns the number of rows written.
+    """
+    if fmt == "parquet" and path == "-":
+        raise ValueError("Parquet can't be written to stdout")
+    since = None
+    if watermark_name:
+        since = load_watermark(db, watermark_name)
+        # Writes made while the triggers were missing weren't numbered, so
+        # start again from everything
+        if ensure_change_log(db):
+            since = None
+    exporter = Exporter(db, chunk_size=chunk_size)
+    # One read transaction, so the new watermark and the rows come from the
+    # same snapshot while fetch or autotag carry on writing
+    with db.atomic():
+        new_watermark = current_watermark(db) if watermark_name else None
+        chunks = exporter.chunks(since)
+        if fmt == "parquet":
+            schema = arrow_schema(exporter.columns(), exporter.dimensions)
+            with replace_when_done(path, "wb") as fp:
+                num_rows = write_parquet(chunks, fp, schema)
+        elif path == "-":
+            num_rows = write_ndjson(chunks, sys.stdout)
+        else:
+            with replace_when_done(path) as fp:
+                num_rows = write_ndjson(chunks, fp)
+    if watermark_name:
+        save_watermark(db, watermark_name, new_watermark, num_rows)
+    return num_rows
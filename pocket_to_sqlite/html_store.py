@@ -0,0 +1,133 @@
+"""
+Page HTML stored once per distinct content, compressed, in its own table
+keyed on html_md5 instead of inline in auto_tags.
+"""
+import os
+import threading
+import zlib
+from .cache import thread_safe_connection
+
+COMPRESSION_LEVELS = {"zlib": 6, "zstd": 3, "none": None}
+
+
+class HtmlStore:
+    table = "html"
+
+    def __init__(self, db, compression="zlib", level=None, export_dir=None):
+        if compression not in COMPRESSION_LEVELS:
+            raise ValueError("Unknown compression: {}".format(compression))
+        if compression == "zstd":
+            try:
+                import zstandard  # noqa
+            except ImportError:
+                raise ValueError(
+                    "zstd compression needs the zstandard package: "
+                    "pip install pocket-to-sqlite[zstd]"
+                )
+        self.db = db
+        self.compression = compression
+        self.level = COMPRESSION_LEVELS[compression] if level is None else level
+        self.export_dir = export_dir
+        db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS [{}] (
+                [html_md5] TEXT PRIMARY KEY,
+                [compression] TEXT,
+                [size] INTEGER,
+                [compressed_size] INTEGER,
+                [content] BLOB
+            )""".format(self.table)
+        )
+        db.conn.commit()
+        self.conn = thread_safe_connection(db)
+        self.lock = threading.Lock()
+
+    def compress(self, data):
+        if self.compression == "zlib":
+            return zlib.compress(data, self.level)
+        if self.compression == "zstd":
+            import zstandard
+
+            return zstandard.ZstdCompressor(level=self.level).compress(data)
+        return data
+
+    @staticmethod
+    def decompress(content, compression):
+        if compression == "zlib":
+            return zlib.decompress(content)
+        if compression == "zstd":
+            import zstandard
+
+            return zstandard.ZstdDecompressor().decompress(content)
+        return content
+
+    def row(self, html, html_md5):
+        data = html.encode("utf-8")
+        content = self.compress(data)
+        return {
+            "html_md5": html_md5,
+            "compression": self.compression,
+            "size": len(data),
+            "compressed_size": len(content),
+            "content": content,
+        }
+
+    def put_all(self, pages):
+        "Store (html, html_md5, url) tuples. Call from the db's own thread"
+        self.db[self.table].insert_all(
+            (self.row(html, html_md5) for html, html_md5, _ in pages),
+            pk="html_md5",
+            ignore=True,
+        )
+        if self.export_dir:
+            for html, _, url in pages:
+                if url:
+                    self.export(html, url)
+
+    def export(self, html, url):
+        # Save html to a file using a cleaned up version of the url
+        valid_chars = '-_.() abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+        filename = self.export_dir + "/" +''.join(c for c in url.replace("/", "_") if c in valid_chars)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+        with open(filename, "w") as f:
+            f.write(html)
+
+    def get(self, html_md5):
+        "Safe to call from any thread"
+        with self.lock:
+            row = self.conn.execute(
+                "select content, compression from [{}] where html_md5 = ?".format(
+                    self.table
+                ),
+                (html_md5,),
+            ).fetchone()
+        if row is None:
+            return None
+        return self.decompress(row[0], row[1]).decode("utf-8")
+
+
+def database_size(db):
+    page_size = db.execute("pragma page_size").fetchone()[0]
+    page_count = db.execute("pragma page_count").fetchone()[0]
+    return page_size * page_count
+
+
+def migrate_auto_tags(db, store):
+    """
+    Move html from an older auto_tags table into the store, drop the column
+    and vacuum. Returns (size before, size after) of the database in bytes.
+    """
+    before = database_size(db)
+    if "html" in db["auto_tags"].columns_dict:
+        rows = db.conn.execute(
+            "select html_md5, html from auto_tags where html is not null"
+        )
+        db[store.table].insert_all(
+            (store.row(html, html_md5) for html_md5, html in rows),
+            pk="html_md5",
+            ignore=True,
+        )
+        db["auto_tags"].transform(drop={"html"})
+    db.vacuum()
+    return before, database_size(db)
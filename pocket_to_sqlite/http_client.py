@@ -0,0 +1,117 @@
+"""
+A single pooled requests.Session shared by every call to the Pocket API
+and to classifier servers, so worker threads reuse keep-alive connections
+instead of doing a fresh TCP+TLS handshake per request. Page downloads
+have their own httpx client, see downloader.py.
+"""
+import collections
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.poolmanager import PoolManager
+from urllib3.util.retry import Retry
+
+DEFAULT_POOL_SIZE = 10
+# (connect, read) seconds, used when a call doesn't pass its own timeout
+DEFAULT_TIMEOUT = (10, 60)
+DEFAULT_RETRIES = 3
+
+_session = None
+_lock = threading.Lock()
+
+
+class CountingPoolManager(PoolManager):
+    "Keeps hold of every connection pool it creates so stats survive eviction"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.created_pools = []
+
+    def _new_pool(self, scheme, host, port, request_context=None):
+        pool = super()._new_pool(scheme, host, port, request_context=request_context)
+        self.created_pools.append(pool)
+        return pool
+
+
+class PooledAdapter(HTTPAdapter):
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        self._pool_connections = connections
+        self._pool_maxsize = maxsize
+        self._pool_block = block
+        self.poolmanager = CountingPoolManager(
+            num_pools=connections, maxsize=maxsize, block=block, **pool_kwargs
+        )
+
+
+class PooledSession(requests.Session):
+    def __init__(
+        self,
+        pool_size=DEFAULT_POOL_SIZE,
+        timeout=DEFAULT_TIMEOUT,
+        retries=DEFAULT_RETRIES,
+    ):
+        super().__init__()
+        self.timeout = timeout
+        # Only connection-level failures and reads of idempotent requests are
+        # retried here; HTTP status handling (503s etc) stays with the caller
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=0,
+            backoff_factor=0.5,
+            raise_on_status=False,
+        )
+        self.adapter = PooledAdapter(
+            pool_connections=100, pool_maxsize=pool_size, max_retries=retry
+        )
+        self.mount("http://", self.adapter)
+        self.mount("https://", self.adapter)
+        self.headers["Accept-Encoding"] = "gzip, deflate"
+        self.headers["Connection"] = "keep-alive"
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(method, url, **kwargs)
+
+    def connection_stats(self):
+        stats = collections.defaultdict(
+            lambda: {"connections": 0, "requests": 0, "reused": 0}
+        )
+        for pool in self.adapter.poolmanager.created_pools:
+            host = "{}://{}:{}".format(pool.scheme, pool.host, pool.port)
+            stats[host]["connections"] += pool.num_connections
+            stats[host]["requests"] += pool.num_requests
+            stats[host]["reused"] += max(0, pool.num_requests - pool.num_connections)
+        return dict(stats)
+
+
+def get_session():
+    global _session
+    with _lock:
+        if _session is None:
+            _session = PooledSession()
+        return _session
+
+
+def configure(**kwargs):
+    "Replace the shared session, e.g. to size pools to the number of workers"
+    global _session
+    with _lock:
+        if _session is not None:
+            _session.close()
+        _session = PooledSession(**kwargs)
+        return _session
+
+
+def connection_stats():
+    return get_session().connection_stats()
+
+
+def print_connection_stats():
+    for host, stats in sorted(connection_stats().items()):
+        print(
+            "{}: {} requests over {} connections ({} reused)".format(
+                host, stats["requests"], stats["connections"], stats["reused"]
+            )
+        )
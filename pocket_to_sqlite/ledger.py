@@ -0,0 +1,212 @@
+"""
+Job ledger for autotag: one row per item with its state, so runs can be
+interrupted and resumed, and several processes can share one database.
+
+    pending -> leased -> done
+                      -> pending (retry after backoff) -> ... -> failed
+"""
+import os
+import socket
+import time
+import uuid
+from . import utils
+
+
+class JobLedger:
+    table = "autotag_jobs"
+
+    def __init__(
+        self,
+        db,
+        lease_seconds=600,
+        max_attempts=5,
+        backoff=60,
+        max_backoff=6 * 60 * 60,
+        owner=None,
+    ):
+        self.db = db
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.owner = owner or "{}:{}:{}".format(
+            socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8]
+        )
+        db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS [{}] (
+                [item_id] INTEGER PRIMARY KEY REFERENCES [items]([item_id]),
+                [state] TEXT NOT NULL,
+                [attempts] INTEGER NOT NULL DEFAULT 0,
+                [lease_owner] TEXT,
+                [lease_expires] FLOAT,
+                [next_attempt_at] FLOAT NOT NULL DEFAULT 0,
+                [last_error] TEXT,
+                [updated_at] FLOAT
+            )""".format(self.table)
+        )
+        db.execute(
+            "CREATE INDEX IF NOT EXISTS [idx_{0}_state] ON [{0}] "
+            "([state], [next_attempt_at])".format(self.table)
+        )
+        db.conn.commit()
+
+    def write(self):
+        return utils.write_transaction(self.db)
+
+    def enqueue(self, errors=False):
+        """
+        Queue items that have no classification, including ones whose
+        auto_tags row was deleted after their job was done. With errors,
+        items whose classification failed are queued too, to be retried
+        right away even if they were backing off.
+        """
+        now = time.time()
+        # Insert, or start a finished job over; leased jobs are left to their owner
+        queue_sql = (
+            "insert into [{0}] (item_id, state, updated_at) "
+            "select item_id, 'pending', :now from items where {1} "
+            "on conflict (item_id) do update set state = 'pending', attempts = 0, "
+            "next_attempt_at = 0, last_error = null, updated_at = :now "
+            "where [{0}].state in ({2})"
+        )
+        with self.write():
+            added = self.db.execute(
+                queue_sql.format(self.table, utils.uncategorized_where(), "'done', 'failed'"),
+                {"now": now},
+            ).rowcount
+            if errors:
+                added += self.db.execute(
+                    queue_sql.format(
+                        self.table,
+                        utils.uncategorized_where(errors=True),
+                        "'done', 'failed', 'pending'",
+                    ),
+                    {"now": now},
+                ).rowcount
+                added += self.db.execute(
+                    "update [{}] set state = 'pending', attempts = 0, "
+                    "next_attempt_at = 0, updated_at = ? where state = 'failed'".format(
+                        self.table
+                    ),
+                    (now,),
+                ).rowcount
+        return added
+
+    def claimable_where(self):
+        return (
+            "(state = 'pending' and next_attempt_at <= :now) "
+            "or (state = 'leased' and lease_expires < :now)"
+        )
+
+    def remaining(self):
+        "Items this run could claim now, leaving out ones waiting on backoff"
+        return self.db.execute(
+            "select count(*) from [{}] where {}".format(self.table, self.claimable_where()),
+            {"now": time.time()},
+        ).fetchone()[0]
+
+    def claim(self, limit):
+        "Lease up to limit items to this owner, returning them as work items"
+        now = time.time()
+        with self.write():
+            item_ids = [
+                row[0]
+                for row in self.db.execute(
+                    "select item_id from [{}] where {} order by item_id limit :limit".format(
+                        self.table, self.claimable_where()
+                    ),
+                    {"now": now, "limit": limit},
+                ).fetchall()
+            ]
+            if not item_ids:
+                return []
+            placeholders = ", ".join("?" for _ in item_ids)
+            self.db.execute(
+                "update [{}] set state = 'leased', attempts = attempts + 1, "
+                "lease_owner = ?, lease_expires = ?, updated_at = ? "
+                "where item_id in ({})".format(self.table, placeholders),
+                [self.owner, now + self.lease_seconds, now] + item_ids,
+            )
+            rows = self.db.execute(
+                "select item_id, resolved_url, given_url from items "
+                "where item_id in ({}) order by item_id".format(placeholders),
+                item_ids,
+            ).fetchall()
+        return [utils.work_item(*row) for row in rows]
+
+    def iter_claimed(self, chunk_size=100):
+        "Claim chunk_size items at a time until nothing is left to claim"
+        while True:
+            items = self.claim(chunk_size)
+            if not items:
+                break
+            yield from items
+
+    def backoff_seconds(self, attempts):
+        return min(self.backoff * 2 ** max(attempts - 1, 0), self.max_backoff)
+
+    def finish(self, categorize_results):
+        """
+        Mark results done or schedule their retry, and extend the leases
+        still held by this owner. Run inside the transaction that saves the
+        results so the two can't disagree after a crash.
+        """
+        now = time.time()
+        with self.write():
+            for result in categorize_results:
+                item_id = result["categorization"]["item_id"]
+                if not result["error"]:
+                    self.db.execute(
+                        "update [{}] set state = 'done', lease_owner = null, "
+                        "lease_expires = null, last_error = null, updated_at = ? "
+                        "where item_id = ?".format(self.table),
+                        (now, item_id),
+                    )
+                    continue
+                row = self.db.execute(
+                    "select attempts from [{}] where item_id = ?".format(self.table),
+                    (item_id,),
+                ).fetchone()
+                attempts = row[0] if row else 1
+                self.db.execute(
+                    "update [{}] set state = ?, next_attempt_at = ?, "
+                    "lease_owner = null, lease_expires = null, last_error = ?, "
+                    "updated_at = ? where item_id = ?".format(self.table),
+                    (
+                        "failed" if attempts >= self.max_attempts else "pending",
+                        now + self.backoff_seconds(attempts),
+                        str(result["categorization"].get("error"))[:1000],
+                        now,
+                        item_id,
+                    ),
+                )
+            self.db.execute(
+                "update [{}] set lease_expires = ? "
+                "where state = 'leased' and lease_owner = ?".format(self.table),
+                (now + self.lease_seconds, self.owner),
+            )
+
+    def release(self):
+        "Hand back unfinished leases, e.g. on Ctrl-C, without using up an attempt"
+        with self.write():
+            return self.db.execute(
+                "update [{}] set state = 'pending', attempts = max(attempts - 1, 0), "
+                "lease_owner = null, lease_expires = null, updated_at = ? "
+                "where state = 'leased' and lease_owner = ?".format(self.table),
+                (time.time(), self.owner),
+            ).rowcount
+
+    def counts(self):
+        return dict(
+            self.db.execute(
+                "select state, count(*) from [{}] group by state".format(self.table)
+            ).fetchall()
+        )
+
+    def summary(self):
+        counts = self.counts()
+        return "Jobs: " + ", ".join(
+            "{} {}".format(counts.get(state, 0), state)
+            for state in ("pending", "leased", "done", "failed")
+        )
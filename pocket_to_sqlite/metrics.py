@@ -0,0 +1,156 @@
+"""
+Counters and histograms for the current run, shared by every thread and
+written out at the end as JSON or in the Prometheus text format, for
+node_exporter's textfile collector.
+
+Histograms whose name ends in _bytes use size buckets, everything else is
+a duration in seconds.
+"""
+import contextlib
+import json
+import os
+import threading
+import time
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = (1e3, 1e4, 3e4, 1e5, 3e5, 1e6, 3e6, 1e7)
+PREFIX = "pocket_to_sqlite_"
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+                break
+
+    def to_dict(self):
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(self.buckets, self.bucket_counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else None,
+            "min": self.min,
+            "max": self.max,
+            "buckets": buckets,
+        }
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.counters = {}
+            self.histograms = {}
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(
+                    BYTES_BUCKETS if name.endswith("_bytes") else SECONDS_BUCKETS
+                )
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "started_at": self.started,
+                "duration_seconds": time.time() - self.started,
+                "counters": dict(sorted(self.counters.items())),
+                "histograms": {
+                    name: histogram.to_dict()
+                    for name, histogram in sorted(self.histograms.items())
+                },
+            }
+
+    def prometheus(self, labels=None):
+        label_text = ",".join(
+            '{}="{}"'.format(key, value) for key, value in sorted((labels or {}).items())
+        )
+
+        def series(name, extra=""):
+            inner = ",".join(part for part in (label_text, extra) if part)
+            return PREFIX + name + ("{" + inner + "}" if inner else "")
+
+        snapshot = self.snapshot()
+        lines = [
+            "# TYPE {}run_duration_seconds gauge".format(PREFIX),
+            "{} {}".format(series("run_duration_seconds"), snapshot["duration_seconds"]),
+            "# TYPE {}run_started_timestamp_seconds gauge".format(PREFIX),
+            "{} {}".format(series("run_started_timestamp_seconds"), snapshot["started_at"]),
+        ]
+        for name, value in snapshot["counters"].items():
+            lines.append("# TYPE {}{}_total counter".format(PREFIX, name))
+            lines.append("{} {}".format(series(name + "_total"), value))
+        for name, histogram in snapshot["histograms"].items():
+            lines.append("# TYPE {}{} histogram".format(PREFIX, name))
+            for bound, count in histogram["buckets"].items():
+                lines.append(
+                    "{} {}".format(series(name + "_bucket", 'le="{}"'.format(bound)), count)
+                )
+            lines.append(
+                "{} {}".format(series(name + "_bucket", 'le="+Inf"'), histogram["count"])
+            )
+            lines.append("{} {}".format(series(name + "_sum"), histogram["sum"]))
+            lines.append("{} {}".format(series(name + "_count"), histogram["count"]))
+        return "\n".join(lines) + "\n"
+
+
+def write_atomically(path, text):
+    # The textfile collector may read at any moment, so never expose a
+    # half-written file
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "w") as fp:
+        fp.write(text)
+    os.replace(tmp_path, path)
+
+
+_registry = Registry()
+inc = _registry.inc
+observe = _registry.observe
+timer = _registry.timer
+reset = _registry.reset
+snapshot = _registry.snapshot
+
+
+def write_json(path, command=None):
+    data = snapshot()
+    data["command"] = command
+    write_atomically(path, json.dumps(data, indent=2) + "\n")
+
+
+def write_prometheus(path, command=None):
+    write_atomically(path, _registry.prometheus({"command": command} if command else None))
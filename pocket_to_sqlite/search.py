@@ -0,0 +1,200 @@
+"""
+Full-text search over items_fts (titles and excerpts) and, optionally,
+pages_fts (categories and text extracted from classified page HTML).
+"""
+import contextlib
+import html.parser
+import re
+from .html_store import HtmlStore
+
+STATUSES = {"unread": 0, "archived": 1, "deleted": 2}
+MAX_TEXT_LENGTH = 200000
+# Pages read and indexed per transaction by index_pages
+INDEX_BATCH_SIZE = 100
+
+
+@contextlib.contextmanager
+def bulk_load(db, table="items"):
+    """
+    Drop the triggers that keep table's FTS index in sync while a bulk write
+    runs, then put them back and rebuild the index once at the end instead
+    of updating it row by row.
+    """
+    fts_table = table + "_fts"
+    if fts_table not in db.table_names():
+        yield
+        return
+    triggers = [
+        (name, sql)
+        for name, sql in db.execute(
+            "select name, sql from sqlite_master where type = 'trigger' and tbl_name = ?",
+            (table,),
+        ).fetchall()
+        if fts_table in sql
+    ]
+    with db.atomic():
+        for name, _ in triggers:
+            db.execute("drop trigger [{}]".format(name))
+    # If we never get to the finally below, utils.ensure_fts finds the
+    # triggers missing and rebuilds the index
+    try:
+        yield
+    finally:
+        with db.atomic():
+            for _, sql in triggers:
+                db.execute(sql)
+            db.execute(
+                "insert into [{0}]([{0}]) values('rebuild')".format(fts_table)
+            )
+            db.execute(
+                "insert into [{0}]([{0}]) values('optimize')".format(fts_table)
+            )
+
+
+class TextExtractor(html.parser.HTMLParser):
+    skip_tags = {"script", "style", "noscript", "template", "svg", "head"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.skip_tags:
+            self.skipping += 1
+
+    def handle_endtag(self, tag):
+        if tag in self.skip_tags and self.skipping:
+            self.skipping -= 1
+
+    def handle_data(self, data):
+        if not self.skipping:
+            self.parts.append(data)
+
+
+def extract_text(html):
+    "Visible text of a page with whitespace collapsed"
+    parser = TextExtractor()
+    parser.feed(html)
+    parser.close()
+    return re.sub(r"\s+", " ", " ".join(parser.parts)).strip()[:MAX_TEXT_LENGTH]
+
+
+def ensure_pages_fts(db):
+    db.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS [pages_fts] USING FTS5 ([top_category], [text])"
+    )
+    db.conn.commit()
+
+
+def index_pages(db, batch_size=INDEX_BATCH_SIZE):
+    """
+    Add text extracted from the stored HTML of every classified item that
+    isn't in pages_fts yet, batch_size pages at a time so only one batch of
+    HTML is in memory. Returns the number of pages indexed.
+    """
+    ensure_pages_fts(db)
+    sql = (
+        "select auto_tags.item_id, auto_tags.top_category, html.content, html.compression "
+        "from auto_tags join [{}] html on html.html_md5 = auto_tags.html_md5 "
+        "where auto_tags.item_id > ? "
+        "and auto_tags.item_id not in (select rowid from pages_fts) "
+        "order by auto_tags.item_id limit ?".format(HtmlStore.table)
+    )
+    indexed, last_id = 0, -1
+    while True:
+        rows = db.execute(sql, (last_id, batch_size)).fetchall()
+        if not rows:
+            return indexed
+        with db.atomic():
+            db.conn.executemany(
+                "insert into pages_fts (rowid, top_category, text) values (?, ?, ?)",
+                (
+                    (
+                        item_id,
+                        top_category,
+                        extract_text(
+                            HtmlStore.decompress(content, compression).decode(
+                                "utf-8", "replace"
+                            )
+                        ),
+                    )
+                    for item_id, top_category, content, compression in rows
+                ),
+            )
+        indexed += len(rows)
+        last_id = rows[-1][0]
+
+
+def search(db, q, category=None, status=None, text=False, limit=20):
+    """
+    bm25-ranked matches for q, best first, as dicts with a highlighted
+    snippet. Titles count for more than excerpts. With text, matches in
+    pages_fts are merged in and each item keeps its best-ranked snippet.
+    """
+    tables = {"items_fts": "5.0, 1.0"}
+    if text and "pages_fts" in db.table_names():
+        tables["pages_fts"] = "2.0, 1.0"
+    where = []
+    params = {"q": q, "limit": limit}
+    if category is not None:
+        where.append("auto_tags.top_category = :category")
+        params["category"] = category
+    if status is not None:
+        where.append("items.status = :status")
+        params["status"] = STATUSES.get(status, status)
+    has_auto_tags = db["auto_tags"].exists()
+    if category is not None and not has_auto_tags:
+        return []
+    sql = """
+        -- bm25() only works in the query against the FTS table itself, so
+        -- that must not be flattened into the group by. A LIMIT keeps it
+        -- apart on every SQLite, where MATERIALIZED needs 3.35+
+        with matches as ({matches} limit -1),
+        best as (
+            -- SQLite takes bare columns from the row that has the min()
+            select item_id, min(rank) as rank, source from matches group by item_id
+        )
+        select items.item_id, items.resolved_title, items.resolved_url,
+            {category} as top_category, best.rank, best.source
+        from best
+        join items on items.item_id = best.item_id
+        {join}
+        {where}
+        order by best.rank
+        limit :limit
+    """.format(
+        matches=" union all ".join(
+            "select rowid as item_id, bm25({0}, {1}) as rank, '{0}' as source "
+            "from {0} where {0} match :q".format(table, weights)
+            for table, weights in tables.items()
+        ),
+        category="auto_tags.top_category" if has_auto_tags else "null",
+        join="left join auto_tags on auto_tags.item_id = items.item_id"
+        if has_auto_tags
+        else "",
+        where="where " + " and ".join(where) if where else "",
+    )
+    cursor = db.execute(sql, params)
+    columns = [c[0] for c in cursor.description]
+    results = [dict(zip(columns, row)) for row in cursor.fetchall()]
+    # Snippets are expensive, so only make them for the results returned
+    for table in tables:
+        item_ids = [r["item_id"] for r in results if r["source"] == table]
+        if not item_ids:
+            continue
+        snippets = dict(
+            db.execute(
+                "select rowid, snippet({0}, -1, '[', ']', '...', 12) from {0} "
+                "where {0} match ? and rowid in ({1})".format(
+                    table, ", ".join("?" for _ in item_ids)
+                ),
+                [q] + item_ids,
+            ).fetchall()
+        )
+        for result in results:
+            if result["source"] == table:
+                result["snippet"] = snippets.get(result["item_id"])
+    for result in results:
+        del result["source"]
+    return results
@@ -0,0 +1,216 @@
+"""
+Small summary tables for Datasette's canned queries: items per
+top_category, per month of time_added, per status and per domain of
+resolved_url.
+
+They are kept up to date by triggers on items and auto_tags, so every
+writer (fetch, import, autotag or anything else) adjusts the counts in the
+same transaction as the rows it writes, and page views read a few hundred
+rows instead of aggregating the whole database. rebuild_summaries
+recomputes them from scratch.
+"""
+import contextlib
+from . import utils
+
+DELETED = 2
+
+
+def domain_sql(url):
+    "SQL for the lowercased host of url, without www. or a port"
+    rest = "case when instr({0}, '://') then substr({0}, instr({0}, '://') + 3) else {0} end".format(url)
+    return (
+        "(select case when host like 'www.%' then substr(host, 5) else host end from "
+        "(select substr(hostport, 1, instr(hostport || ':', ':') - 1) as host from "
+        "(select lower(substr(rest, 1, instr(rest || '/', '/') - 1)) as hostport from "
+        "(select {} as rest))))".format(rest)
+    )
+
+
+# (summary table, key column, key type, source table, key expression,
+# condition); {row} in the expressions stands for the source row
+SUMMARIES = (
+    (
+        "summary_categories",
+        "top_category",
+        "TEXT",
+        "auto_tags",
+        "{row}.top_category",
+        "{row}.error is null and {row}.top_category is not null",
+    ),
+    (
+        "summary_months",
+        "month",
+        "TEXT",
+        "items",
+        "coalesce(strftime('%Y-%m', {row}.time_added, 'unixepoch'), '')",
+        "coalesce({row}.status, 0) != %d" % DELETED,
+    ),
+    (
+        "summary_statuses",
+        "status",
+        "INTEGER",
+        "items",
+        "coalesce({row}.status, 0)",
+        "1",
+    ),
+    (
+        "summary_domains",
+        "domain",
+        "TEXT",
+        "items",
+        "coalesce({}, '')".format(
+            domain_sql("coalesce(nullif({row}.resolved_url, ''), {row}.given_url, '')")
+        ),
+        "coalesce({row}.status, 0) != %d" % DELETED,
+    ),
+)
+# The source columns the summaries read, which the triggers need to exist
+SOURCE_COLUMNS = {
+    "items": {"status": int, "time_added": int, "resolved_url": str, "given_url": str},
+    "auto_tags": {"top_category": str, "error": str},
+}
+
+
+def summaries_of(source):
+    return [summary for summary in SUMMARIES if summary[3] == source]
+
+
+def increment_sql(summary, row):
+    table, key, _, _, expression, condition = summary
+    return (
+        "INSERT INTO [{0}] ([{1}], items) SELECT {2}, 1 WHERE {3} "
+        "ON CONFLICT ([{1}]) DO UPDATE SET items = items + 1;".format(
+            table, key, expression.format(row=row), condition.format(row=row)
+        )
+    )
+
+
+def decrement_sql(summary, row):
+    table, key, _, _, expression, condition = summary
+    key_sql = "[{}] = {}".format(key, expression.format(row=row))
+    return (
+        "UPDATE [{0}] SET items = items - 1 WHERE {1} AND {2};\n"
+        "    DELETE FROM [{0}] WHERE {1} AND items <= 0;".format(
+            table, key_sql, condition.format(row=row)
+        )
+    )
+
+
+def trigger_sql(source):
+    "{trigger name: CREATE TRIGGER statement} keeping source's summaries in sync"
+    summaries = summaries_of(source)
+    increments = "\n    ".join(increment_sql(summary, "new") for summary in summaries)
+    decrements = "\n    ".join(decrement_sql(summary, "old") for summary in summaries)
+    columns = sorted(SOURCE_COLUMNS[source])
+    changed = " OR ".join("old.[{0}] IS NOT new.[{0}]".format(column) for column in columns)
+    name = "summaries_{}_".format(source)
+    return {
+        name + "insert": "CREATE TRIGGER [{}insert] AFTER INSERT ON [{}] BEGIN\n    {}\nEND".format(
+            name, source, increments
+        ),
+        name + "delete": "CREATE TRIGGER [{}delete] AFTER DELETE ON [{}] BEGIN\n    {}\nEND".format(
+            name, source, decrements
+        ),
+        # Only rows whose summarized columns changed, not every upsert
+        name + "update": (
+            "CREATE TRIGGER [{}update] AFTER UPDATE OF {} ON [{}] WHEN {} BEGIN\n"
+            "    {}\n    {}\nEND".format(
+                name,
+                ", ".join("[{}]".format(column) for column in columns),
+                source,
+                changed,
+                decrements,
+                increments,
+            )
+        ),
+    }
+
+
+def create_tables(db, source):
+    for table, key, key_type, _, _, _ in summaries_of(source):
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS [{}] ([{}] {} PRIMARY KEY NOT NULL, [items] INTEGER NOT NULL)".format(
+                table, key, key_type
+            )
+        )
+
+
+def rebuild(db, source):
+    counts = {}
+    for summary in summaries_of(source):
+        table, key, _, _, expression, condition = summary
+        db.execute("DELETE FROM [{}]".format(table))
+        db.execute(
+            "INSERT INTO [{}] ([{}], items) SELECT {}, count(*) FROM [{}] WHERE {} GROUP BY 1".format(
+                table,
+                key,
+                expression.format(row=source),
+                source,
+                condition.format(row=source),
+            )
+        )
+        counts[table] = db.execute("select count(*) from [{}]".format(table)).fetchone()[0]
+    return counts
+
+
+def stored_triggers(db, source):
+    return dict(
+        db.execute(
+            "select name, sql from sqlite_master where type = 'trigger' "
+            "and tbl_name = ? and name like 'summaries\\_%' escape '\\'",
+            (source,),
+        ).fetchall()
+    )
+
+
+def ensure_summaries(db, force=False):
+    """
+    Create the summary tables and their triggers for whichever of items and
+    auto_tags exist. Summaries are rebuilt whenever their triggers had to be
+    (re)created, which covers new databases, databases from before summary
+    tables and tables rebuilt by a migration, or always with force. Returns
+    {summary table: rows} for the summaries that were rebuilt.
+    """
+    rebuilt = {}
+    for source, columns in SOURCE_COLUMNS.items():
+        if not db[source].exists():
+            continue
+        triggers = trigger_sql(source)
+        if not force and stored_triggers(db, source) == triggers:
+            continue
+        existing = db[source].columns_dict
+        for column, column_type in columns.items():
+            if column not in existing:
+                db[source].add_column(column, column_type)
+        with utils.write_transaction(db):
+            for name in stored_triggers(db, source):
+                db.execute("DROP TRIGGER [{}]".format(name))
+            create_tables(db, source)
+            for sql in triggers.values():
+                db.execute(sql)
+            rebuilt.update(rebuild(db, source))
+    return rebuilt
+
+
+def rebuild_summaries(db):
+    "Recompute every summary table from scratch"
+    return ensure_summaries(db, force=True)
+
+
+@contextlib.contextmanager
+def bulk_load(db, source="items"):
+    """
+    Drop source's summary triggers while a bulk write runs and rebuild its
+    summaries once at the end, which is quicker than a trigger per row.
+    """
+    triggers = stored_triggers(db, source)
+    if not triggers:
+        yield
+        return
+    with db.atomic():
+        for name in triggers:
+            db.execute("DROP TRIGGER [{}]".format(name))
+    try:
+        yield
+    finally:
+        ensure_summaries(db)
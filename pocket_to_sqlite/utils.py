@@ -1,166 +1,434 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+import contextlib
 import datetime
-import requests
+import itertools
 import json
+import os
+import requests
+import sqlite3
 import time
-from homepage2vec.model import WebsiteClassifier, Webpage
+import sqlite_utils
 from sqlite_utils.db import AlterError, ForeignKey
 import hashlib
-import os
+import threading
+from . import downloader, http_client, metrics
+from .embeddings import pack as pack_embeddings
+
+# Overridable so fetch and autotag-sync can run against a stand-in API
+POCKET_API_URL = os.environ.get("POCKET_API_URL", "https://getpocket.com/v3")
+
+_model = None
+_model_lock = threading.Lock()
+
+
+def get_model():
+    """
+    Load the homepage2vec classifier on first use. Importing homepage2vec
+    pulls in torch and the model weights, which commands that never classify
+    anything shouldn't pay for.
+    """
+    global _model
+    with _model_lock:
+        if _model is None:
+            from homepage2vec.model import WebsiteClassifier
+
+            _model = WebsiteClassifier()
+        return _model
+
+# Pragmas applied to every connection the CLI opens. Both use WAL so that
+# Datasette can read while fetch or autotag write; fast trades durability of
+# the last few commits on power loss for far fewer fsyncs.
+DB_PROFILES = {
+    "fast": {
+        "journal_mode": "wal",
+        "synchronous": "normal",
+        "cache_size": -64000,
+        "mmap_size": 256 * 1024 * 1024,
+        "temp_store": "memory",
+        "busy_timeout": 30000,
+    },
+    "safe": {
+        "journal_mode": "wal",
+        "synchronous": "full",
+        "busy_timeout": 30000,
+    },
+}
+
+
+def open_database(db_path, profile="fast"):
+    db = sqlite_utils.Database(db_path)
+    for pragma, value in DB_PROFILES[profile].items():
+        db.execute("pragma {} = {}".format(pragma, value))
+    return db
+
+
+def finish_database(db):
+    "Refresh planner statistics and checkpoint the WAL at the end of a run"
+    db.execute("pragma optimize")
+    if db.execute("pragma journal_mode").fetchone()[0] == "wal":
+        # PASSIVE doesn't wait on readers such as Datasette
+        db.execute("pragma wal_checkpoint(PASSIVE)")
+
+
+@contextlib.contextmanager
+def write_transaction(db):
+    """
+    db.atomic(), but taking the write lock up front with BEGIN IMMEDIATE, so
+    concurrent writers wait on busy_timeout rather than failing to upgrade
+    a read lock part way through.
+    """
+    started = not db.conn.in_transaction
+    if started:
+        db.conn.execute("BEGIN IMMEDIATE")
+    try:
+        # A savepoint inside the transaction begun above
+        with db.atomic():
+            yield
+    except BaseException:
+        if started:
+            db.rollback()
+        raise
+    if started:
+        db.commit()
 
-model = WebsiteClassifier()
 
-def save_items(items, db):
-    for item in items:
-        transform(item)
-        authors = item.pop("authors", None)
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            break
+        yield chunk
+
+
+# Fields Pocket changes without the item itself changing: time_updated is
+# bumped on every sync and sort_id is the position in the response
+DIGEST_IGNORE = ("time_updated", "sort_id", "digest")
+DELETED = 2
+# Tables keyed by item_id whose rows follow an item imported from a Pocket
+# export (archive.export_item_id) to its real ID once the API sends it
+ITEM_KEYED_TABLES = ("auto_tags", "autotag_jobs")
+
+
+def item_digest(item, authors):
+    "Hash of a transformed item and its authors, for skipping unchanged rows"
+    content = {key: value for key, value in item.items() if key not in DIGEST_IGNORE}
+    content["authors"] = sorted(authors, key=lambda author: author["author_id"])
+    return hashlib.sha1(
+        json.dumps(content, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+def stored_digests(db, item_ids, has_digest):
+    "item_id -> stored digest (None for rows older versions wrote) of those already saved"
+    digests = {}
+    for chunk in chunks(item_ids, 500):
+        digests.update(
+            db.execute(
+                "select item_id, {} from items where item_id in ({})".format(
+                    "digest" if has_digest else "null",
+                    ", ".join("?" for _ in chunk),
+                ),
+                chunk,
+            ).fetchall()
+        )
+    return digests
+
+
+def export_items_replaced(db, items):
+    "(export item_id, real item_id) of stored export items that items have the URL of"
+    real_ids = {
+        item["given_url"]: item["item_id"]
+        for item in items
+        if item["item_id"] > 0 and item.get("given_url")
+    }
+    replaced = []
+    for urls in chunks(list(real_ids), 500):
+        for item_id, url in db.execute(
+            "select item_id, given_url from items where item_id < 0 "
+            "and given_url in ({})".format(", ".join("?" for _ in urls)),
+            urls,
+        ):
+            replaced.append((item_id, real_ids[url]))
+    return replaced
+
+
+def save_items(items, db, batch_size=500):
+    """
+    Insert new items, update changed ones in place and skip the ones whose
+    digest matches what is stored. Stored items that come back deleted
+    (status 2) only have their status and time_updated set; deleted items
+    we have never seen are inserted as they are. An item imported from a
+    Pocket export is replaced by the API's version of the same URL.
+    Returns counts of inserted, updated, deleted and skipped.
+    """
+    counts = {"inserted": 0, "updated": 0, "deleted": 0, "skipped": 0}
+    items_columns = set(db["items"].columns_dict) if db["items"].exists() else set()
+    # item_id is the rowid, so this is one seek
+    has_export_items = "given_url" in items_columns and bool(
+        db.execute("select 1 from items where item_id < 0 limit 1").fetchone()
+    )
+    for chunk in chunks(items, batch_size):
+        items_to_save = []
+        authors_by_item = {}
+        chunk_columns = set()
+        for item in chunk:
+            transform(item)
+            authors = item.pop("authors", None)
+            item_authors = []
+            if authors:
+                for details in authors.values():
+                    item_authors.append(
+                        {
+                            "author_id": int(details["author_id"]),
+                            "item_id": int(details["item_id"]),
+                            "name": details["name"],
+                            "url": details["url"],
+                        }
+                    )
+            item["digest"] = item_digest(item, item_authors)
+            authors_by_item[item["item_id"]] = item_authors
+            chunk_columns.update(item.keys())
+            items_to_save.append(item)
+        existing = {}
+        if items_columns:
+            existing = stored_digests(
+                db,
+                [item["item_id"] for item in items_to_save],
+                "digest" in items_columns,
+            )
+        new_items = []
+        changed_items = []
+        deleted_items = []
+        for item in items_to_save:
+            if item["item_id"] not in existing:
+                new_items.append(item)
+            elif item.get("status") == DELETED:
+                deleted_items.append(item)
+            elif existing[item["item_id"]] != item["digest"]:
+                changed_items.append(item)
+        replaced = export_items_replaced(db, new_items) if has_export_items else []
+        if changed_items:
+            # Like the row replace this used to be, columns the new version
+            # doesn't have are cleared rather than keeping stale values
+            columns = items_columns | chunk_columns
+            changed_items = [
+                dict({column: None for column in columns}, **item) for item in changed_items
+            ]
+        authors_to_save = []
         items_authors_to_save = []
-        if authors:
-            authors_to_save = []
-            for details in authors.values():
+        for item in new_items + changed_items:
+            for author in authors_by_item[item["item_id"]]:
                 authors_to_save.append(
-                    {
-                        "author_id": int(details["author_id"]),
-                        "name": details["name"],
-                        "url": details["url"],
-                    }
+                    {key: author[key] for key in ("author_id", "name", "url")}
                 )
                 items_authors_to_save.append(
-                    {
-                        "author_id": int(details["author_id"]),
-                        "item_id": int(details["item_id"]),
-                    }
+                    {"author_id": author["author_id"], "item_id": author["item_id"]}
                 )
-            db["authors"].insert_all(authors_to_save, pk="author_id", replace=True)
-        db["items"].insert(item, pk="item_id", alter=True, replace=True)
-        if items_authors_to_save:
-            db["items_authors"].insert_all(
-                items_authors_to_save,
-                pk=("author_id", "item_id"),
-                foreign_keys=("author_id", "item_id"),
-                replace=True,
-            )
+        # Only pay for schema introspection when this chunk brings new columns
+        alter = not chunk_columns.issubset(items_columns)
+        with metrics.timer("db_write_seconds"), db.atomic():
+            if authors_to_save:
+                db["authors"].insert_all(
+                    authors_to_save,
+                    pk="author_id",
+                    replace=True,
+                    batch_size=batch_size,
+                )
+            if new_items:
+                db["items"].insert_all(
+                    new_items,
+                    pk="item_id",
+                    alter=alter,
+                    replace=True,
+                    batch_size=batch_size,
+                )
+            if changed_items:
+                # An upsert updates the row in place, so the FTS update
+                # trigger fires once instead of a delete plus an insert
+                db["items"].upsert_all(
+                    changed_items,
+                    pk="item_id",
+                    alter=alter,
+                    batch_size=batch_size,
+                )
+                changed_ids = [item["item_id"] for item in changed_items]
+                if db["items_authors"].exists():
+                    for ids in chunks(changed_ids, 500):
+                        db.execute(
+                            "delete from items_authors where item_id in ({})".format(
+                                ", ".join("?" for _ in ids)
+                            ),
+                            ids,
+                        )
+            if items_authors_to_save:
+                db["items_authors"].insert_all(
+                    items_authors_to_save,
+                    pk=("author_id", "item_id"),
+                    foreign_keys=("author_id", "item_id"),
+                    replace=True,
+                    batch_size=batch_size,
+                )
+            for export_id, item_id in replaced:
+                for table in ITEM_KEYED_TABLES:
+                    if db[table].exists():
+                        db.execute(
+                            "update or ignore [{}] set item_id = ? where item_id = ?".format(table),
+                            (item_id, export_id),
+                        )
+                        db.execute(
+                            "delete from [{}] where item_id = ?".format(table), (export_id,)
+                        )
+                db.execute("delete from items where item_id = ?", (export_id,))
+            deleted = 0
+            if deleted_items:
+                assignments = "status = {}".format(DELETED)
+                params = [(item["item_id"],) for item in deleted_items]
+                if "time_updated" in items_columns:
+                    # Minimal deletion records may not carry time_updated
+                    assignments += ", time_updated = coalesce(?, time_updated)"
+                    params = [(item.get("time_updated"), item["item_id"]) for item in deleted_items]
+                deleted = db.conn.executemany(
+                    "update items set {} where status is not {} and item_id = ?".format(
+                        assignments, DELETED
+                    ),
+                    params,
+                ).rowcount
+        items_columns.update(chunk_columns)
+        counts["inserted"] += len(new_items)
+        counts["updated"] += len(changed_items)
+        counts["deleted"] += deleted
+        counts["skipped"] += len(items_to_save) - len(new_items) - len(changed_items) - deleted
+    for key, value in counts.items():
+        metrics.inc("items_{}".format(key), value)
+    return counts
 
-def write_labels_to_pocket(autoclassification,auth, db):
-    item_id = autoclassification["item_id"]
-    top_category = "autotag-{}".format(autoclassification["top_category"]).lower()
-
-    print("Writing tag {} to item {}".format(top_category, item_id))
-    args = {
-        "consumer_key": auth["pocket_consumer_key"],
-        "access_token": auth["pocket_access_token"],
-        "actions": json.dumps(
-            [
-                {
-                    "action": "tags_add",
-                    "item_id": item_id,
-                    "tags": top_category,
-                }
-            ]
-        ),
+
+def tag_action(autoclassification):
+    return {
+        "action": "tags_add",
+        "item_id": autoclassification["item_id"],
+        "tags": "autotag-{}".format(autoclassification["top_category"]).lower(),
     }
 
-    # print(args)
-    response = requests.get("https://getpocket.com/v3/send", args)
-    print ("result {}".format(response.text))
-    # Extend the items with synced=1
-    db["auto_tags"].update(
-        item_id, {"synced": 1}
-    )
 
+def send_actions(actions, auth, api_url=POCKET_API_URL):
+    "POST a list of actions to /v3/send and return a success flag per action"
+    with metrics.timer("pocket_send_seconds"):
+        response = http_client.get_session().post(
+            api_url + "/send",
+            data={
+                "consumer_key": auth["pocket_consumer_key"],
+                "access_token": auth["pocket_access_token"],
+                "actions": json.dumps(actions),
+            },
+        )
+    response.raise_for_status()
+    results = response.json().get("action_results") or []
+    results = [bool(result) for result in results]
+    return results + [False] * (len(actions) - len(results))
 
-def categorize_item(item, categorize_url, save_html):
-    # assign resolve_url to either resolved_url or given_url
-    resolved_url = item.get("resolved_url", item.get("given_url"))
 
-    if (resolved_url is None):
-        return {
-            "error": True,
-            "categorization": {
-                "item_id": item["item_id"],
-                "error": "No resolved_url or given_url",
-            }
-        }
+def send_tag_batch(
+    autoclassifications, auth, retries=2, retry_sleep=3, api_url=POCKET_API_URL
+):
+    """
+    Send tags_add actions for a batch of auto_tags rows, retrying only the
+    actions that failed. Returns (synced item_ids, failed item_ids).
+    """
+    remaining = list(autoclassifications)
+    synced = []
+    for attempt in range(retries + 1):
+        if attempt:
+            metrics.inc("pocket_send_retries")
+            time.sleep(attempt * retry_sleep)
+        try:
+            results = send_actions(
+                [tag_action(row) for row in remaining], auth, api_url=api_url
+            )
+        except requests.RequestException as ex:
+            metrics.inc("pocket_send_errors")
+            print("Error sending {} tags: {}".format(len(remaining), ex))
+            continue
+        synced.extend(row["item_id"] for row, ok in zip(remaining, results) if ok)
+        remaining = [row for row, ok in zip(remaining, results) if not ok]
+        if not remaining:
+            break
+    return synced, [row["item_id"] for row in remaining]
 
-    req = False
-    err = False
-    html = False
 
-    try:
-        # Fetch the content of the page to save it in the database
-        req = requests.get(resolved_url, timeout=10)
-        html = req.text
-        if req.status_code != 200:
-            err = "Status " + str(req.status_code) + " " + html
-    except Exception as inst:
-        err = str(inst)
-        print(err)
-
-    if err:
-        return {
-            "error": True,
-            "categorization": {
-                "item_id": item["item_id"],
-                "error": err
-            }
+def mark_synced(db, item_ids):
+    with metrics.timer("db_write_seconds"), db.atomic():
+        for chunk in chunks(item_ids, 500):
+            db.execute(
+                "update auto_tags set synced = 1 where item_id in ({})".format(
+                    ", ".join("?" for _ in chunk)
+                ),
+                chunk,
+            )
+
+
+def sync_labels_to_pocket(
+    autoclassifications,
+    auth,
+    db,
+    batch_size=100,
+    concurrency=1,
+    retries=2,
+    retry_sleep=3,
+    api_url=POCKET_API_URL,
+):
+    """
+    Write auto_tags top categories back to Pocket as tags, many actions per
+    /v3/send request. Only the actions Pocket reports as successful are
+    marked synced. Returns (num_synced, num_failed).
+    """
+    num_synced = 0
+    num_failed = 0
+    # HTTP happens on the pool; the SQLite writes stay on this thread
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [
+            executor.submit(
+                send_tag_batch,
+                batch,
+                auth,
+                retries=retries,
+                retry_sleep=retry_sleep,
+                api_url=api_url,
+            )
+            for batch in chunks(autoclassifications, batch_size)
+        ]
+        for future in as_completed(futures):
+            synced, failed = future.result()
+            mark_synced(db, synced)
+            num_synced += len(synced)
+            num_failed += len(failed)
+            metrics.inc("tags_synced", len(synced))
+            metrics.inc("tags_failed", len(failed))
+            print("Synced {} tags, {} failed".format(num_synced, num_failed))
+    return num_synced, num_failed
+
+
+def error_result(item, err):
+    return {
+        "error": True,
+        "categorization": {
+            "item_id": item["item_id"],
+            "error": err
         }
+    }
 
-    print("Received {} chars from {}".format(str(len(html)), resolved_url))
-
-    if save_html:
-        # Save html to a file, using an escaped version of resolve_url
-        # as the filename
-        # Save html to a file using a cleaned up version of the url
-        valid_chars = '-_.() abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
-        filename = save_html + "/" +''.join(c for c in resolved_url.replace("/", "_") if c in valid_chars)
-        os.makedirs(os.path.dirname(filename), exist_ok=True)
-
-        with open(filename, "w") as f:
-            f.write(html)
-    
-    scores = None
-    embeddings = None
-    process_time = time.time()
-
-    if not categorize_url:
-        website = Webpage(item["resolved_url"])
-        website.html = html
-        scores, embeddings = model.predict(website)
-        process_time = time.time() - process_time
-        print("Predicted locally in {:.2f} seconds".format(process_time))
-    else:
-        try:
-            # Send the request to the homepage2vec server
-            req = requests.post(categorize_url,
-                headers={
-                    'accept': 'application/json',
-                    'Content-Type': 'application/json',
-                    'Authorization': 'Bearer 1234',
-                },
-                json={
-                    "url": resolved_url,
-                    "html": html
-                })
-            if req.status_code != 200:
-                err = "Status " + str(req.status_code) + " " + req.text
-        except Exception as inst:
-            err = str(inst)
-            print(err)
-
-        if err:
-            return {
-                "error": True,
-                "categorization": {
-                    "item_id": item["item_id"],
-                    "error": err
-                }
-            }
-
-        process_time = time.time() - process_time
-        print("Predicted remotely in {:.2f} seconds".format(process_time))
-        json = req.json()
-        scores = json["scores"]
-        embeddings = json["embeddings"]
 
+def download_page(resolved_url, validators=None):
+    """
+    Fetch a single page, returning (html, error) with exactly one of them
+    set. categorize_items keeps one PageDownloader for the whole run instead.
+    """
+    with downloader.PageDownloader(validators=validators) as pages:
+        return pages.submit(resolved_url).result()
+
+
+def categorized_result(item, resolved_url, html, scores, embeddings, process_time):
     # Given "scores" as a generator that looks like {"Arts": 0.6156846880912781, "Business": 0.3619343638420105, "Computers": 0.8148682117462158, "Games": 0.28710833191871643, "Health": 0.4017010033130646, "Home": 0.22346019744873047, "Kids_and_Teens": 0.306125283241272, "News": 0.7160046696662903, "Recreation": 0.2587287724018097, "Reference": 0.6425570249557495, "Science": 0.7425054311752319, "Shopping": 0.17683619260787964, "Society": 0.6040355563163757, "Sports": 0.08852018415927887}
     # Return a list of categories that have a score of 0.5 or higher
     # e.g. ["Arts", "Computers", "News", "Reference", "Science", "Society"]
@@ -180,13 +448,345 @@ def categorize_item(item, categorize_url, save_html):
         "created_at": datetime.datetime.now(),
         "synced": False,
     }
-    print("Top category for {} (item id {}): {}".format(resolved_url, item["item_id"], top_category))
 
     return {
         "error": False,
+        "url": resolved_url,
         "categorization": categorization
     }
 
+
+def create_auto_tags_table(db):
+    db.execute("""
+        CREATE TABLE [auto_tags] (
+        [item_id] INTEGER PRIMARY KEY REFERENCES [items]([item_id]),
+        [error] TEXT,
+        [html_md5] TEXT,
+        [likely_categories] TEXT,
+        [top_category] TEXT,
+        [scores] TEXT,
+        [embeddings] BLOB,
+        [embedding_format] TEXT,
+        [process_time] FLOAT,
+        [created_at] TEXT,
+        [synced] INTEGER
+    )""")
+
+
+UNSYNCED_SQL = "select item_id, top_category from auto_tags where synced <> 1 and error is null"
+
+# (table, index name, columns, partial index condition)
+INDEXES = (
+    ("items", "idx_items_status", "[status]", None),
+    ("auto_tags", "idx_auto_tags_top_category", "[top_category], [error]", None),
+    (
+        "auto_tags",
+        "idx_auto_tags_unsynced",
+        "[item_id], [top_category]",
+        "synced <> 1 and error is null",
+    ),
+    ("auto_tags", "idx_auto_tags_errors", "[item_id]", "error is not null"),
+)
+
+
+def ensure_indexes(db):
+    "Create the indexes the autotag, autotag-sync and canned queries rely on"
+    for table, name, columns, where in INDEXES:
+        if db[table].exists():
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS [{}] ON [{}] ({}){}".format(
+                    name, table, columns, " WHERE " + where if where else ""
+                )
+            )
+    db.conn.commit()
+
+
+def hot_queries():
+    "(description, sql) of the queries that run against the whole database"
+    return [
+        (
+            "autotag: items to classify",
+            "select item_id, resolved_url, given_url from items where "
+            + uncategorized_where(),
+        ),
+        (
+            "autotag --errors: items to retry",
+            "select item_id, resolved_url, given_url from items where "
+            + uncategorized_where(errors=True),
+        ),
+        ("autotag-sync: tags to send", UNSYNCED_SQL),
+        (
+            "rebuild-summaries: items per category",
+            "select count(*) c, top_category from auto_tags where error is null "
+            "group by top_category order by c desc",
+        ),
+        (
+            "metadata.json: items in one category",
+            "select auto_tags.top_category, items.item_id, items.resolved_url "
+            "from auto_tags inner join items on auto_tags.item_id = items.item_id "
+            "where auto_tags.top_category = 'Arts'",
+        ),
+    ]
+
+
+def explain_queries(db):
+    "Print EXPLAIN QUERY PLAN, row count and run time of each hot query"
+    for description, sql in hot_queries():
+        print(description)
+        print("  " + sql)
+        try:
+            plan = db.execute("explain query plan " + sql).fetchall()
+        except sqlite3.OperationalError as ex:
+            # e.g. auto_tags doesn't exist yet
+            print("  skipped: {}".format(ex))
+            continue
+        for row in plan:
+            print("    " + row[-1])
+        start = time.perf_counter()
+        count = len(db.execute(sql).fetchall())
+        print("  {} rows in {:.2f}ms".format(count, (time.perf_counter() - start) * 1000))
+
+
+def save_categorizations(db, categorize_results, html_store, embedding_format="float32"):
+    """
+    Upsert categorize_items results into auto_tags in one transaction, with
+    the page html going to the HtmlStore rather than inline and embeddings
+    packed into a BLOB.
+    """
+    pages = []
+    # Error results only carry item_id and error; upserting them alongside
+    # full rows would null out the columns they don't have
+    rows_by_columns = {}
+    for categorize_result in categorize_results:
+        categorization = dict(categorize_result["categorization"])
+        html = categorization.pop("html", None)
+        if html is not None:
+            pages.append((html, categorization["html_md5"], categorize_result.get("url")))
+        if categorization.get("embeddings") is not None:
+            categorization["embeddings"] = pack_embeddings(
+                categorization["embeddings"], embedding_format
+            )
+            categorization["embedding_format"] = embedding_format
+        rows_by_columns.setdefault(tuple(sorted(categorization)), []).append(categorization)
+    with db.atomic():
+        html_store.put_all(pages)
+        for rows in rows_by_columns.values():
+            db["auto_tags"].upsert_all(
+                rows,
+                pk="item_id",
+                alter=True,
+                foreign_keys=("items", "item_id"))
+
+
+def save_categorization(db, categorize_result, html_store, embedding_format="float32"):
+    save_categorizations(db, [categorize_result], html_store, embedding_format)
+
+
+def uncategorized_where(errors=False):
+    if errors:
+        # Driven from the small idx_auto_tags_errors partial index
+        return "status = 0 and item_id in (select item_id from auto_tags where error is not null)"
+    # An anti-join probing auto_tags' primary key, rather than NOT IN, which
+    # materializes every auto_tags item_id first
+    return (
+        "status = 0 and not exists "
+        "(select 1 from auto_tags where auto_tags.item_id = items.item_id)"
+    )
+
+
+def work_item(item_id, resolved_url, given_url):
+    item = {"item_id": item_id}
+    # Leave out NULLs so categorize_items falls back to given_url
+    if resolved_url is not None:
+        item["resolved_url"] = resolved_url
+    if given_url is not None:
+        item["given_url"] = given_url
+    return item
+
+
+def predict_batch(pages):
+    """
+    Classify a list of (url, html) pages with the local model, returning a
+    (scores, embeddings) pair per page. homepage2vec extracts features one
+    page at a time, but the classifier forward pass runs once on the stacked
+    feature matrix.
+    """
+    import torch
+    from homepage2vec.model import Webpage
+
+    model = get_model()
+    vectors = []
+    for url, html in pages:
+        website = Webpage(url)
+        website.html = html
+        website.features = model.get_features(url, html, None)
+        vectors.append(torch.FloatTensor(model.concatenate_features(website)))
+    scores, embeddings = model.get_scores(torch.stack(vectors))
+    return [
+        (dict(zip(model.classes, page_scores)), page_embeddings)
+        for page_scores, page_embeddings in zip(
+            torch.sigmoid(scores).tolist(), embeddings.tolist()
+        )
+    ]
+
+
+class StageTimings:
+    "Thread-safe running totals of time spent in each pipeline stage"
+
+    def __init__(self):
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def time(self, stage, count=1):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                calls, items, total = self.stages.get(stage, (0, 0, 0.0))
+                self.stages[stage] = (calls + 1, items + count, total + elapsed)
+            metrics.observe("autotag_{}_seconds".format(stage), elapsed)
+            metrics.inc("autotag_{}_items".format(stage), count)
+
+    def report(self):
+        for stage, (calls, items, total) in self.stages.items():
+            print(
+                "{}: {} items in {} calls, {:.2f}s total, {:.3f}s per item".format(
+                    stage, items, calls, total, total / items if items else 0
+                )
+            )
+
+
+def categorize_items(
+    items,
+    predict=predict_batch,
+    pages=None,
+    batch_size=16,
+    max_wait=2.0,
+    concurrency=1,
+    timings=None,
+    cache=None,
+    validators=None,
+):
+    """
+    Download pages with a PageDownloader while classifying them in batches of
+    up to batch_size, or whatever has arrived after max_wait seconds. predict
+    is a classifier backend's predict method; up to concurrency batches are
+    handed to it at once, so a remote server or process pool with several
+    workers is kept busy. Pages whose content is already in the
+    ClassificationCache skip predict. Cache and database access stay on the
+    calling thread. Yields categorized_result and error_result dicts in
+    completion order.
+
+    Without pages a PageDownloader using validators is made for the call.
+    """
+    timings = timings if timings is not None else StageTimings()
+    own_pages = pages is None
+    if own_pages:
+        pages = downloader.PageDownloader(validators=validators, timings=timings)
+
+    def run_predict(pages):
+        start = time.perf_counter()
+        with timings.time("inference", count=len(pages)):
+            predictions = predict(pages)
+        return predictions, time.perf_counter() - start
+
+    def results(batch, predictions, misses, process_time):
+        for i, ((item, url, html), prediction) in enumerate(zip(batch, predictions)):
+            if isinstance(prediction, Exception):
+                yield error_result(item, str(prediction))
+                continue
+            scores, embeddings = prediction
+            yield categorized_result(
+                item, url, html, scores, embeddings, process_time if i in misses else 0
+            )
+
+    def start_batch(batch):
+        hashes = [hashlib.md5(html.encode("utf-8")).hexdigest() for _, _, html in batch]
+        predictions = [cache.get(html_md5) if cache else None for html_md5 in hashes]
+        misses = [i for i, prediction in enumerate(predictions) if prediction is None]
+        if not misses:
+            return list(results(batch, predictions, misses, 0))
+        future = inference.submit(run_predict, [batch[i][1:] for i in misses])
+        predicting[future] = (batch, hashes, predictions, misses)
+        return []
+
+    def finish_batch(future):
+        batch, hashes, predictions, misses = predicting.pop(future)
+        try:
+            fresh, elapsed = future.result()
+        except Exception as ex:
+            # e.g. the classifier server is down: fail this batch, keep going
+            fresh, elapsed = [ex] * len(misses), 0
+        for i, prediction in zip(misses, fresh):
+            predictions[i] = prediction
+            if cache and not isinstance(prediction, Exception):
+                cache.put(hashes[i], *prediction)
+        return results(batch, predictions, misses, elapsed / len(misses))
+
+    items = iter(items)
+    exhausted = False
+    downloads = {}
+    predicting = {}
+    batch = []
+    batch_started = None
+    # Keep enough downloads queued to fill the next batch while this one runs
+    max_in_flight = pages.max_connections + batch_size * concurrency
+    with contextlib.ExitStack() as stack:
+        if own_pages:
+            stack.callback(pages.close)
+        inference = stack.enter_context(ThreadPoolExecutor(max_workers=concurrency))
+        while True:
+            while not exhausted and len(downloads) + len(batch) < max_in_flight:
+                item = next(items, None)
+                if item is None:
+                    exhausted = True
+                    continue
+                resolved_url = item.get("resolved_url", item.get("given_url"))
+                if resolved_url is None:
+                    yield error_result(item, "No resolved_url or given_url")
+                    continue
+                downloads[pages.submit(resolved_url)] = (item, resolved_url)
+            if not downloads and not batch and not predicting:
+                break
+            can_predict = len(predicting) < concurrency
+            timeout = None
+            if batch and can_predict:
+                timeout = max(0, batch_started + max_wait - time.monotonic())
+            if downloads or predicting:
+                done, _ = wait(
+                    set(downloads) | set(predicting),
+                    timeout=timeout,
+                    return_when=FIRST_COMPLETED,
+                )
+                for future in done:
+                    if future in predicting:
+                        yield from finish_batch(future)
+                        continue
+                    item, url = downloads.pop(future)
+                    html, err = future.result()
+                    if err:
+                        yield error_result(item, err)
+                        continue
+                    if not batch:
+                        batch_started = time.monotonic()
+                    batch.append((item, url, html))
+            while (
+                batch
+                and len(predicting) < concurrency
+                and (
+                    len(batch) >= batch_size
+                    or (exhausted and not downloads)
+                    or time.monotonic() - batch_started >= max_wait
+                )
+            ):
+                yield from start_batch(batch[:batch_size])
+                batch = batch[batch_size:]
+                batch_started = time.monotonic()
+
+
 def transform(item):
     for key in (
         "item_id",
@@ -214,14 +814,18 @@ def transform(item):
 
 
 def ensure_fts(db):
-    if "items_fts" not in db.table_names():
-        db["items"].enable_fts(["resolved_title", "excerpt"], create_triggers=True)
+    """
+    Create items_fts and its triggers. With replace, sqlite-utils also
+    recreates and repopulates an existing index whose triggers are missing,
+    e.g. after a fetch died inside search.bulk_load.
+    """
+    db["items"].enable_fts(["resolved_title", "excerpt"], create_triggers=True, replace=True)
 
 
-def fetch_stats(auth):
-    response = requests.get(
-        "https://getpocket.com/v3/stats",
-        {
+def fetch_stats(auth, api_url=POCKET_API_URL):
+    response = http_client.get_session().get(
+        api_url + "/stats",
+        params={
             "consumer_key": auth["pocket_consumer_key"],
             "access_token": auth["pocket_access_token"],
         },
@@ -230,9 +834,60 @@ def fetch_stats(auth):
     return response.json()
 
 
+class RateLimiter:
+    """
+    Token bucket shared by fetch threads. The refill rate is halved whenever
+    Pocket throttles us (503/429) and grows back towards max_rate on clean
+    responses.
+    """
+
+    def __init__(self, max_rate, burst=1, min_rate=0.05):
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.rate = max_rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+
 class FetchItems:
     def __init__(
-        self, auth, since=None, page_size=500, sleep=2, retry_sleep=3, record_since=None
+        self,
+        auth,
+        since=None,
+        page_size=500,
+        sleep=2,
+        retry_sleep=3,
+        record_since=None,
+        concurrency=1,
+        rate=None,
+        total=None,
+        api_url=POCKET_API_URL,
+        archive=None,
     ):
         self.auth = auth
         self.since = since
@@ -240,31 +895,50 @@ class FetchItems:
         self.sleep = sleep
         self.retry_sleep = retry_sleep
         self.record_since = record_since
+        self.concurrency = concurrency
+        # Requests per second across all threads in parallel mode
+        self.rate = rate or concurrency / (self.sleep or 0.1)
+        self.total = total
+        self.api_url = api_url
+        # An archive.PageArchive to keep every raw response in
+        self.archive = archive
+
+    def page_args(self, offset):
+        args = {
+            "consumer_key": self.auth["pocket_consumer_key"],
+            "access_token": self.auth["pocket_access_token"],
+            "sort": "oldest",
+            "state": "all",
+            "detailType": "complete",
+            "count": self.page_size,
+            "offset": offset,
+        }
+        if self.since is not None:
+            args["since"] = self.since
+        return args
 
     def __iter__(self):
+        if self.concurrency > 1:
+            yield from self.iter_parallel()
+            return
         offset = 0
         retries = 0
         while True:
-            args = {
-                "consumer_key": self.auth["pocket_consumer_key"],
-                "access_token": self.auth["pocket_access_token"],
-                "sort": "oldest",
-                "state": "all",
-                "detailType": "complete",
-                "count": self.page_size,
-                "offset": offset,
-            }
-            if self.since is not None:
-                args["since"] = self.since
-            response = requests.get("https://getpocket.com/v3/get", args)
+            with metrics.timer("pocket_get_seconds"):
+                response = http_client.get_session().get(
+                    self.api_url + "/get", params=self.page_args(offset)
+                )
             if response.status_code == 503 and retries < 5:
                 print("Got a 503, retrying...")
+                metrics.inc("pocket_get_throttled")
                 retries += 1
                 time.sleep(retries * self.retry_sleep)
                 continue
             else:
                 retries = 0
             response.raise_for_status()
+            if self.archive:
+                self.archive.save(offset, response.content)
             page = response.json()
             items = list((page["list"] or {}).values())
             next_since = page["since"]
@@ -276,3 +950,65 @@ class FetchItems:
             offset += self.page_size
             if self.sleep:
                 time.sleep(self.sleep)
+
+    def fetch_page(self, offset, limiter):
+        retries = 0
+        while True:
+            limiter.acquire()
+            with metrics.timer("pocket_get_seconds"):
+                response = http_client.get_session().get(
+                    self.api_url + "/get", params=self.page_args(offset)
+                )
+            if response.status_code in (429, 503) and retries < 5:
+                print("Got a {}, retrying...".format(response.status_code))
+                metrics.inc("pocket_get_throttled")
+                limiter.throttled()
+                retries += 1
+                time.sleep(retries * self.retry_sleep)
+                continue
+            response.raise_for_status()
+            limiter.succeeded()
+            if self.archive:
+                self.archive.save(offset, response.content)
+            return response.json()
+
+    def iter_parallel(self):
+        # Several offset windows are in flight at once, but pages are
+        # yielded strictly in offset order so sort=oldest still holds
+        limiter = RateLimiter(self.rate, burst=self.concurrency)
+        pending = {}
+        next_offset = 0
+        offset = 0
+        run_since = None
+        recorded = None
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            try:
+                while True:
+                    while len(pending) < self.concurrency and (
+                        self.total is None
+                        or next_offset < self.total
+                        or next_offset == offset
+                    ):
+                        pending[next_offset] = executor.submit(
+                            self.fetch_page, next_offset, limiter
+                        )
+                        next_offset += self.page_size
+                    page = pending.pop(offset).result()
+                    # Pages were requested at slightly different times; the
+                    # earliest since is the only one that can't skip changes
+                    since = page["since"]
+                    if since and (run_since is None or since < run_since):
+                        run_since = since
+                    items = list((page["list"] or {}).values())
+                    yield from items
+                    # Checkpoint once each page in offset order has been
+                    # handed on, so an interrupted run doesn't start over
+                    if self.record_since and run_since and run_since != recorded:
+                        self.record_since(run_since)
+                        recorded = run_since
+                    if not items:
+                        break
+                    offset += self.page_size
+            finally:
+                for future in pending.values():
+                    future.cancel()
@@ -34,7 +34,9 @@ setup(
         [console_scripts]
         pocket-to-sqlite=pocket_to_sqlite.cli:cli
     """,
-    install_requires=["sqlite-utils>=2.4.4", "click", "requests", "homepage2vec"],
-    extras_require={"test": ["pytest"]},
+    # sqlite-utils 4 needs Python 3.10
+    python_requires=">=3.10",
+    install_requires=["sqlite-utils>=4.0", "click", "requests", "httpx", "homepage2vec"],
+    extras_require={"test": ["pytest"], "zstd": ["zstandard"], "parquet": ["pyarrow"]},
     tests_require=["pocket-to-sqlite[test]"],
 )
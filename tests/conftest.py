@@ -0,0 +1,87 @@
+"""
+Fixtures for the tests, on top of the servers in fake_servers.py.
+"""
+from http.server import BaseHTTPRequestHandler
+import time
+import pytest
+from fake_servers import FakePocket, start_server, stop_server
+
+
+@pytest.fixture
+def http_server():
+    "http_server(handler) serves handler for the rest of the test and returns its URL"
+    servers = []
+
+    def start(handler):
+        server, url = start_server(handler)
+        servers.append(server)
+        return url
+
+    yield start
+    for server in servers:
+        stop_server(server)
+
+
+@pytest.fixture
+def fake_pocket(http_server):
+    "fake_pocket(num_items, **options) starts a FakePocket with pocket.url set"
+
+    def start(num_items, **options):
+        items = [{"item_id": str(i), "sort_id": i} for i in range(num_items)]
+        pocket = FakePocket(items, **options)
+        pocket.url = http_server(pocket.handler())
+        return pocket
+
+    return start
+
+
+@pytest.fixture(scope="session")
+def page_server():
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            content_type = "text/html"
+            if self.path.startswith("/missing"):
+                self.send_response(404)
+                body = b"Not found"
+            elif self.path.startswith("/down"):
+                self.send_response(503)
+                body = b"Down"
+            elif self.path.startswith("/huge"):
+                self.send_response(200)
+                body = b"<p>" + b"x" * 1000000
+            elif self.path.startswith("/pdf"):
+                self.send_response(200)
+                content_type = "application/pdf"
+                body = b"%PDF-1.4"
+            elif self.path.startswith("/latin1"):
+                self.send_response(200)
+                content_type = "text/html; charset=iso-8859-1"
+                body = "<title>Caf\u00e9</title>".encode("iso-8859-1")
+            elif self.path.startswith("/etag"):
+                if self.headers.get("If-None-Match") == '"v1"':
+                    self.send_response(304)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("ETag", '"v1"')
+                body = b"<title>Tagged</title>"
+            else:
+                if self.path.startswith("/slow"):
+                    time.sleep(0.3)
+                self.send_response(200)
+                title = "same" if self.path.startswith("/same") else self.path
+                body = "<title>{}</title>".format(title).encode("utf-8")
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server, url = start_server(Handler)
+    yield url
+    stop_server(server)
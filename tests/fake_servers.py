@@ -0,0 +1,130 @@
+"""
+Local HTTP servers shared by the tests and the benchmarks. Plain functions
+and classes on the standard library, so the benchmarks can import them
+without pytest; conftest.py puts fixtures on top.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import threading
+import time
+import urllib.parse
+
+
+def start_server(handler, host="127.0.0.1"):
+    """
+    Serve from a background thread. handler is a request handler class, or
+    an already bound server such as classifiers.make_server returns.
+    Returns (server, base URL).
+    """
+    if isinstance(handler, type):
+        server = ThreadingHTTPServer((host, 0), handler)
+    else:
+        server = handler
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:{}".format(server.server_address[1])
+
+
+def stop_server(server):
+    server.shutdown()
+    server.server_close()
+
+
+class FakePocket:
+    """
+    /v3/get, /v3/stats and /v3/send for an account of items.
+
+    Pages at fail_offsets get a 503 the first time they are asked for, and
+    tags_add actions for item_ids in fail_actions fail the first time they
+    are sent. Every request waits latency seconds and an error_rate
+    fraction of them get a 503. on_response(path, status) is called for
+    each response.
+    """
+
+    def __init__(
+        self,
+        items,
+        fail_offsets=(),
+        latency=0.0,
+        error_rate=0.0,
+        since=1000,
+        seed=0,
+        on_response=None,
+    ):
+        self.items = list(items)
+        self.fail_offsets = set(fail_offsets)
+        self.fail_actions = set()
+        self.latency = latency
+        self.error_rate = error_rate
+        self.since = since
+        self.rng = random.Random(seed)
+        self.on_response = on_response
+        self.lock = threading.Lock()
+        # Offsets of every /v3/get, and the actions of every /v3/send
+        self.requests = []
+        self.actions = []
+
+    def respond(self, path, args):
+        "(status, body) for a request"
+        time.sleep(self.latency)
+        with self.lock:
+            if self.rng.random() < self.error_rate:
+                return 503, {"error": "Service unavailable"}
+            if path.endswith("/stats"):
+                return 200, {"count_list": len(self.items)}
+            if path.endswith("/send"):
+                actions = json.loads(args.get("actions", "[]"))
+                self.actions.append(actions)
+                results = []
+                for action in actions:
+                    results.append(action["item_id"] not in self.fail_actions)
+                    self.fail_actions.discard(action["item_id"])
+                return 200, {"status": 1, "action_results": results}
+            offset = int(args.get("offset", 0))
+            self.requests.append(offset)
+            if offset in self.fail_offsets:
+                self.fail_offsets.discard(offset)
+                return 503, {"error": "Service unavailable"}
+            items = self.items
+            if "since" in args:
+                since = int(args["since"])
+                items = [item for item in items if int(item.get("time_updated", 0)) > since]
+            page = items[offset : offset + int(args.get("count", 30))]
+            self.since += 1
+            return 200, {
+                "status": 1,
+                "list": {item["item_id"]: item for item in page},
+                "since": self.since,
+            }
+
+    def handler(self):
+        pocket = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def send_json(self, path, args):
+                status, body = pocket.respond(path, args)
+                if pocket.on_response:
+                    pocket.on_response(path, status)
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                url = urllib.parse.urlsplit(self.path)
+                self.send_json(url.path, dict(urllib.parse.parse_qsl(url.query)))
+
+            def do_POST(self):
+                length = int(self.headers["Content-Length"])
+                body = self.rfile.read(length).decode("utf-8")
+                self.send_json(self.path, dict(urllib.parse.parse_qsl(body)))
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,184 @@
+from click.testing import CliRunner
+from pocket_to_sqlite import archive, cli, utils
+import gzip
+import io
+import json
+import pathlib
+import pytest
+import sqlite_utils
+
+HTML_EXPORT = """<!DOCTYPE html>
+<html><head><title>Pocket Export</title></head><body>
+<h1>Unread</h1>
+<ul>
+<li><a href="https://example.com/a" time_added="1600000000" tags="python,sqlite">Article &amp; A</a></li>
+<li><a href="http://people.idsia.ch/~juergen/deep-learning-miraculous-year-1990-1991.html" time_added="1570303854" tags="">Already fetched</a></li>
+</ul>
+<h1>Read Archive</h1>
+<ul>
+<li><a href="https://example.com/b" time_added="1500000000" tags="">https://example.com/b</a></li>
+</ul>
+</body></html>
+"""
+
+CSV_EXPORT = """title,url,time_added,tags,status
+Article C,https://example.com/c,1600000001,python|web,unread
+,https://example.com/d,1400000000,,archive
+"""
+
+
+def page_json(items, since):
+    return json.dumps(
+        {"status": 1, "list": {item["item_id"]: item for item in items}, "since": since}
+    ).encode("utf-8")
+
+
+@pytest.fixture
+def items():
+    return json.load(open(pathlib.Path(__file__).parent / "pocket.json"))
+
+
+def test_streaming_page_reads_across_chunks(items):
+    many = [dict(items[0], item_id=str(i)) for i in range(20)]
+    page = archive.StreamingPage(io.StringIO(page_json(many, 1234).decode("utf-8")), read_size=7)
+    assert [item["item_id"] for item in page] == [str(i) for i in range(20)]
+    assert 1234 == page.since
+
+
+def test_streaming_page_empty_list():
+    # Pocket sends an empty list rather than an empty object
+    page = archive.StreamingPage(io.StringIO('{"status": 2, "list": [], "since": 99}'))
+    assert [] == list(page)
+    assert 99 == page.since
+
+
+def test_streaming_page_error():
+    with pytest.raises(ValueError):
+        list(archive.StreamingPage(io.StringIO('{"list": {}, "error": "Bad key"}')))
+
+
+def test_html_export():
+    items = list(archive.iter_html_export(io.StringIO(HTML_EXPORT)))
+    assert [
+        ("https://example.com/a", "Article & A", 0, ["python", "sqlite"]),
+        (
+            "http://people.idsia.ch/~juergen/deep-learning-miraculous-year-1990-1991.html",
+            "Already fetched",
+            0,
+            None,
+        ),
+        ("https://example.com/b", "https://example.com/b", 1, None),
+    ] == [
+        (
+            item["given_url"],
+            item["resolved_title"],
+            item["status"],
+            list(item["tags"]) if item["tags"] else None,
+        )
+        for item in items
+    ]
+    assert items[0]["item_id"] == archive.export_item_id("https://example.com/a") < 0
+
+
+def test_csv_export():
+    items = list(archive.iter_csv_export(io.StringIO(CSV_EXPORT)))
+    assert [("Article C", 0, ["python", "web"]), (None, 1, None)] == [
+        (item["resolved_title"], item["status"], list(item["tags"]) if item["tags"] else None)
+        for item in items
+    ]
+
+
+def test_import_replays_archived_pages(items, tmpdir):
+    pages = archive.PageArchive(str(tmpdir / "pages"))
+    older = dict(items[0], item_id="1", given_url="https://example.com/1", time_updated="100")
+    pages.save(0, page_json([items[0], older], 2000))
+    pages.save(2, page_json([], 2000))
+    with gzip.open(next(pathlib.Path(pages.directory).glob("*-000000000.json.gz"))) as fp:
+        assert 2 == len(json.load(fp)["list"])
+    db_path = str(tmpdir / "pocket.db")
+    result = CliRunner().invoke(cli.cli, ["import", db_path, str(tmpdir / "pages")])
+    assert 0 == result.exit_code, result.output
+    assert "2 inserted" in result.output
+    db = sqlite_utils.Database(db_path)
+    assert {1, 2746847510} == {row["item_id"] for row in db["items"].rows}
+    assert ["Link."] == [row["name"] for row in db["authors"].rows]
+    assert 2000 == db["since"].get(1)["since"]
+    assert "items_fts" in db.table_names()
+
+
+def test_import_since_and_all(items, tmpdir):
+    db_path = str(tmpdir / "pocket.db")
+    db = sqlite_utils.Database(db_path)
+    db["since"].insert({"id": 1, "since": 1000}, pk="id")
+    pages = archive.PageArchive(str(tmpdir / "pages"))
+    older = dict(items[0], item_id="1", given_url="https://example.com/1", time_updated="100")
+    pages.save(0, page_json([items[0], older], 500))
+    result = CliRunner().invoke(cli.cli, ["import", db_path, str(tmpdir / "pages")])
+    assert 0 == result.exit_code, result.output
+    assert [2746847510] == [row["item_id"] for row in db["items"].rows]
+    result = CliRunner().invoke(cli.cli, ["import", db_path, str(tmpdir / "pages"), "--all"])
+    assert 0 == result.exit_code, result.output
+    assert 2 == db["items"].count
+    # Older pages don't move since backwards
+    assert 1000 == db["since"].get(1)["since"]
+
+
+def test_import_since_keeps_deletions_without_timestamps(items, tmpdir):
+    pages = archive.PageArchive(str(tmpdir / "pages"))
+    pages.save(0, page_json([items[0], {"item_id": "1", "status": "2"}], 2000))
+    importer = archive.Importer([str(tmpdir / "pages")], since=1600000000)
+    assert [{"item_id": "1", "status": "2"}] == list(importer)
+
+
+def test_api_item_replaces_export_item_with_same_url(items, tmpdir):
+    db_path = str(tmpdir / "pocket.db")
+    (tmpdir / "ril_export.html").write_text(HTML_EXPORT, "utf-8")
+    result = CliRunner().invoke(cli.cli, ["import", db_path, str(tmpdir / "ril_export.html")])
+    assert 0 == result.exit_code, result.output
+    db = sqlite_utils.Database(db_path)
+    export_id = archive.export_item_id(items[0]["given_url"])
+    utils.create_auto_tags_table(db)
+    db["auto_tags"].insert({"item_id": export_id, "top_category": "Science"})
+    assert {"inserted": 1, "updated": 0, "deleted": 0, "skipped": 0} == utils.save_items(
+        [items[0]], db
+    )
+    assert 3 == db["items"].count
+    assert [2746847510] == [
+        row["item_id"]
+        for row in db["items"].rows_where("given_url = ?", [items[0]["given_url"]])
+    ]
+    assert [(2746847510, "Science")] == db.execute(
+        "select item_id, top_category from auto_tags"
+    ).fetchall()
+
+
+def test_import_exports_skip_known_urls(items, tmpdir):
+    db_path = str(tmpdir / "pocket.db")
+    pages = archive.PageArchive(str(tmpdir / "pages"))
+    pages.save(0, page_json(items, 2000))
+    (tmpdir / "ril_export.html").write_text(HTML_EXPORT, "utf-8")
+    (tmpdir / "export.csv").write_text(CSV_EXPORT, "utf-8")
+    result = CliRunner().invoke(
+        cli.cli,
+        [
+            "import",
+            db_path,
+            str(tmpdir / "pages"),
+            str(tmpdir / "ril_export.html"),
+            str(tmpdir / "export.csv"),
+            "--all",
+        ],
+    )
+    assert 0 == result.exit_code, result.output
+    db = sqlite_utils.Database(db_path)
+    assert 5 == db["items"].count
+    # The fetched copy of the article wasn't replaced by the export's
+    assert 1 == db["items"].count_where("given_url like '%miraculous%'")
+    assert 0 < db["items"].get(2746847510)["word_count"]
+
+
+def test_import_unknown_file(tmpdir):
+    (tmpdir / "notes.txt").write_text("hello", "utf-8")
+    result = CliRunner().invoke(cli.cli, ["import", str(tmpdir / "pocket.db"), str(tmpdir / "notes.txt")])
+    assert 1 == result.exit_code
+    assert "Don't know how to import" in result.output
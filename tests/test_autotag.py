@@ -0,0 +1,195 @@
+from pocket_to_sqlite import cache, html_store, utils
+import pytest
+import sqlite_utils
+
+
+def fake_predict(batches):
+    def predict(pages):
+        batches.append(len(pages))
+        return [({"Arts": 0.9, "News": 0.1}, [0.5, 0.5]) for _ in pages]
+
+    return predict
+
+
+def test_categorize_items_batches_pages(page_server):
+    items = [
+        {"item_id": i, "resolved_url": "{}/page/{}".format(page_server, i)}
+        for i in range(10)
+    ]
+    items.append({"item_id": 10, "resolved_url": page_server + "/missing"})
+    items.append({"item_id": 11})
+    batches = []
+    timings = utils.StageTimings()
+    results = list(
+        utils.categorize_items(
+            items,
+            batch_size=4,
+            max_wait=5,
+            timings=timings,
+            predict=fake_predict(batches),
+        )
+    )
+    by_id = {r["categorization"]["item_id"]: r for r in results}
+    assert list(range(12)) == sorted(by_id)
+    assert by_id[10]["error"]
+    assert by_id[10]["categorization"]["error"].startswith("Status 404")
+    assert "No resolved_url or given_url" == by_id[11]["categorization"]["error"]
+    ok = by_id[3]["categorization"]
+    assert "Arts" == ok["top_category"]
+    assert ["Arts"] == ok["likely_categories"]
+    assert "<title>/page/3</title>" == ok["html"]
+    assert [4, 4, 2] == batches
+    assert 10 == timings.stages["inference"][1]
+
+
+def test_categorize_items_flushes_partial_batch_after_max_wait(page_server):
+    items = [{"item_id": 0, "resolved_url": page_server + "/page/0"}] + [
+        {"item_id": i, "resolved_url": "{}/slow/{}".format(page_server, i)}
+        for i in range(1, 3)
+    ]
+    batches = []
+    list(
+        utils.categorize_items(
+            items, batch_size=3, max_wait=0.05, predict=fake_predict(batches)
+        )
+    )
+    assert 3 == sum(batches)
+    assert 1 == batches[0]
+
+
+@pytest.fixture
+def classification_cache(tmp_path):
+    db = sqlite_utils.Database(str(tmp_path / "cache.db"))
+    return cache.ClassificationCache(db, "test-model", threaded=True)
+
+
+def test_categorize_items_uses_cache(page_server, classification_cache):
+    items = [
+        {"item_id": i, "resolved_url": "{}/same/{}".format(page_server, i)}
+        for i in range(6)
+    ]
+    batches = []
+    predict = fake_predict(batches)
+    results = list(
+        utils.categorize_items(
+            items[:1], predict=predict, cache=classification_cache
+        )
+    )
+    results += list(
+        utils.categorize_items(
+            items[1:], batch_size=2, predict=predict, cache=classification_cache
+        )
+    )
+    assert [1] == batches
+    assert {"Arts": 0.9, "News": 0.1} == results[-1]["categorization"]["scores"]
+    assert (5, 1) == (classification_cache.hits, classification_cache.misses)
+
+
+def test_classification_cache_is_keyed_on_model_version(tmp_path):
+    db = sqlite_utils.Database(str(tmp_path / "cache.db"))
+    cache.ClassificationCache(db, "v1").put("abc", {"Arts": 1.0}, [1.0])
+    assert ({"Arts": 1.0}, [1.0]) == cache.ClassificationCache(db, "v1").get("abc")
+    assert cache.ClassificationCache(db, "v2").get("abc") is None
+
+
+def test_classification_cache_eviction(classification_cache):
+    for i in range(5):
+        classification_cache.put(str(i), {"Arts": 1.0}, [])
+    classification_cache.get("0")
+    classification_cache.max_entries = 2
+    assert 3 == classification_cache.evict()
+    assert classification_cache.get("0") is not None
+    assert classification_cache.get("1") is None
+    classification_cache.max_age_days = -1
+    assert 2 == classification_cache.evict()
+
+
+def test_download_page_conditional_request(page_server, tmp_path):
+    db = sqlite_utils.Database(str(tmp_path / "validators.db"))
+    store = html_store.HtmlStore(db)
+    validators = cache.PageValidators(db, store)
+    url = page_server + "/etag/1"
+    html, err = utils.download_page(url, validators=validators)
+    assert ("<title>Tagged</title>", None) == (html, err)
+    validators.flush()
+    validator = db["page_validators"].get(url)
+    assert '"v1"' == validator["etag"]
+    assert 21 == validator["size"]
+    # A 304 without stored HTML falls back to a full download
+    assert (html, None) == utils.download_page(url, validators=validators)
+    assert 0 == validators.not_modified
+    store.put_all([(html, validator["html_md5"], None)])
+    assert (html, None) == utils.download_page(url, validators=validators)
+    assert (1, 21) == (validators.not_modified, validators.bytes_saved)
+
+
+def test_save_categorization_stores_html_once(tmp_path):
+    db = sqlite_utils.Database(str(tmp_path / "html.db"))
+    store = html_store.HtmlStore(db, export_dir=str(tmp_path / "pages"))
+    utils.create_auto_tags_table(db)
+    html = "<p>" + "hello " * 1000 + "</p>"
+    for item_id in (1, 2):
+        result = utils.categorized_result(
+            {"item_id": item_id}, "https://example.com/a", html, {"Arts": 0.9}, [], 0
+        )
+        utils.save_categorization(db, result, store)
+    assert "html" not in db["auto_tags"].columns_dict
+    assert 1 == db["html"].count
+    row = db["html"].get(result["categorization"]["html_md5"])
+    assert row["compressed_size"] < row["size"]
+    assert html == store.get(row["html_md5"])
+    assert html == (tmp_path / "pages" / "https__example.com_a").read_text()
+
+
+def test_migrate_auto_tags(tmp_path):
+    db = sqlite_utils.Database(str(tmp_path / "old.db"))
+    html = "<p>" + "hello " * 1000 + "</p>"
+    db["auto_tags"].insert_all(
+        [{"item_id": i, "html": html, "html_md5": "abc", "top_category": "Arts"} for i in range(20)],
+        pk="item_id",
+    )
+    store = html_store.HtmlStore(db)
+    before, after = html_store.migrate_auto_tags(db, store)
+    assert after < before
+    assert "html" not in db["auto_tags"].columns_dict
+    assert 20 == db["auto_tags"].count
+    assert html == store.get("abc")
+
+
+def test_save_categorizations_keeps_columns_of_error_rows(tmp_path):
+    db = sqlite_utils.Database(str(tmp_path / "results.db"))
+    store = html_store.HtmlStore(db)
+    utils.create_auto_tags_table(db)
+    ok = utils.categorized_result(
+        {"item_id": 1}, "https://example.com/a", "<p>a</p>", {"Arts": 0.9}, [0.5], 0
+    )
+    utils.save_categorizations(
+        db, [ok, utils.error_result({"item_id": 2}, "Timeout")], store
+    )
+    assert "Arts" == db["auto_tags"].get(1)["top_category"]
+    assert "Timeout" == db["auto_tags"].get(2)["error"]
+    assert 1 == db["html"].count
+
+
+def test_hot_queries_use_indexes(tmp_path):
+    db = sqlite_utils.Database(str(tmp_path / "plans.db"))
+    db["items"].insert_all(
+        [{"item_id": i, "status": i % 3, "given_url": "https://example.com/{}".format(i), "resolved_url": None} for i in range(300)],
+        pk="item_id",
+    )
+    utils.create_auto_tags_table(db)
+    db["auto_tags"].insert_all(
+        [{"item_id": i, "top_category": "Arts", "synced": i % 2} for i in range(0, 300, 3)],
+        pk="item_id",
+    )
+    utils.ensure_indexes(db)
+    utils.ensure_indexes(db)
+    plans = {
+        description: " ".join(row[-1] for row in db.execute("explain query plan " + sql))
+        for description, sql in utils.hot_queries()
+    }
+    assert "idx_auto_tags_unsynced" in plans["autotag-sync: tags to send"]
+    assert "idx_auto_tags_errors" in plans["autotag --errors: items to retry"]
+    assert "idx_auto_tags_top_category" in plans["rebuild-summaries: items per category"]
+    assert "PRIMARY KEY" in plans["autotag: items to classify"]
+    assert 50 == len(db.execute(utils.UNSYNCED_SQL).fetchall())
@@ -0,0 +1,146 @@
+from pocket_to_sqlite import classifiers, utils
+from http.server import BaseHTTPRequestHandler
+import json
+import threading
+import time
+import pytest
+
+
+def predict_titles(pages):
+    "Module level, so worker processes can unpickle it"
+    return [({"Arts": len(html) / 100}, [float(len(url))]) for url, html in pages]
+
+
+class SlowClassifier:
+    version = "slow"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = 0
+        self.most_running = 0
+
+    def predict(self, pages):
+        with self.lock:
+            self.running += 1
+            self.most_running = max(self.most_running, self.running)
+        time.sleep(0.1)
+        with self.lock:
+            self.running -= 1
+        return predict_titles(pages)
+
+
+@pytest.fixture
+def classifier_server(http_server):
+    def start(classifier, token=None):
+        return http_server(classifiers.make_server(classifier, port=0, token=token)) + "/"
+
+    return start
+
+
+def test_remote_classifier_sends_batches(classifier_server):
+    url = classifier_server(classifiers.LocalClassifier(predict_titles), token="secret")
+    pages = [("https://example.com/{}".format(i), "x" * i) for i in range(5)]
+    remote = classifiers.RemoteClassifier(url, token="secret")
+    assert predict_titles(pages) == [tuple(p) for p in remote.predict(pages)]
+    assert remote.batched
+    with pytest.raises(ValueError, match="Status 401"):
+        classifiers.RemoteClassifier(url, token="wrong").predict(pages)
+
+
+# What single-document servers have been seen to answer a batch with
+@pytest.mark.parametrize("batch_status", (400, 422, 200))
+def test_remote_classifier_falls_back_to_single_documents(http_server, batch_status):
+    requests = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            requests.append(body)
+            status = 200
+            data = json.dumps({"scores": {"Arts": 1.0}, "embeddings": [1.0]}).encode()
+            if "url" not in body:
+                status = batch_status
+                data = json.dumps({"error": "Expected url and html"}).encode()
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    remote = classifiers.RemoteClassifier(http_server(Handler) + "/")
+    pages = [("https://example.com/a", "a"), ("https://example.com/b", "b")]
+    assert 2 == len(remote.predict(pages))
+    assert 2 == len(remote.predict(pages))
+    # Only the first batch was tried as a batch
+    assert [False, True, True, True, True] == ["url" in body for body in requests]
+
+
+def test_process_pool_classifier_keeps_page_order():
+    pool = classifiers.ProcessPoolClassifier(2, predict=predict_titles, load_model=None)
+    pages = [("https://example.com/{}".format(i), "x" * i) for i in range(7)]
+    try:
+        assert predict_titles(pages) == pool.predict(pages)
+        pool.split = False
+        assert predict_titles(pages) == pool.predict(pages)
+    finally:
+        pool.close()
+
+
+def test_categorize_items_runs_concurrent_batches(page_server, classifier_server):
+    slow = SlowClassifier()
+    remote = classifiers.RemoteClassifier(classifier_server(slow))
+    items = [
+        {"item_id": i, "resolved_url": "{}/page/{}".format(page_server, i)}
+        for i in range(12)
+    ]
+    results = list(
+        utils.categorize_items(
+            items, remote.predict, batch_size=2, max_wait=0.05, concurrency=3
+        )
+    )
+    assert list(range(12)) == sorted(r["categorization"]["item_id"] for r in results)
+    assert not any(r["error"] for r in results)
+    assert 2 <= slow.most_running <= 3
+
+
+def test_categorize_items_fails_batch_when_classifier_errors(page_server):
+    def broken(pages):
+        raise ValueError("Status 500 model exploded")
+
+    items = [{"item_id": 1, "resolved_url": page_server + "/page/1"}]
+    [result] = utils.categorize_items(items, broken, max_wait=0.05)
+    assert result["error"]
+    assert "model exploded" in result["categorization"]["error"]
+
+
+def test_remote_classifier_keeps_batching_after_server_error(http_server):
+    requests = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            requests.append(body)
+            status = 503 if len(requests) == 1 else 200
+            results = [{"scores": {"Arts": 1.0}, "embeddings": [1.0]} for _ in body["pages"]]
+            data = json.dumps({"results": results}).encode()
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    remote = classifiers.RemoteClassifier(http_server(Handler) + "/")
+    pages = [("https://example.com/a", "a"), ("https://example.com/b", "b")]
+    # A busy server fails the batch rather than switching to single pages
+    with pytest.raises(ValueError, match="Status 503"):
+        remote.predict(pages)
+    assert remote.batched is None
+    assert 2 == len(remote.predict(pages))
+    assert remote.batched
+    assert ["pages", "pages"] == [next(iter(body)) for body in requests]
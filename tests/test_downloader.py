@@ -0,0 +1,55 @@
+from pocket_to_sqlite import downloader
+import time
+import pytest
+
+
+@pytest.fixture
+def pages():
+    pages = downloader.PageDownloader(max_bytes=1000, failure_threshold=2)
+    yield pages
+    pages.close()
+
+
+def test_download_checks_type_caps_size_and_decodes(page_server, pages):
+    html, err = pages.submit(page_server + "/huge").result()
+    assert err is None
+    assert 1000 == len(html)
+    assert (None, "Not HTML: application/pdf") == pages.submit(page_server + "/pdf").result()
+    assert ("<title>Café</title>", None) == pages.submit(page_server + "/latin1").result()
+    html, err = pages.submit(page_server + "/missing").result()
+    assert "Status 404 Not found" == err
+
+
+@pytest.mark.parametrize(
+    "body,content_type,expected",
+    [
+        ("café".encode("utf-8"), None, "café"),
+        ("café".encode("cp1252"), "text/html; charset=windows-1252", "café"),
+        (b'<meta charset="iso-8859-1"><p>caf\xe9', "text/html", '<meta charset="iso-8859-1"><p>café'),
+        ("café".encode("utf-8"), "text/html; charset=nonsense", "café"),
+        # Cut off in the middle of a character by max_bytes
+        ("café".encode("utf-8")[:-1], None, "caf�"),
+    ],
+)
+def test_decode(body, content_type, expected):
+    assert expected == downloader.decode(body, content_type)
+
+
+def test_hosts_that_keep_failing_are_skipped(page_server, pages):
+    for _ in range(2):
+        html, err = pages.submit(page_server + "/down").result()
+        assert "Status 503 Down" == err
+    html, err = pages.submit(page_server + "/page/1").result()
+    assert "Skipped 127.0.0.1 after 2 failures in a row" == err
+    pages.failures["127.0.0.1"] = (2, 0)
+    # After the cooldown the host is tried again, and a success clears it
+    assert ("<title>/page/1</title>", None) == pages.submit(page_server + "/page/1").result()
+    assert {} == pages.failures
+
+
+def test_per_host_limit(page_server):
+    with downloader.PageDownloader(per_host=1) as pages:
+        start = time.perf_counter()
+        futures = [pages.submit("{}/slow/{}".format(page_server, i)) for i in range(2)]
+        assert not any(future.result()[1] for future in futures)
+        assert time.perf_counter() - start >= 0.6
@@ -0,0 +1,61 @@
+from pocket_to_sqlite import embeddings
+import json
+import pytest
+import sqlite_utils
+
+
+@pytest.mark.parametrize("fmt,size", [("float32", 12), ("float16", 6)])
+def test_pack_unpack(fmt, size):
+    blob = embeddings.pack([0.5, -1.0, 2.0], fmt)
+    assert size == len(blob)
+    assert [0.5, -1.0, 2.0] == embeddings.unpack(blob, fmt)
+    assert [0.5] == embeddings.unpack("[0.5]", fmt)
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / "similar.db")
+    db = sqlite_utils.Database(path)
+    vectors = {1: [1.0, 0.0, 0.0], 2: [0.9, 0.1, 0.0], 3: [0.0, 1.0, 0.0], 4: [0.5, 0.5, 0.0]}
+    db["auto_tags"].insert_all(
+        [
+            {"item_id": item_id, "embeddings": embeddings.pack(v), "embedding_format": "float32"}
+            for item_id, v in vectors.items()
+        ],
+        pk="item_id",
+    )
+    # Older rows with JSON embeddings are still readable
+    db["auto_tags"].insert({"item_id": 5, "embeddings": json.dumps([0.0, 0.0, 1.0])})
+    db["items"].insert(
+        {"item_id": 2, "resolved_url": "https://example.com/", "given_url": None},
+        pk="item_id",
+    )
+    return path
+
+
+def test_similar(db_path):
+    db = sqlite_utils.Database(db_path)
+    index = embeddings.EmbeddingIndex(db, db_path).load()
+    assert [2, 4] == [item_id for item_id, _ in index.similar(1, k=2)]
+    assert index.similar(1, k=1)[0][1] == pytest.approx(0.9939, abs=1e-4)
+    assert 2 == embeddings.resolve_item_id(db, "https://example.com/")
+    with pytest.raises(KeyError):
+        index.similar(99)
+
+
+def test_index_cache_invalidated_by_new_rows(db_path):
+    db = sqlite_utils.Database(db_path)
+    assert 5 == len(embeddings.EmbeddingIndex(db, db_path).load().ids)
+    db["auto_tags"].insert(
+        {"item_id": 6, "embeddings": embeddings.pack([1.0, 0.0, 0.0]), "embedding_format": "float32"}
+    )
+    index = embeddings.EmbeddingIndex(db, db_path).load()
+    assert 6 == len(index.ids)
+    assert 6 == index.similar(1, k=1)[0][0]
+
+
+def test_migrate_auto_tags(db_path):
+    db = sqlite_utils.Database(db_path)
+    assert 1 == embeddings.migrate_auto_tags(db)
+    row = db["auto_tags"].get(5)
+    assert [0.0, 0.0, 1.0] == embeddings.unpack(row["embeddings"], row["embedding_format"])
@@ -0,0 +1,123 @@
+from click.testing import CliRunner
+from pocket_to_sqlite import cli, export, html_store, utils
+import json
+import pathlib
+import pytest
+import sqlite_utils
+
+
+@pytest.fixture
+def db_path(tmpdir):
+    db_path = str(tmpdir / "export.db")
+    db = sqlite_utils.Database(db_path)
+    items = json.load(open(pathlib.Path(__file__).parent / "pocket.json"))
+    items.append({"item_id": "2", "resolved_url": "https://example.com/2", "time_updated": "1"})
+    utils.save_items(items, db)
+    utils.create_auto_tags_table(db)
+    categorized = utils.categorized_result(
+        {"item_id": 2746847510},
+        "http://people.idsia.ch/~juergen/deep-learning-overview.html",
+        "<title>Deep learning</title>",
+        {"Arts": 0.25, "Computers": 0.75},
+        [0.5, -1.0, 2.0],
+        0.1,
+    )
+    utils.save_categorizations(
+        db, [categorized, utils.error_result({"item_id": 2}, "Status 404")], html_store.HtmlStore(db)
+    )
+    db.close()
+    return db_path
+
+
+def read_ndjson(path):
+    return [json.loads(line) for line in open(path)]
+
+
+def test_export_ndjson_decodes_json_columns(db_path, tmpdir):
+    db = sqlite_utils.Database(db_path)
+    assert 2 == export.export(db, str(tmpdir / "out.ndjson"), chunk_size=1)
+    first, second = read_ndjson(str(tmpdir / "out.ndjson"))
+    assert 2 == first["item_id"]
+    assert "Status 404" == first["classification_error"]
+    assert first["embedding"] is None
+    assert 2746847510 == second["item_id"]
+    assert "Computers" == second["top_category"]
+    assert ["Computers"] == second["likely_categories"]
+    assert (0.25, 0.75, None) == (
+        second["score_arts"],
+        second["score_computers"],
+        second["score_news"],
+    )
+    assert [0.5, -1.0, 2.0] == second["embedding"]
+    assert ["Link."] == [author["name"] for author in second["authors"]]
+    assert [1, 0] == [second["images"][0]["image_id"], second["images"][0]["width"]]
+
+
+def test_export_watermark_only_writes_changed_rows(db_path, tmpdir):
+    db = sqlite_utils.Database(db_path)
+    out = str(tmpdir / "out.ndjson")
+    assert 2 == export.export(db, out, watermark_name="daily")
+    assert 0 == export.export(db, out, watermark_name="daily")
+    db["items"].update(2, {"time_updated": 2000000000})
+    assert 1 == export.export(db, out, watermark_name="daily")
+    assert [2] == [row["item_id"] for row in read_ndjson(out)]
+    # Other watermarks are independent
+    assert 2 == export.export(db, out, watermark_name="weekly")
+    assert {"daily": 1, "weekly": 2} == {
+        row["name"]: row["rows"] for row in db[export.WATERMARKS_TABLE].rows
+    }
+
+
+def test_export_watermark_sees_deletions_and_same_second_updates(db_path, tmpdir):
+    db = sqlite_utils.Database(db_path)
+    out = str(tmpdir / "out.ndjson")
+    assert 2 == export.export(db, out, watermark_name="daily")
+    # Minimal deletion records carry no time_updated to compare
+    utils.save_items([{"item_id": "2746847510", "status": "2"}], db)
+    assert 1 == export.export(db, out, watermark_name="daily")
+    assert [(2746847510, 2)] == [(row["item_id"], row["status"]) for row in read_ndjson(out)]
+    # Nor does a second update within the same second
+    db["items"].update(2, {"resolved_url": "https://example.com/two"})
+    assert 1 == export.export(db, out, watermark_name="daily")
+    db["items"].update(2, {"resolved_url": "https://example.com/2"})
+    assert 1 == export.export(db, out, watermark_name="daily")
+    # A reclassification counts too
+    db["auto_tags"].update(2, {"error": None, "top_category": "News"})
+    assert 1 == export.export(db, out, watermark_name="daily")
+    assert "News" == read_ndjson(out)[0]["top_category"]
+    assert 0 == export.export(db, out, watermark_name="daily")
+    # autotag-sync only sets synced, which isn't exported
+    utils.mark_synced(db, [2, 2746847510])
+    assert 0 == export.export(db, out, watermark_name="daily")
+
+
+def test_export_watermark_starts_over_without_triggers(db_path, tmpdir):
+    db = sqlite_utils.Database(db_path)
+    out = str(tmpdir / "out.ndjson")
+    assert 2 == export.export(db, out, watermark_name="daily")
+    for name in export.stored_change_triggers(db, "items"):
+        db.execute("drop trigger [{}]".format(name))
+    assert 2 == export.export(db, out, watermark_name="daily")
+    assert 0 == export.export(db, out, watermark_name="daily")
+
+
+def test_export_parquet(db_path, tmpdir):
+    pa = pytest.importorskip("pyarrow")
+    import pyarrow.parquet as pq
+
+    out = str(tmpdir / "out.parquet")
+    result = CliRunner().invoke(cli.cli, ["export", db_path, out, "--chunk-size", "1"])
+    assert 0 == result.exit_code, result.output
+    table = pq.read_table(out)
+    assert 2 == table.num_rows
+    embedding = table.schema.field("embedding").type
+    assert (3, pa.float32()) == (embedding.list_size, embedding.value_type)
+    assert pa.float64() == table.schema.field("score_arts").type
+    assert [None, 0.75] == table.column("score_computers").to_pylist()
+
+
+def test_export_cli_ndjson_to_stdout(db_path):
+    result = CliRunner().invoke(cli.cli, ["export", db_path, "-"])
+    assert 0 == result.exit_code, result.output
+    lines = [line for line in result.output.splitlines() if line.startswith("{")]
+    assert [2, 2746847510] == [json.loads(line)["item_id"] for line in lines]
@@ -0,0 +1,110 @@
+from pocket_to_sqlite import ledger, utils
+import threading
+import pytest
+import sqlite_utils
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    db = sqlite_utils.Database(path)
+    db.enable_wal()
+    db["items"].insert_all(
+        [
+            {"item_id": i, "status": 0, "given_url": "https://example.com/{}".format(i), "resolved_url": None}
+            for i in range(1, 41)
+        ]
+        # Deleted items are never queued
+        + [{"item_id": 41, "status": 2, "given_url": "https://example.com/41", "resolved_url": None}],
+        pk="item_id",
+    )
+    utils.create_auto_tags_table(db)
+    db.close()
+    return path
+
+
+def open_ledger(db_path, **kwargs):
+    db = sqlite_utils.Database(db_path)
+    db.execute("pragma busy_timeout = 30000")
+    return ledger.JobLedger(db, **kwargs)
+
+
+def error(item_id):
+    return utils.error_result({"item_id": item_id}, "Timeout")
+
+
+def ok(item_id):
+    return {"error": False, "categorization": {"item_id": item_id}}
+
+
+def test_concurrent_workers_claim_disjoint_items(db_path):
+    assert 40 == open_ledger(db_path).enqueue()
+    claimed = []
+
+    def work():
+        jobs = open_ledger(db_path)
+        for item in jobs.iter_claimed(chunk_size=3):
+            claimed.append(item["item_id"])
+            jobs.finish([ok(item["item_id"])])
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert list(range(1, 41)) == sorted(claimed)
+    assert {"done": 40} == open_ledger(db_path).counts()
+
+
+def test_failed_items_back_off_then_give_up(db_path):
+    jobs = open_ledger(db_path, max_attempts=2, backoff=0)
+    jobs.enqueue()
+    items = jobs.claim(2)
+    assert [1, 2] == [item["item_id"] for item in items]
+    # Work items leave out a NULL resolved_url, so given_url is used
+    assert {"item_id": 1, "given_url": "https://example.com/1"} == items[0]
+    jobs.finish([error(1), ok(2)])
+    # Retried straight away with no backoff, then failed for good
+    assert [1, 3] == [item["item_id"] for item in jobs.claim(2)]
+    jobs.finish([error(1)])
+    assert "failed" == jobs.db["autotag_jobs"].get(1)["state"]
+    assert 2 == jobs.db["autotag_jobs"].get(1)["attempts"]
+    assert 240 == ledger.JobLedger(jobs.db, backoff=60).backoff_seconds(3)
+    # --errors puts failed items back in the queue
+    jobs.enqueue(errors=True)
+    assert "pending" == jobs.db["autotag_jobs"].get(1)["state"]
+
+
+def test_release_and_expired_leases(db_path):
+    first = open_ledger(db_path, owner="first", lease_seconds=-1)
+    first.enqueue()
+    first.claim(5)
+    # first's leases have already expired, so second takes them over
+    second = open_ledger(db_path, owner="second")
+    assert [1, 2, 3, 4, 5] == [item["item_id"] for item in second.claim(5)]
+    assert 5 == second.release()
+    row = second.db["autotag_jobs"].get(1)
+    assert ("pending", 1) == (row["state"], row["attempts"])
+
+
+def test_enqueue_requeues_deleted_and_errored_classifications(db_path):
+    jobs = open_ledger(db_path, backoff=600)
+    jobs.enqueue()
+    items = jobs.claim(2)
+    jobs.finish([ok(1), error(2)])
+    jobs.db["auto_tags"].insert_all(
+        [{"item_id": 1, "top_category": "Arts"}, {"item_id": 2, "error": "Timeout"}]
+    )
+    assert 2 == len(items)
+    # Item 2 is backing off, so it isn't counted as work for this run
+    assert 38 == jobs.remaining()
+    # Dropping a classification queues its item again
+    jobs.db.execute("delete from auto_tags where item_id = 1")
+    assert 1 == jobs.enqueue()
+    assert ("pending", 0) == tuple(
+        jobs.db.execute("select state, attempts from autotag_jobs where item_id = 1").fetchone()
+    )
+    # --errors retries item 2 now rather than after its backoff
+    jobs.enqueue(errors=True)
+    assert 40 == jobs.remaining()
+    assert [1, 2] == [item["item_id"] for item in jobs.claim(2)]
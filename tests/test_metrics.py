@@ -0,0 +1,71 @@
+from click.testing import CliRunner
+from pocket_to_sqlite import cli, metrics
+import json
+import pstats
+import pytest
+
+
+@pytest.fixture
+def registry():
+    registry = metrics.Registry()
+    registry.inc("pages_fetched")
+    registry.inc("pages_fetched", 2)
+    for seconds in (0.003, 0.2, 0.2, 100):
+        registry.observe("page_fetch_seconds", seconds)
+    registry.observe("page_html_bytes", 5000)
+    return registry
+
+
+def test_histogram_buckets_are_cumulative(registry):
+    snapshot = registry.snapshot()
+    assert {"pages_fetched": 3} == snapshot["counters"]
+    seconds = snapshot["histograms"]["page_fetch_seconds"]
+    assert 4 == seconds["count"]
+    assert 0.003 == seconds["min"]
+    assert 100 == seconds["max"]
+    assert 1 == seconds["buckets"]["0.005"]
+    assert 3 == seconds["buckets"]["0.25"]
+    # 100 seconds is past the last bucket and only counted in +Inf
+    assert 3 == seconds["buckets"]["60"]
+    html_bytes = snapshot["histograms"]["page_html_bytes"]["buckets"]
+    assert 0 == html_bytes["1000.0"]
+    assert 1 == html_bytes["10000.0"]
+
+
+def test_prometheus_text(registry):
+    text = registry.prometheus({"command": "fetch"})
+    lines = text.splitlines()
+    assert "# TYPE pocket_to_sqlite_pages_fetched_total counter" in lines
+    assert 'pocket_to_sqlite_pages_fetched_total{command="fetch"} 3' in lines
+    assert 'pocket_to_sqlite_page_fetch_seconds_bucket{command="fetch",le="+Inf"} 4' in lines
+    assert 'pocket_to_sqlite_page_fetch_seconds_count{command="fetch"} 4' in lines
+
+
+def test_cli_writes_metrics_and_profile(tmpdir):
+    db_path = str(tmpdir / "db.db")
+    auth_path = str(tmpdir / "auth.json")
+    open(auth_path, "w").write(
+        json.dumps({"pocket_consumer_key": "x", "pocket_access_token": "y"})
+    )
+    metrics.inc("left_over_from_another_run")
+    result = CliRunner().invoke(
+        cli.cli,
+        [
+            "autotag-sync",
+            db_path,
+            "--auth",
+            auth_path,
+            "--metrics-json",
+            str(tmpdir / "metrics.json"),
+            "--metrics-textfile",
+            str(tmpdir / "metrics.prom"),
+            "--profile",
+            str(tmpdir / "run.prof"),
+        ],
+    )
+    assert 0 == result.exit_code, result.output
+    report = json.load(open(str(tmpdir / "metrics.json")))
+    assert "autotag-sync" == report["command"]
+    assert "left_over_from_another_run" not in report["counters"]
+    assert "pocket_to_sqlite_run_duration_seconds" in open(str(tmpdir / "metrics.prom")).read()
+    assert pstats.Stats(str(tmpdir / "run.prof")).total_calls
@@ -0,0 +1,109 @@
+from pocket_to_sqlite import http_client, utils
+import itertools
+import pytest
+import sqlite_utils
+
+AUTH = {"pocket_consumer_key": "key", "pocket_access_token": "token"}
+
+
+@pytest.mark.parametrize("total", [None, 95])
+def test_fetch_items_parallel_preserves_order(fake_pocket, total):
+    pocket = fake_pocket(95, fail_offsets=[20, 40])
+    recorded = []
+    fetch = utils.FetchItems(
+        AUTH,
+        page_size=10,
+        retry_sleep=0,
+        record_since=recorded.append,
+        concurrency=4,
+        rate=1000,
+        total=total,
+        api_url=pocket.url,
+    )
+    items = list(fetch)
+    assert [str(i) for i in range(95)] == [item["item_id"] for item in items]
+    # The 503s were retried
+    assert 2 == pocket.requests.count(20)
+    assert 2 == pocket.requests.count(40)
+    # Checkpointed as pages were handed on, ending on the earliest since
+    assert 1001 == recorded[-1]
+    assert sorted(recorded, reverse=True) == recorded
+
+
+def test_fetch_items_parallel_checkpoints_before_finishing(fake_pocket):
+    pocket = fake_pocket(95)
+    recorded = []
+    fetch = utils.FetchItems(
+        AUTH,
+        page_size=10,
+        record_since=recorded.append,
+        concurrency=4,
+        rate=1000,
+        api_url=pocket.url,
+    )
+    items = iter(fetch)
+    # Interrupted part way through the third page
+    assert 25 == len(list(itertools.islice(items, 25)))
+    items.close()
+    # Checkpointed without waiting for the rest of the run, and only ever
+    # moving back to the earliest since of the pages seen
+    assert recorded
+    assert sorted(recorded, reverse=True) == recorded
+
+
+def test_rate_limiter_backs_off_and_recovers():
+    limiter = utils.RateLimiter(10)
+    limiter.throttled()
+    limiter.throttled()
+    assert 2.5 == limiter.rate
+    for _ in range(20):
+        limiter.succeeded()
+    assert 10 == limiter.rate
+
+
+def test_fetch_items_reuses_connections(fake_pocket):
+    pocket = fake_pocket(50)
+    http_client.configure(pool_size=1)
+    fetch = utils.FetchItems(AUTH, page_size=10, sleep=0, api_url=pocket.url)
+    assert 50 == len(list(fetch))
+    stats = http_client.connection_stats()[pocket.url]
+    assert 6 == stats["requests"]
+    assert 1 == stats["connections"]
+    assert 5 == stats["reused"]
+
+
+@pytest.mark.parametrize("concurrency", [1, 3])
+def test_sync_labels_to_pocket_batches_and_retries(fake_pocket, concurrency):
+    pocket = fake_pocket(0)
+    pocket.fail_actions = {3, 7}
+    db = sqlite_utils.Database(":memory:")
+    db["auto_tags"].insert_all(
+        [{"item_id": i, "top_category": "News", "synced": 0} for i in range(10)],
+        pk="item_id",
+    )
+    synced, failed = utils.sync_labels_to_pocket(
+        list(db["auto_tags"].rows),
+        AUTH,
+        db,
+        batch_size=4,
+        concurrency=concurrency,
+        retry_sleep=0,
+        api_url=pocket.url,
+    )
+    assert (10, 0) == (synced, failed)
+    # 3 batches plus one partial retry for each batch that had a failure
+    assert 5 == len(pocket.actions)
+    assert [{"action": "tags_add", "item_id": 3, "tags": "autotag-news"}] in pocket.actions
+    assert 10 == db["auto_tags"].count_where("synced = 1")
+
+
+def test_sync_labels_to_pocket_gives_up_after_retries(fake_pocket):
+    pocket = fake_pocket(0)
+    db = sqlite_utils.Database(":memory:")
+    db["auto_tags"].insert({"item_id": 1, "top_category": "News", "synced": 0}, pk="item_id")
+    pocket.fail_actions = {1}
+    synced, failed = utils.sync_labels_to_pocket(
+        list(db["auto_tags"].rows), AUTH, db, retries=0, api_url=pocket.url
+    )
+    assert (0, 1) == (synced, failed)
+    assert 0 == db["auto_tags"].count_where("synced = 1")
@@ -60,6 +60,7 @@ def test_item(converted):
         "image": '{"item_id": "2746847510", "src": "http://people.idsia.ch/~juergen/lstmagfa288.gif", "width": "0", "height": "0"}',
         "images": '{"1": {"item_id": "2746847510", "image_id": "1", "src": "http://people.idsia.ch/~juergen/lstmagfa288.gif", "width": "0", "height": "0", "credit": "", "caption": ""}, "2": {"item_id": "2746847510", "image_id": "2", "src": "http://people.idsia.ch/~juergen/deepoverview466x288-6border.gif", "width": "0", "height": "0", "credit": "", "caption": ""}}',
         "listen_duration_estimate": 4419,
+        "digest": "e77bd5b17ce57f25ef17697d2127f197c002cee7",
     } == item
 
 
@@ -72,3 +73,72 @@ def test_authors(converted):
             "url": "http://people.idsia.ch/~juergen/heatexchanger/heatexchanger.html",
         }
     ] == authors
+
+
+def test_save_items_batched_adds_new_columns():
+    db = sqlite_utils.Database(":memory:")
+    items = []
+    for i in range(5):
+        item = load()[0]
+        item["item_id"] = str(1000 + i)
+        if i == 4:
+            item["domain_metadata"] = {"name": "idsia.ch"}
+        items.append(item)
+    utils.save_items(items, db, batch_size=2)
+    assert 5 == db["items"].count
+    assert "domain_metadata" in db["items"].columns_dict
+    assert 1 == db["authors"].count
+    assert 1 == db["items_authors"].count
+
+
+def test_save_items_skips_unchanged_and_marks_deleted():
+    db = sqlite_utils.Database(":memory:")
+    assert {"inserted": 1, "updated": 0, "deleted": 0, "skipped": 0} == utils.save_items(load(), db)
+    utils.ensure_fts(db)
+    # Only time_updated and sort_id differ
+    items = load()
+    items[0]["time_updated"] = "1600000000"
+    items[0]["sort_id"] = 3
+    assert {"inserted": 0, "updated": 0, "deleted": 0, "skipped": 1} == utils.save_items(items, db)
+    assert 1570303854 == db["items"].get(2746847510)["time_updated"]
+    items = load()
+    items[0]["resolved_title"] = "A new title"
+    assert {"inserted": 0, "updated": 1, "deleted": 0, "skipped": 0} == utils.save_items(items, db)
+    assert [(2746847510,)] == db.execute(
+        "select rowid from items_fts where items_fts match 'new'"
+    ).fetchall()
+    assert 1 == db["items_authors"].count
+    # A field Pocket stops sending is cleared, as a row replace would
+    items = load()
+    items[0]["resolved_title"] = "Another title"
+    del items[0]["excerpt"]
+    assert {"inserted": 0, "updated": 1, "deleted": 0, "skipped": 0} == utils.save_items(items, db)
+    assert None is db["items"].get(2746847510)["excerpt"]
+    deleted = [
+        {"item_id": "2746847510", "status": "2", "time_updated": "1600000001"},
+        {"item_id": "1", "status": "2", "time_updated": "1600000002"},
+    ]
+    assert {"inserted": 1, "updated": 0, "deleted": 1, "skipped": 0} == utils.save_items(deleted, db)
+    row = db["items"].get(2746847510)
+    assert (2, "Another title", 1600000001) == (
+        row["status"],
+        row["resolved_title"],
+        row["time_updated"],
+    )
+    assert 2 == db["items"].get(1)["status"]
+    # Deleting again changes nothing
+    assert {"inserted": 0, "updated": 0, "deleted": 0, "skipped": 2} == utils.save_items(deleted, db)
+
+
+@pytest.mark.parametrize(
+    "profile,synchronous,mmap_size", (("fast", 1, 256 * 1024 * 1024), ("safe", 2, 0))
+)
+def test_open_database_profiles(tmp_path, profile, synchronous, mmap_size):
+    db = utils.open_database(str(tmp_path / "profile.db"), profile)
+    assert "wal" == db.execute("pragma journal_mode").fetchone()[0]
+    assert synchronous == db.execute("pragma synchronous").fetchone()[0]
+    assert mmap_size == db.execute("pragma mmap_size").fetchone()[0]
+    assert 30000 == db.execute("pragma busy_timeout").fetchone()[0]
+    utils.save_items(load(), db)
+    utils.finish_database(db)
+    assert 1 == db["items"].count
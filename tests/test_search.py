@@ -0,0 +1,118 @@
+from pocket_to_sqlite import html_store, search, utils
+import pytest
+import sqlite_utils
+
+
+def item(item_id, title, excerpt="", status=0):
+    return {
+        "item_id": item_id,
+        "resolved_id": item_id,
+        "resolved_url": "https://example.com/{}".format(item_id),
+        "resolved_title": title,
+        "excerpt": excerpt,
+        "status": status,
+    }
+
+
+@pytest.fixture
+def db():
+    db = sqlite_utils.Database(memory=True)
+    utils.save_items(
+        [
+            item(1, "Deep learning in practice", "Training neural networks"),
+            item(2, "Sourdough bread", "A recipe that mentions learning to bake"),
+            item(3, "Learning to garden", "Tomatoes", status=1),
+        ],
+        db,
+    )
+    utils.ensure_fts(db)
+    utils.create_auto_tags_table(db)
+    db["auto_tags"].insert_all(
+        [
+            {"item_id": 1, "top_category": "Computers"},
+            {"item_id": 2, "top_category": "Food"},
+            {"item_id": 3, "top_category": "Home"},
+        ],
+        pk="item_id",
+    )
+    return db
+
+
+def ids(results):
+    return [result["item_id"] for result in results]
+
+
+def test_search_ranks_titles_first_with_filters(db):
+    results = search.search(db, "learning")
+    assert 2 == results[-1]["item_id"]
+    assert "[learning]" in results[-1]["snippet"]
+    assert "Food" == results[-1]["top_category"]
+    assert [1] == ids(search.search(db, "learning", category="Computers"))
+    assert [3] == ids(search.search(db, "learning", status="archived"))
+
+
+def test_bulk_load_rebuilds_index_once(db):
+    with search.bulk_load(db):
+        assert [] == db.execute(
+            "select name from sqlite_master where type = 'trigger'"
+        ).fetchall()
+        utils.save_items([item(4, "Rust for learning systems programming")], db)
+        utils.save_items([item(1, "Renamed", "Nothing here")], db)
+    assert [3, 4, 2] == ids(search.search(db, "learning"))
+    # Triggers are back
+    utils.save_items([item(5, "Learning again")], db)
+    assert 5 in ids(search.search(db, "learning"))
+
+
+def test_ensure_fts_restores_triggers_after_interrupted_bulk_load(db):
+    # As a fetch killed inside search.bulk_load leaves things
+    for name in ("items_ai", "items_ad", "items_au"):
+        db.execute("drop trigger [{}]".format(name))
+    utils.save_items([item(4, "Rust for learning systems programming")], db)
+    utils.ensure_fts(db)
+    assert 4 in ids(search.search(db, "learning"))
+    utils.save_items([item(5, "Learning again")], db)
+    assert 5 in ids(search.search(db, "learning"))
+
+
+def test_index_pages_in_batches(db):
+    store = html_store.HtmlStore(db)
+    utils.save_categorizations(
+        db,
+        [
+            utils.categorized_result(
+                {"item_id": item_id},
+                "https://example.com/{}".format(item_id),
+                "<p>page {} about compost</p>".format(item_id),
+                {"Home": 0.9},
+                [],
+                0,
+            )
+            for item_id in (1, 2, 3)
+        ],
+        store,
+    )
+    assert 3 == search.index_pages(db, batch_size=2)
+    assert 0 == search.index_pages(db, batch_size=2)
+    assert [1, 2, 3] == sorted(ids(search.search(db, "compost", text=True)))
+
+
+def test_index_pages_makes_page_text_searchable(db):
+    store = html_store.HtmlStore(db)
+    result = utils.categorized_result(
+        {"item_id": 2},
+        "https://example.com/2",
+        "<html><head><title>x</title><script>var rye;</script></head>"
+        "<body><p>Use rye &amp; spelt flour</p></body></html>",
+        {"Food": 0.9},
+        [],
+        0,
+    )
+    utils.save_categorization(db, result, store)
+    assert 1 == search.index_pages(db)
+    assert 0 == search.index_pages(db)
+    assert [] == ids(search.search(db, "spelt"))
+    results = search.search(db, "spelt", text=True)
+    assert [2] == ids(results)
+    assert "rye & [spelt] flour" in results[0]["snippet"]
+    assert [] == ids(search.search(db, "var", text=True))
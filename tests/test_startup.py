@@ -0,0 +1,18 @@
+import subprocess
+import sys
+
+FORBIDDEN = ("homepage2vec", "torch", "httpx", "numpy")
+
+
+def test_cli_import_does_not_load_heavy_modules():
+    # sqlite_utils imports numpy whenever it is installed, so block it: an
+    # eager numpy import of our own then fails instead of going unnoticed
+    output = subprocess.check_output(
+        [
+            sys.executable,
+            "-c",
+            "import sys; sys.modules['numpy'] = None; import pocket_to_sqlite.cli; "
+            "print(sorted(m for m in {!r} if sys.modules.get(m)))".format(FORBIDDEN),
+        ]
+    )
+    assert b"[]" == output.strip()
@@ -0,0 +1,144 @@
+from click.testing import CliRunner
+from pocket_to_sqlite import cli, html_store, summaries, search, utils
+import json
+import pathlib
+import pytest
+import sqlite_utils
+
+TABLES = [summary[0] for summary in summaries.SUMMARIES]
+
+
+def item(item_id, url, time_added, status=0):
+    return {
+        "item_id": str(item_id),
+        "resolved_id": str(item_id),
+        "given_url": url,
+        "resolved_url": url,
+        "resolved_title": "Item {}".format(item_id),
+        "excerpt": "",
+        "time_added": str(time_added),
+        "time_updated": str(time_added),
+        "status": str(status),
+    }
+
+
+def snapshot(db):
+    return {
+        table: {row[0]: row[1] for row in db.execute("select * from [{}]".format(table))}
+        for table in TABLES
+        if db[table].exists()
+    }
+
+
+@pytest.fixture
+def db():
+    db = sqlite_utils.Database(memory=True)
+    utils.save_items(
+        [
+            item(1, "https://www.example.com/a", 1577836800),
+            item(2, "http://Example.com:8080/b", 1577836801, status=1),
+            item(3, "https://news.example.org/c?x=1", 1580515200),
+        ],
+        db,
+    )
+    utils.create_auto_tags_table(db)
+    summaries.ensure_summaries(db)
+    return db
+
+
+def test_domain_sql():
+    db = sqlite_utils.Database(memory=True)
+    urls = ["https://www.Example.com:8080/a/b", "http://foo.org", "foo.net/x", ""]
+    db["urls"].insert_all({"url": url} for url in urls)
+    assert ["example.com", "foo.org", "foo.net", ""] == [
+        row[0] for row in db.execute("select " + summaries.domain_sql("urls.url") + " from urls")
+    ]
+
+
+def test_ensure_summaries_counts_existing_rows(db):
+    assert {
+        "summary_categories": {},
+        "summary_months": {"2020-01": 2, "2020-02": 1},
+        "summary_statuses": {0: 2, 1: 1},
+        "summary_domains": {"example.com": 2, "news.example.org": 1},
+    } == snapshot(db)
+    # Nothing to do the second time
+    assert {} == summaries.ensure_summaries(db)
+
+
+def test_summaries_follow_writes(db):
+    utils.save_items(
+        [
+            # Moves to another month and status
+            dict(item(1, "https://www.example.com/a", 1583020800), status="1"),
+            item(4, "https://other.net/d", 1583020801),
+            # Deleted items drop out of the month and domain counts
+            {"item_id": "3", "status": "2"},
+        ],
+        db,
+    )
+    store = html_store.HtmlStore(db)
+    utils.save_categorizations(
+        db,
+        [
+            utils.categorized_result({"item_id": 1}, "u", "<p>", {"Arts": 0.9}, [0.5], 0.1),
+            utils.categorized_result({"item_id": 2}, "u", "<p>", {"News": 0.9}, [0.5], 0.1),
+            utils.error_result({"item_id": 4}, "Timeout"),
+        ],
+        store,
+    )
+    # A retried error that now succeeds, and a reclassification
+    utils.save_categorizations(
+        db,
+        [
+            utils.categorized_result({"item_id": 4}, "u", "<p>", {"Arts": 0.9}, [0.5], 0.1),
+            utils.categorized_result({"item_id": 2}, "u", "<p>", {"Science": 0.9}, [0.5], 0.1),
+        ],
+        store,
+    )
+    db.execute("delete from items where item_id = 2")
+    incremental = snapshot(db)
+    assert {
+        "summary_categories": {"Arts": 2, "Science": 1},
+        "summary_months": {"2020-03": 2},
+        "summary_statuses": {1: 1, 0: 1, 2: 1},
+        "summary_domains": {"example.com": 1, "other.net": 1},
+    } == incremental
+    summaries.rebuild_summaries(db)
+    assert incremental == snapshot(db)
+
+
+def test_bulk_load_rebuilds_once(db):
+    with summaries.bulk_load(db):
+        assert {} == summaries.stored_triggers(db, "items")
+        utils.save_items([item(4, "https://other.net/d", 1583020801)], db)
+    assert 3 == len(summaries.stored_triggers(db, "items"))
+    assert {"example.com": 2, "news.example.org": 1, "other.net": 1} == snapshot(db)[
+        "summary_domains"
+    ]
+
+
+def test_fetch_style_bulk_load_with_fts(db):
+    utils.ensure_fts(db)
+    with search.bulk_load(db), summaries.bulk_load(db):
+        utils.save_items([item(4, "https://other.net/d", 1583020801)], db)
+    assert 4 == sum(snapshot(db)["summary_statuses"].values())
+    assert 4 == db["items_fts"].count
+
+
+def test_rebuild_summaries_cli(tmpdir):
+    db_path = str(tmpdir / "pocket.db")
+    db = sqlite_utils.Database(db_path)
+    utils.save_items(json.load(open(pathlib.Path(__file__).parent / "pocket.json")), db)
+    db.close()
+    result = CliRunner().invoke(cli.cli, ["rebuild-summaries", db_path])
+    assert 0 == result.exit_code, result.output
+    assert "summary_domains: 1 rows" in result.output
+    db = sqlite_utils.Database(db_path)
+    assert {"people.idsia.ch": 1} == snapshot(db)["summary_domains"]
+
+
+def test_metadata_queries_run(db):
+    metadata = json.load(open(pathlib.Path(__file__).parent.parent / "metadata.json"))
+    for name, query in metadata["databases"]["pocket"]["queries"].items():
+        db.execute(query["sql"]).fetchall()